@@ -1,7 +1,169 @@
+"""Admin site for the app models.
+The changelists never count or page through more than `ADMIN_SCAN_LIMIT`
+rows: above it the total shown is the database's own row estimate. Related
+Users and UsageTypes are joined in the changelist query and picked through
+autocomplete widgets instead of full `<select>` lists. With several shards
+the Usage changelist lists one shard at a time, picked in the sidebar.
+"""
+import math
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.functional import cached_property
 
+from app.controller import delete_usage, delete_user, search_users
 from app.models import User, Usage, UsageTypes
+from app.serializers import UsageSerializer
+from app.sharding import is_sharded, shard_aliases, shard_for, use_shard
+
+ADMIN_SCAN_LIMIT = 10000
+
+
+def estimated_row_count(model, using=DEFAULT_DB_ALIAS):
+    """Return the row estimate kept by the database statistics for a model's table, or None."""
+    table = model._meta.db_table
+    connection = connections[using]
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            elif connection.vendor == 'sqlite' and 'sqlite_stat1' in connection.introspection.table_names():
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            else:
+                return None
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if not row:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that scans at most `scan_limit` rows.
+    Counts below the limit are exact; above it an unfiltered queryset reports
+    the estimated table size, and pages beyond the limit are not served.
+    """
+    scan_limit = ADMIN_SCAN_LIMIT
+
+    @cached_property
+    def count(self):
+        scanned = self.object_list.order_by().values('pk')[:self.scan_limit].count()
+        if scanned < self.scan_limit or self.object_list.query.has_filters():
+            return scanned
+        return max(estimated_row_count(self.object_list.model, using=self.object_list.db) or 0, scanned)
+
+    @cached_property
+    def num_pages(self):
+        return min(super().num_pages, max(1, math.ceil(self.scan_limit / self.per_page)))
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """Sidebar choice of the shard listed, the primary by default. Hidden with a single shard."""
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shard_aliases()] if is_sharded() else []
+
+    def choices(self, changelist):
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': (self.value() or shard_aliases()[0]) == alias,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        if not is_sharded():
+            return queryset
+        alias = self.value() if self.value() in shard_aliases() else shard_aliases()[0]
+        return queryset.using(alias)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(User)
+class UserAdmin(LargeTableAdmin):
+    list_display = ('name', 'is_staff', 'is_superuser')
+    list_filter = ('is_staff', 'is_superuser')
+    fields = ('name', 'is_staff', 'is_superuser')
+    search_fields = ('name',)
+    ordering = ('name',)
+
+    def get_search_results(self, request, queryset, search_term):
+        """Match names through the trigram index used by the users endpoint."""
+        if not search_term:
+            return queryset, False
+        return queryset.filter(pk__in=search_users(search=search_term).values('pk')), False
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.set_unusable_password()
+        super().save_model(request, obj, form, change)
+
+    def delete_model(self, request, obj):
+        delete_user(obj.pk)
+
+    def delete_queryset(self, request, queryset):
+        for user_id in queryset.values_list('pk', flat=True):
+            delete_user(user_id)
+
+
+@admin.register(UsageTypes)
+class UsageTypesAdmin(LargeTableAdmin):
+    list_display = ('name', 'unit', 'factor')
+    search_fields = ('name',)
+    ordering = ('name',)
+
+
+@admin.register(Usage)
+class UsageAdmin(LargeTableAdmin):
+    """Usages are written through the same paths as the API, so the rollups
+    and the change sequence stay consistent with admin edits."""
+    list_display = ('id', 'user_id', 'usage_type_id', 'usage_at', 'amount', 'emissions', 'resolution')
+    list_select_related = ('user_id', 'usage_type_id')
+    list_filter = (ShardListFilter, 'resolution', 'usage_type_id')
+    date_hierarchy = 'usage_at'
+    autocomplete_fields = ('user_id', 'usage_type_id')
+    fields = ('user_id', 'usage_type_id', 'usage_at', 'amount', 'idempotency_key')
+    ordering = ('-id',)
+
+    def get_object(self, request, object_id, from_field=None):
+        """Look the Usage up on every shard, primary first."""
+        for alias in shard_aliases():
+            with use_shard(alias):
+                obj = super().get_object(request, object_id, from_field)
+            if obj is not None:
+                return obj
+        return None
+
+    def save_model(self, request, obj, form, change):
+        data = dict(form.cleaned_data, idempotency_key=form.cleaned_data.get('idempotency_key') or None)
+        serializer = UsageSerializer()
+        if not change:
+            obj.pk = serializer.create(data).pk
+            return
+        stored = obj._state.db
+        if shard_for(data['user_id'].pk) != stored:
+            # Moved to a User of another shard.
+            with use_shard(stored):
+                delete_usage(obj.pk)
+            obj.pk = serializer.create(data).pk
+            return
+        with use_shard(stored):
+            serializer.update(Usage.objects.get(pk=obj.pk), data)
+
+    def delete_model(self, request, obj):
+        with use_shard(obj._state.db):
+            delete_usage(obj.pk)
 
-admin.site.register(User)
-admin.site.register(Usage)
-admin.site.register(UsageTypes)
\ No newline at end of file
+    def delete_queryset(self, request, queryset):
+        with use_shard(queryset.db):
+            for usage_id in queryset.values_list('pk', flat=True):
+                delete_usage(usage_id)
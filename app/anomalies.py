@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming detection of out of line Usage readings.
+Every created Usage updates, in O(1), the exponentially weighted mean and
+variance of the amounts of its `(user_id, usage_type_id)` series, once the
+transaction inserting it commits, so rolled back inserts leave the
+statistics untouched. A reading
+further than ANOMALY_THRESHOLD standard deviations from the mean of its
+series, once the series has ANOMALY_MIN_SAMPLES readings, is recorded as a
+UsageAnomaly in the transaction of the insert. The standard deviation is at
+least ANOMALY_MIN_STD_RATIO of the mean, so steady series do not flag every
+small change, and anomalous readings are clipped to the threshold before they
+are folded in, so one broken reading does not shift the mean.
+
+The statistics live in a bounded, least recently used, in-memory store of
+ANOMALY_STORE_SIZE series per process, so the ingest path never reads the
+database for them. The store is filled from the UsageStatistic checkpoints
+once per process, and the series changed since are written back every
+ANOMALY_CHECKPOINT_SECONDS, after the commit of the insert that found them
+due. Processes keep their own statistics; the last checkpoint of a series wins.
+A checkpoint skips the series of deleted Users and UsageTypes, and a series
+whose write fails is kept for the next checkpoint.
+"""
+import math
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+
+from app.models import UsageAnomaly, UsageStatistic, UsageTypes, User
+from app.sharding import current_shard, group_by_shard, scatter, shard_for
+
+# Smallest standard deviation, for series of zero amounts.
+MIN_STD = 1e-9
+
+
+def ewma_update(state, value, alpha):
+    """Fold a value into exponentially weighted statistics.
+    Until 1 / count drops below `alpha` the values are weighted equally, so
+    the first readings of a series give its plain mean and variance.
+        Args:
+            state (tuple): [Required]. `(count, mean, variance)`.
+            value (float): [Required].
+            alpha (float): [Required]. Weight of a new value once the series is long.
+        Returns (tuple):
+            Returns the new `(count, mean, variance)`.
+        >>> state = (0, 0.0, 0.0)
+        >>> for value in (10, 12, 14):
+        ...     state = ewma_update(state, value, 0.1)
+        >>> state[0], state[1], round(state[2], 4)
+        (3, 12.0, 2.6667)
+    """
+    count, mean, variance = state
+    if not count:
+        return 1, value, 0.0
+    weight = max(alpha, 1 / (count + 1))
+    difference = value - mean
+    increment = weight * difference
+    return count + 1, mean + increment, (1 - weight) * (variance + difference * increment)
+
+
+def anomaly_score(state, value, min_std_ratio):
+    """Return the distance of a value to the mean of the statistics in standard deviations.
+        >>> anomaly_score((20, 10.0, 4.0), 16, 0.25)
+        2.4
+    """
+    _, mean, variance = state
+    return (value - mean) / max(math.sqrt(variance), abs(mean) * min_std_ratio, MIN_STD)
+
+
+def score_reading(state, value):
+    """Score a reading against the statistics of its series.
+    Anomalous readings are clipped to the threshold before they are folded in,
+    so the statistics only move as far as the threshold.
+        Args:
+            state (tuple): [Required]. `(count, mean, variance)` of the series.
+            value (float): [Required]. Amount of the reading.
+        Returns (tuple):
+            Returns the score of the reading, None while the series is warming up,
+            and the value to fold into the statistics.
+    """
+    if state[0] < settings.ANOMALY_MIN_SAMPLES:
+        return None, value
+    threshold = settings.ANOMALY_THRESHOLD
+    score = anomaly_score(state, value, settings.ANOMALY_MIN_STD_RATIO)
+    if abs(score) > threshold:
+        value = state[1] + (value - state[1]) * threshold / abs(score)
+    return score, value
+
+
+class StatisticsStore:
+    """Bounded store of the statistics of the series of the current process.
+    Evicted series that were not checkpointed yet wait for the next checkpoint.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._series = OrderedDict()
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._checkpoint_due_at = time.monotonic() + settings.ANOMALY_CHECKPOINT_SECONDS
+
+    def load(self):
+        """Fill the store with the most recently checkpointed series of every shard."""
+        rows = []
+        for shard_rows in scatter(lambda: list(UsageStatistic.objects.order_by('-updated_at').values_list(
+                'user_id', 'usage_type_id', 'count', 'mean', 'variance', 'updated_at')[:self.capacity])):
+            rows.extend(shard_rows)
+        rows.sort(key=lambda row: row[-1])
+        with self._lock:
+            for user_id, usage_type_id, count, mean, variance, _ in rows[-self.capacity:]:
+                self._series.setdefault((user_id, usage_type_id), (count, mean, variance))
+
+    def get(self, key):
+        """Return the `(count, mean, variance)` of a series, empty for an unknown one."""
+        with self._lock:
+            return self._series.get(key, (0, 0.0, 0.0))
+
+    def fold(self, observations):
+        """Fold committed readings into the statistics of their series.
+            Args:
+                observations (list): [Required]. `((user_id, usage_type_id), value)` pairs,
+                    with the values returned by `score_reading`.
+            Returns (None):
+                None.
+        """
+        with self._lock:
+            for key, value in observations:
+                state = self._series.pop(key, (0, 0.0, 0.0))
+                self._series[key] = self._dirty[key] = ewma_update(state, value, settings.ANOMALY_EWMA_ALPHA)
+                if len(self._series) > self.capacity:
+                    self._series.popitem(last=False)
+
+    def forget(self, user_id):
+        """Drop the series of a deleted User, including the ones waiting for the checkpoint."""
+        with self._lock:
+            for series in (self._series, self._dirty):
+                for key in [key for key in series if key[0] == user_id]:
+                    del series[key]
+
+    def checkpoint_due(self):
+        """Return True once per ANOMALY_CHECKPOINT_SECONDS."""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._checkpoint_due_at:
+                return False
+            self._checkpoint_due_at = now + settings.ANOMALY_CHECKPOINT_SECONDS
+            return True
+
+    def checkpoint(self):
+        """Write the series changed since the last checkpoint to UsageStatistic.
+            Returns (int):
+                Number of series written.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        now = datetime.now(tz=pytz.utc)
+        written = 0
+        for alias, keys in group_by_shard(dirty, lambda key: key[0]).items():
+            try:
+                written += _upsert_statistics(alias, [key + dirty[key] for key in keys], now)
+            except DatabaseError:
+                # Runs after the commit of an unrelated insert: keep the series for the
+                # next checkpoint, unless they changed again since.
+                with self._lock:
+                    for key in keys:
+                        self._dirty.setdefault(key, dirty[key])
+        return written
+
+
+def _upsert_statistics(alias, rows, now):
+    # Series of Users or UsageTypes deleted since they were observed are dropped.
+    user_ids = set(User.objects.using(alias).filter(pk__in={row[0] for row in rows}).values_list('pk', flat=True))
+    usage_type_ids = set(UsageTypes.objects.using(alias).filter(pk__in={row[1] for row in rows})
+                         .values_list('pk', flat=True))
+    rows = [row for row in rows if row[0] in user_ids and row[1] in usage_type_ids]
+    if not rows:
+        return 0
+    connection = connections[alias]
+    field = UsageStatistic._meta.get_field
+    params = [(field('user_id').get_db_prep_value(user_id, connection), usage_type_id, count, mean, variance,
+               connection.ops.adapt_datetimefield_value(now))
+              for user_id, usage_type_id, count, mean, variance in rows]
+    sql = ('INSERT INTO {table} (user_id_id, usage_type_id_id, count, mean, variance, updated_at) '
+           'VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (user_id_id, usage_type_id_id) DO UPDATE SET '
+           'count = excluded.count, mean = excluded.mean, variance = excluded.variance, '
+           'updated_at = excluded.updated_at').format(table=UsageStatistic._meta.db_table)
+    with transaction.atomic(using=alias), connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+    return len(rows)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the statistics store of the process, loading the checkpoints on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            store = StatisticsStore(settings.ANOMALY_STORE_SIZE)
+            store.load()
+            _store = store
+    return _store
+
+
+def observe_usages(usages):
+    """Score newly created Usages, record their anomalies and update the statistics on commit.
+    Called in the transaction inserting the Usages, on their shard. Readings
+    of the same series are scored against the ones before them in `usages`.
+        Args:
+            usages (iterable): [Required]. Saved raw Usage models.
+        Returns (list):
+            Returns the UsageAnomaly models created.
+    """
+    store = get_store()
+    staged = {}
+    observations = []
+    anomalies = []
+    for usage in usages:
+        key = (usage.user_id_id, usage.usage_type_id_id)
+        amount = float(usage.amount)
+        state = staged[key] if key in staged else store.get(key)
+        score, value = score_reading(state, amount)
+        staged[key] = ewma_update(state, value, settings.ANOMALY_EWMA_ALPHA)
+        observations.append((key, value))
+        if score is not None and abs(score) > settings.ANOMALY_THRESHOLD:
+            anomalies.append(UsageAnomaly(user_id_id=usage.user_id_id, usage_type_id_id=usage.usage_type_id_id,
+                                          usage_id=usage.id, usage_at=usage.usage_at, amount=amount,
+                                          expected=state[1], score=score))
+    if anomalies:
+        UsageAnomaly.objects.bulk_create(anomalies)
+    transaction.on_commit(lambda: store.fold(observations), using=current_shard())
+    if store.checkpoint_due():
+        transaction.on_commit(store.checkpoint, using=current_shard())
+    return anomalies
+
+
+def forget_statistics(user_id):
+    """Drop the statistics of a User from the store of the process once its deletion commits.
+    Called in the transaction deleting the User; its checkpoints cascade with it.
+    """
+    if _store is not None:
+        transaction.on_commit(lambda: _store.forget(user_id), using=shard_for(user_id))
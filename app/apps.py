@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AppsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        from app.sharding import connect_reference_replication
+        connect_reference_replication()
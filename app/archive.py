@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+"""Retention tiering of Usages into columnar segment files.
+Usages older than the retention period are written per user and month to a
+segment file (see `app.segments`), recorded in UsageArchiveSegment and
+deleted from the Usage table in chunks. Archiving is not a deletion: the
+aggregates and the change sequence are left untouched, and readers merge
+the segments back in when a requested range reaches them.
+"""
+import heapq
+import itertools
+import os
+import uuid
+
+from datetime import date, datetime, timedelta
+
+import pytz
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import TruncMonth
+from django.utils.dateparse import parse_datetime
+
+from app.models import Usage, UsageArchiveSegment, UsageTypes, User
+from app.outbox import record_event
+from app.segments import COLUMNS, Segment, from_micros, to_micros, write_segment
+from app.sharding import atomic, on_user_shard, scatter, user_queryset
+
+ARCHIVE_DELETE_CHUNK_SIZE = 1000
+ARCHIVE_READ_CHUNK_SIZE = 1000
+# Catalog columns bounding the values of an ordering field in a segment.
+SEGMENT_BOUNDS = {'usage_at': ('start_at', 'end_at'), 'id': ('min_id', 'max_id')}
+
+
+def archive_cutoff(retention_days=None, now=None):
+    """Return the first day of the month that is still kept in the Usage table.
+    Only whole months older than the retention period are archived.
+    """
+    retention_days = settings.USAGE_RETENTION_DAYS if retention_days is None else retention_days
+    limit = (now or datetime.now(tz=pytz.utc)) - timedelta(days=retention_days)
+    return datetime(limit.year, limit.month, 1, tzinfo=pytz.utc)
+
+
+def archive_usages(cutoff, chunk_size=ARCHIVE_DELETE_CHUNK_SIZE, progress=None):
+    """Archive every Usage older than `cutoff`, one user and month at a time.
+        Args:
+            cutoff (datetime): [Required]. Usages before it are archived.
+            chunk_size (int): [Optional]. Usages deleted per transaction.
+            progress (callable): [Optional]. Called with every new UsageArchiveSegment.
+        Returns (int):
+            Number of Usages archived.
+    """
+    months = scatter(lambda: list(Usage.objects.filter(usage_at__lt=cutoff).order_by()
+                                  .annotate(period=TruncMonth('usage_at')).values_list('user_id', 'period').distinct()))
+    archived = 0
+    for user_id, period in [month for shard_months in months for month in shard_months]:
+        segment = archive_user_month(user_id, period.date(), cutoff, chunk_size=chunk_size)
+        if segment:
+            archived += segment.row_count
+            if progress:
+                progress(segment)
+    return archived
+
+
+@on_user_shard
+def archive_user_month(user_id, period, cutoff, chunk_size=ARCHIVE_DELETE_CHUNK_SIZE):
+    """Move the Usages of a User in one month to a new segment file.
+    The file is written and cataloged before any row is deleted; until the
+    deletion finishes readers drop the archived copies of rows still in the table.
+        Args:
+            user_id (string): [Required].
+            period (date): [Required]. First day of the month.
+            cutoff (datetime): [Required]. Usages at or after it are kept.
+            chunk_size (int): [Optional]. Usages deleted per transaction.
+        Returns (UsageArchiveSegment):
+            Returns the new segment, or None if there was nothing to archive.
+    """
+    start = datetime(period.year, period.month, 1, tzinfo=pytz.utc)
+    end = min(_next_month(start), cutoff)
+    rows = Usage.objects.filter(user_id=user_id, usage_at__gte=start, usage_at__lt=end) \
+        .order_by('usage_at', 'id').values_list(*[name for name, _ in COLUMNS])
+    columns = {name: [] for name, _ in COLUMNS}
+    for row in rows.iterator(chunk_size=chunk_size):
+        for (name, _), value in zip(COLUMNS, row):
+            columns[name].append(to_micros(value) if name == 'usage_at' else value)
+    if not columns['id']:
+        return None
+
+    relative_path = os.path.join(uuid.UUID(str(user_id)).hex,
+                                 '{:%Y-%m}-{}.useg'.format(period, uuid.uuid4().hex[:12]))
+    write_segment(os.path.join(settings.USAGE_ARCHIVE_DIR, relative_path), columns)
+    segment = UsageArchiveSegment.objects.create(
+        user_id_id=user_id, period=period, path=relative_path, row_count=len(columns['id']),
+        start_at=from_micros(columns['usage_at'][0]), end_at=from_micros(columns['usage_at'][-1]),
+        min_id=min(columns['id']), max_id=max(columns['id']),
+    )
+
+    usage_ids = columns['id']
+    for index in range(0, len(usage_ids), chunk_size):
+        with atomic():
+            Usage.objects.filter(pk__in=usage_ids[index:index + chunk_size]).delete()
+            record_event(user_id, 'usage', 'archived', usage_ids=usage_ids[index:index + chunk_size],
+                         segment_id=segment.pk)
+    return segment
+
+
+def segments_in_range(user_id, start, end):
+    """Return the UsageArchiveSegments of a User overlapping [start, end]."""
+    return user_queryset(UsageArchiveSegment, user_id) \
+        .filter(user_id=user_id, start_at__lte=end, end_at__gte=start).order_by('start_at')
+
+
+def archived_usages(segments, start, end, user=None, exclude_ids=()):
+    """Rebuild the archived Usages of some segments that fall in [start, end].
+    The returned models carry their User and UsageType, so serializing them
+    does not query the database again.
+        Args:
+            segments (iterable): [Required]. UsageArchiveSegment models.
+            start (datetime): [Required].
+            end (datetime): [Required].
+            user (User): [Optional]. Owner of the segments.
+            exclude_ids (set): [Optional]. IDs of Usages still in the table.
+        Returns (list):
+            Returns Usage models ordered by segment and `usage_at`.
+    """
+    usage_types = None
+    usages = []
+    for segment_row in segments:
+        if usage_types is None:
+            usage_types = UsageTypes.objects.in_bulk()
+        usages.extend(_read_usages(segment_row, start, end, usage_types, user=user, exclude_ids=exclude_ids))
+    return usages
+
+
+def _read_usages(segment_row, start, end, usage_types, user=None, exclude_ids=(), usage_type_ids=None):
+    start_micros, end_micros = to_micros(start), to_micros(end)
+    with Segment(os.path.join(settings.USAGE_ARCHIVE_DIR, segment_row.path)) as segment:
+        columns = {name: segment.column(name) for name, _ in COLUMNS}
+    usages = []
+    for index, micros in enumerate(columns['usage_at']):
+        if not start_micros <= micros <= end_micros or columns['id'][index] in exclude_ids \
+                or usage_type_ids and columns['usage_type_id'][index] not in usage_type_ids:
+            continue
+        usage = Usage(
+            id=columns['id'][index], user_id_id=segment_row.user_id_id,
+            usage_type_id_id=columns['usage_type_id'][index], usage_at=from_micros(micros),
+            amount=columns['amount'][index], factor=columns['factor'][index],
+            emissions=columns['emissions'][index], change_seq=columns['change_seq'][index],
+            resolution=columns['resolution'][index], sample_count=columns['sample_count'][index],
+        )
+        usage._state.adding = False
+        usage.usage_type_id = usage_types[usage.usage_type_id_id]
+        if user is not None:
+            usage.user_id = user
+        usages.append(usage)
+    return usages
+
+
+class MergedUsages:
+    """Ordered, lazy view of the live Usages of a User merged with the
+    archived ones of some segments, as returned by `app.controller.get_usages`.
+    The live queryset and every segment are merged as rows are read, and a
+    segment file is only opened once the merge reaches the range of the
+    ordering field recorded in its catalog row (see SEGMENT_BOUNDS). A slice
+    reads at most `stop` live rows, so a page never loads the whole history.
+    Like a queryset it supports `count()`, slicing and iteration.
+        Args:
+            live (QuerySet): [Required]. Live Usages, ordered by `orderby`.
+            segments (list): [Required]. UsageArchiveSegment models overlapping [start, end].
+            start (datetime): [Required].
+            end (datetime): [Required].
+            orderby (string): [Required]. Ordering field, `-` prefixed when descending.
+            user_id (string): [Required]. Owner of the Usages.
+            usage_type_ids (set): [Optional]. UsageType IDs the archived Usages must have.
+    """
+
+    def __init__(self, live, segments, start, end, orderby, user_id, usage_type_ids=None):
+        self.live = live
+        self.segments = list(segments)
+        self.start, self.end = start, end
+        self.user_id = user_id
+        self.usage_type_ids = usage_type_ids
+        self.reverse = orderby.startswith('-')
+        self.field = Usage._meta.get_field(orderby.lstrip('-'))
+        self._count = None
+        self._live_in_segments = None
+        self._references = None
+
+    def count(self):
+        """Return the number of Usages, from the catalog for segments wholly in range."""
+        if self._count is None:
+            self._count = self.live.count() + sum(self._archived_count(segment) for segment in self.segments)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return self._merge(self.live.iterator(chunk_size=ARCHIVE_READ_CHUNK_SIZE))
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        live = self.live if index.stop is None else self.live[:index.stop]
+        return list(itertools.islice(self._merge(iter(live)), index.start or 0, index.stop))
+
+    def _merge(self, live):
+        heap = []
+        order = itertools.count()
+
+        def push(usages):
+            usage = next(usages, None)
+            if usage is not None:
+                key = self._key(usage)
+                heapq.heappush(heap, (_Descending(key) if self.reverse else key, next(order), key, usage, usages))
+
+        push(live)
+        pending = sorted(self.segments, key=self._bound_order, reverse=self.reverse)
+        while heap or pending:
+            while pending and (not heap or self._reached(heap[0][2], pending[0])):
+                push(iter(self._read(pending.pop(0))))
+            _, _, _, usage, usages = heapq.heappop(heap)
+            yield usage
+            push(usages)
+
+    def _key(self, usage):
+        value = getattr(usage, self.field.attname)
+        return value is not None, value if value is not None else 0, usage.id
+
+    def _bound(self, segment):
+        names = SEGMENT_BOUNDS.get(self.field.attname)
+        return getattr(segment, names[1 if self.reverse else 0]) if names else None
+
+    def _bound_order(self, segment):
+        # Segments without a bound are opened first, whatever the direction.
+        bound = self._bound(segment)
+        return (bound is None) == self.reverse, bound
+
+    def _reached(self, key, segment):
+        bound = self._bound(segment)
+        if bound is None:
+            return True
+        return key[1] <= bound if self.reverse else bound <= key[1]
+
+    def _read(self, segment):
+        if self._references is None:
+            self._references = User.objects.get(pk=self.user_id), UsageTypes.objects.in_bulk()
+        user, usage_types = self._references
+        usages = _read_usages(segment, self.start, self.end, usage_types, user=user,
+                              exclude_ids=self._live_ids(segment), usage_type_ids=self.usage_type_ids)
+        usages.sort(key=self._key, reverse=self.reverse)
+        return usages
+
+    def _live_ids(self, segment):
+        # Rows of a segment whose archiving has not finished are still in the table.
+        if self._live_in_segments is None:
+            self._live_in_segments = list(
+                user_queryset(Usage, self.user_id)
+                .filter(user_id=self.user_id, usage_at__gte=min(row.start_at for row in self.segments),
+                        usage_at__lte=max(row.end_at for row in self.segments))
+                .values_list('id', 'usage_at'))
+        return {usage_id for usage_id, moment in self._live_in_segments
+                if segment.start_at <= moment <= segment.end_at}
+
+    def _archived_count(self, segment):
+        live_ids = self._live_ids(segment)
+        if not live_ids and not self.usage_type_ids and self.start <= segment.start_at \
+                and segment.end_at <= self.end:
+            return segment.row_count
+        start_micros, end_micros = to_micros(self.start), to_micros(self.end)
+        with Segment(os.path.join(settings.USAGE_ARCHIVE_DIR, segment.path)) as reader:
+            rows = zip(reader.column('id'), reader.column('usage_type_id'), reader.column('usage_at'))
+            return sum(1 for usage_id, usage_type_id, micros in rows
+                       if start_micros <= micros <= end_micros and usage_id not in live_ids
+                       and (not self.usage_type_ids or usage_type_id in self.usage_type_ids))
+
+
+class _Descending:
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def segment_deltas(segments):
+    """Build rollup deltas from archive segments, like `app.rollups.queryset_deltas`.
+    Rows still in the Usage table, whose archiving has not finished, are
+    left out so they are not counted twice.
+        Args:
+            segments (iterable): [Required]. UsageArchiveSegment models of the current shard.
+        Returns (dict):
+            Returns a dict of `[amount, emissions, count]` keyed by
+            `(user_id, usage_type_id, period)`.
+    """
+    deltas = {}
+    for segment_row in segments:
+        with Segment(os.path.join(settings.USAGE_ARCHIVE_DIR, segment_row.path)) as segment:
+            columns = {name: segment.column(name) for name in ('id', 'usage_type_id', 'amount', 'emissions',
+                                                               'sample_count')}
+        live_ids = set(Usage.objects.filter(user_id=segment_row.user_id_id, usage_at__gte=segment_row.start_at,
+                                            usage_at__lte=segment_row.end_at).values_list('pk', flat=True))
+        for index, usage_id in enumerate(columns['id']):
+            if usage_id in live_ids:
+                continue
+            # Segments hold one month of one User.
+            delta = deltas.setdefault((segment_row.user_id_id, columns['usage_type_id'][index], segment_row.period),
+                                      [0.0, 0.0, 0])
+            delta[0] += columns['amount'][index]
+            delta[1] += columns['emissions'][index] or 0.0
+            delta[2] += columns['sample_count'][index]
+    return deltas
+
+
+def delete_segments(user_id):
+    """Delete the segments of a User, removing the files once the transaction commits.
+        Args:
+            user_id (string): [Required].
+        Returns (int):
+            Number of archived Usages deleted.
+    """
+    segments = list(UsageArchiveSegment.objects.filter(user_id=user_id))
+    paths = [os.path.join(settings.USAGE_ARCHIVE_DIR, segment.path) for segment in segments]
+    UsageArchiveSegment.objects.filter(pk__in=[segment.pk for segment in segments]).delete()
+    transaction.on_commit(lambda: [os.remove(path) for path in paths if os.path.exists(path)])
+    return sum(segment.row_count for segment in segments)
+
+
+def parse_bound(value):
+    """Return a range bound given as a datetime or ISO string as an aware datetime."""
+    if isinstance(value, str):
+        value = parse_datetime(value) or datetime.combine(date.fromisoformat(value), datetime.min.time())
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value
+
+
+def _next_month(moment):
+    return (moment.replace(day=1) + timedelta(days=32)).replace(day=1)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""Monthly emissions budgets per User and UsageType.
+Consumption is the `emissions` of the UsagePeriodTotal of the month, which
+is kept up to date by every Usage write (see app/rollups.py), so checking a
+budget never aggregates Usages. When a write moves the total of a month past
+a share of BUDGET_THRESHOLDS of the limit, a BudgetEvent is recorded in the
+transaction of the write. The unique constraint on the events makes every
+threshold of a month recorded exactly once, even when the total drops and
+rises again or concurrent writes cross it together.
+"""
+from django.conf import settings
+
+from app.models import BudgetEvent, EmissionsBudget, UsagePeriodTotal
+
+
+def crossed_thresholds(old, new, limit):
+    """Return the shares of BUDGET_THRESHOLDS of `limit` reached going from `old` to `new` emissions.
+        >>> crossed_thresholds(40.0, 85.0, 100.0)
+        [0.5, 0.8]
+    """
+    return [threshold for threshold in settings.BUDGET_THRESHOLDS if old < threshold * limit <= new]
+
+
+def check_budgets(changes):
+    """Record the thresholds crossed by changes of the running totals of the current shard.
+        Args:
+            changes (dict): [Required]. `(old_emissions, new_emissions)` keyed by
+                `(user_id, usage_type_id, period)`.
+        Returns (list):
+            Returns the BudgetEvent models of the crossings.
+    """
+    rising = {key: change for key, change in changes.items() if change[1] > change[0]}
+    if not rising:
+        return []
+    budgets = {(budget.user_id_id, budget.usage_type_id_id): budget.limit for budget in EmissionsBudget.objects.filter(
+        user_id__in={user_id for user_id, _, _ in rising}, usage_type_id__in={key[1] for key in rising})}
+    events = [
+        BudgetEvent(user_id_id=user_id, usage_type_id_id=usage_type_id, period=period, threshold=threshold,
+                    limit=budgets[(user_id, usage_type_id)], emissions=new)
+        for (user_id, usage_type_id, period), (old, new) in rising.items() if (user_id, usage_type_id) in budgets
+        for threshold in crossed_thresholds(old, new, budgets[(user_id, usage_type_id)])
+    ]
+    if events:
+        BudgetEvent.objects.bulk_create(events, ignore_conflicts=True)
+    return events
+
+
+def check_budget(budget, period):
+    """Record the thresholds of a new or changed budget already reached by the total of `period`."""
+    total = UsagePeriodTotal.objects.filter(user_id=budget.user_id_id, usage_type_id=budget.usage_type_id_id,
+                                            period=period).values_list('emissions', flat=True).first()
+    if total is None:
+        return []
+    events = [BudgetEvent(user_id_id=budget.user_id_id, usage_type_id_id=budget.usage_type_id_id, period=period,
+                          threshold=threshold, limit=budget.limit, emissions=total)
+              for threshold in crossed_thresholds(float('-inf'), total, budget.limit)]
+    BudgetEvent.objects.bulk_create(events, ignore_conflicts=True)
+    return events
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Change sequence for incremental sync of Usages.
+Every Usage write stamps the row with a value of the `usage` ChangeCounter,
+and every deletion leaves a UsageTombstone with its own value, so a client
+holding a cursor only has to fetch what was written after it.
+Each shard has its own counter, so writes only wait for the writes of the
+same shard. Cursors are per User, whose changes all come from one shard;
+a counter starts from the value of the primary and `move_user` carries it
+along, so the sequence of a User never goes back.
+"""
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F
+
+from app.models import ChangeCounter, UsageTombstone
+from app.sharding import current_shard
+
+USAGE_COUNTER = 'usage'
+
+
+def allocate_change_seq(count=1, name=USAGE_COUNTER):
+    """Reserve `count` consecutive values of a counter of the current shard.
+        Args:
+            count (int): [Optional]. Number of values to reserve.
+            name (string): [Optional]. Name of the counter.
+        Returns (int):
+            Returns the first reserved value.
+    """
+    alias = current_shard()
+    # The UPDATE locks the row until the commit and reads back the value it wrote.
+    with transaction.atomic(using=alias, savepoint=False):
+        last = _increment(alias, name, count)
+        if last is None:
+            seed = ChangeCounter.objects.using(DEFAULT_DB_ALIAS).filter(name=name).values_list('value', flat=True)
+            ChangeCounter.objects.using(alias).get_or_create(name=name, defaults={'value': seed.first() or 0})
+            last = _increment(alias, name, count)
+    return last - count + 1
+
+
+def _increment(alias, name, count):
+    connection = connections[alias]
+    # Backends that return columns from an INSERT also support UPDATE ... RETURNING.
+    if connection.features.can_return_columns_from_insert:
+        sql = 'UPDATE {table} SET value = value + %s WHERE name = %s RETURNING value'.format(
+            table=connection.ops.quote_name(ChangeCounter._meta.db_table))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [count, name])
+            row = cursor.fetchone()
+        return row[0] if row else None
+    counter = ChangeCounter.objects.using(alias).filter(name=name)
+    if counter.update(value=F('value') + count):
+        return counter.values_list('value', flat=True).get()
+    return None
+
+
+def stamp_usages(usages):
+    """Give each Usage a new change sequence value before it is saved.
+        Args:
+            usages (list): [Required]. Usage models.
+        Returns (list):
+            Returns the same Usage models.
+    """
+    if usages:
+        first = allocate_change_seq(len(usages))
+        for offset, usage in enumerate(usages):
+            usage.change_seq = first + offset
+    return usages
+
+
+def record_tombstones(user_id, usage_ids):
+    """Record the deletion of some Usages of a User.
+        Args:
+            user_id (string): [Required].
+            usage_ids (list): [Required]. IDs of the deleted Usages.
+        Returns (None):
+            None.
+    """
+    if usage_ids:
+        first = allocate_change_seq(len(usage_ids))
+        UsageTombstone.objects.bulk_create([
+            UsageTombstone(user_id=user_id, usage_id=usage_id, change_seq=first + offset)
+            for offset, usage_id in enumerate(usage_ids)
+        ])
+
+
+def record_reset(user_id):
+    """Record the deletion of all Usages of a User with a single tombstone.
+        Args:
+            user_id (string): [Required].
+        Returns (None):
+            None.
+    """
+    UsageTombstone.objects.create(user_id=user_id, usage_id=None, change_seq=allocate_change_seq())
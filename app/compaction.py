@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Downsampling of old raw readings into hourly or daily aggregate Usages.
+For every `(user, usage_type)` the Usages older than an age threshold are
+grouped into UTC hours or days, and every group is replaced by one Usage at
+the start of the bucket holding the summed amount and emissions, with the
+number of raw readings in `sample_count`. Buckets never cross a month, so
+the rollups do not change. Only buckets still holding finer Usages are
+rewritten, which makes running the job again a no-op.
+"""
+from datetime import datetime, timedelta
+
+import pytz
+
+from app.changes import record_tombstones, stamp_usages
+from app.live import usage_payload
+from app.models import Usage
+from app.outbox import record_event
+from app.sharding import allocate_usage_ids, atomic, on_user_shard, scatter
+
+COMPACTION_CHUNK_SIZE = 1000
+RESOLUTIONS = {label: value for value, label in Usage.Resolution.choices if value}
+
+
+def compaction_cutoff(resolution, older_than_days, now=None):
+    """Return the start of the bucket reached `older_than_days` ago.
+    Only whole buckets before it are compacted.
+    """
+    limit = (now or datetime.now(tz=pytz.utc)) - timedelta(days=older_than_days)
+    return bucket_start(limit, resolution)
+
+
+def compact_usages(resolution, cutoff, chunk_size=COMPACTION_CHUNK_SIZE, progress=None):
+    """Compact every Usage older than `cutoff` to `resolution`, one User and UsageType at a time.
+        Args:
+            resolution (int): [Required]. Seconds per bucket, a `Usage.Resolution` value.
+            cutoff (datetime): [Required]. Usages before it are compacted.
+            chunk_size (int): [Optional]. Usages read per transaction; a bucket is never split.
+            progress (callable): [Optional]. Called with the user id, usage type id and
+                number of Usages replaced for every series.
+        Returns (int):
+            Number of Usages replaced by aggregates.
+    """
+    cutoff = bucket_start(cutoff, resolution)
+    series = scatter(lambda: list(Usage.objects.filter(usage_at__lt=cutoff, resolution__lt=resolution).order_by()
+                                  .values_list('user_id', 'usage_type_id').distinct()))
+    replaced = 0
+    for user_id, usage_type_id in [pair for shard_series in series for pair in shard_series]:
+        count = compact_series(user_id, usage_type_id, resolution, cutoff, chunk_size=chunk_size)
+        replaced += count
+        if progress:
+            progress(user_id, usage_type_id, count)
+    return replaced
+
+
+@on_user_shard
+def compact_series(user_id, usage_type_id, resolution, cutoff, chunk_size=COMPACTION_CHUNK_SIZE):
+    """Compact the Usages of one User and UsageType before `cutoff`.
+    The series is walked in windows of about `chunk_size` Usages, widened to
+    whole buckets, and each window is rewritten in its own transaction.
+        Args:
+            user_id (string): [Required].
+            usage_type_id (int): [Required].
+            resolution (int): [Required]. Seconds per bucket.
+            cutoff (datetime): [Required]. Start of a bucket; Usages at or after it are kept.
+            chunk_size (int): [Optional]. Usages read per transaction.
+        Returns (int):
+            Number of Usages replaced by aggregates.
+    """
+    finer = Usage.objects.filter(user_id=user_id, usage_type_id=usage_type_id,
+                                 usage_at__lt=cutoff, resolution__lt=resolution).order_by('usage_at')
+    replaced = 0
+    while True:
+        first = finer.values_list('usage_at', flat=True).first()
+        if first is None:
+            return replaced
+        start = bucket_start(first, resolution)
+        last = list(finer.values_list('usage_at', flat=True)[chunk_size - 1:chunk_size])
+        end = min(bucket_start(last[0], resolution) + timedelta(seconds=resolution), cutoff) if last else cutoff
+        replaced += _compact_window(user_id, usage_type_id, resolution, start, end)
+
+
+def bucket_start(moment, resolution):
+    """Return the start of the UTC bucket of `resolution` seconds containing `moment`."""
+    seconds = int(moment.timestamp())
+    return datetime.fromtimestamp(seconds - seconds % resolution, tz=pytz.utc)
+
+
+@atomic()
+def _compact_window(user_id, usage_type_id, resolution, start, end):
+    rows = Usage.objects.select_for_update() \
+        .filter(user_id=user_id, usage_type_id=usage_type_id, usage_at__gte=start, usage_at__lt=end,
+                resolution__lte=resolution) \
+        .values_list('id', 'usage_at', 'amount', 'factor', 'emissions', 'resolution', 'sample_count')
+    buckets = {}
+    for row in rows:
+        buckets.setdefault(bucket_start(row[1], resolution), []).append(row)
+
+    replaced_ids = []
+    aggregates = []
+    for bucket, bucket_rows in sorted(buckets.items()):
+        if all(row[5] == resolution for row in bucket_rows):
+            continue
+        amount = sum(row[2] for row in bucket_rows)
+        emissions = None if all(row[4] is None for row in bucket_rows) \
+            else sum(row[4] or 0.0 for row in bucket_rows)
+        factors = {row[3] for row in bucket_rows}
+        if len(factors) == 1:
+            factor = factors.pop()
+        else:
+            factor = emissions / amount if amount and emissions is not None else None
+        aggregates.append(Usage(
+            user_id_id=user_id, usage_type_id_id=usage_type_id, usage_at=bucket, amount=amount,
+            factor=factor, emissions=emissions, resolution=resolution,
+            sample_count=sum(row[6] for row in bucket_rows),
+        ))
+        replaced_ids.extend(row[0] for row in bucket_rows)
+
+    for index in range(0, len(replaced_ids), COMPACTION_CHUNK_SIZE):
+        Usage.objects.filter(pk__in=replaced_ids[index:index + COMPACTION_CHUNK_SIZE]).delete()
+    record_tombstones(user_id, replaced_ids)
+    Usage.objects.bulk_create(stamp_usages(allocate_usage_ids(aggregates)))
+    if replaced_ids:
+        record_event(user_id, 'usage', 'compacted', replaced_ids=replaced_ids,
+                     usages=[usage_payload(usage) for usage in aggregates])
+    return len(replaced_ids)
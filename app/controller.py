@@ -13,14 +13,230 @@ The operations apply to the following models:
 Todo:
     * Adding Logging
 """
+import bisect
+import heapq
+import itertools
 import pytz
+import uuid
 
-from datetime import datetime
+from datetime import date, datetime
 
-from django.db.models import Q
-from rest_framework.exceptions import PermissionDenied
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q, QuerySet, Sum
+from rest_framework.exceptions import PermissionDenied, ValidationError
 
-from app.models import User, UsageTypes, Usage
+from app.anomalies import forget_statistics, observe_usages
+from app.budgets import check_budget
+from app.analytics import ANALYTICS_MAX_WINDOW, ANALYTICS_WINDOW, load_usage_columns, usage_analytics
+from app.archive import MergedUsages, archived_usages, delete_segments, parse_bound, segments_in_range
+from app.changes import allocate_change_seq, record_reset, record_tombstones, stamp_usages
+from app.live import notify_usage_event, usage_payload
+from app.models import (
+    BudgetEvent,
+    EmissionsBudget,
+    FactorRecomputeJob,
+    User,
+    UsageAnomaly,
+    UsagePeriodTotal,
+    UsageTypeFactor,
+    UsageTombstone,
+    UsageTypes,
+    Usage,
+    UserPeriodEmissions
+)
+from app.outbox import outbox_event, record_event, record_events
+from app.rollups import (
+    apply_usage_deltas,
+    forget_user,
+    load_sketch,
+    merge_deltas,
+    period_of,
+    queryset_deltas,
+    usage_deltas
+)
+from app.sharding import (
+    allocate_usage_ids,
+    atomic,
+    group_by_shard,
+    on_user_shard,
+    scatter,
+    shard_aliases,
+    shard_for,
+    use_shard,
+    user_queryset
+)
+from app.singleflight import coalesce
+
+USERS_PAGE_SIZE = 100
+USERS_MAX_PAGE_SIZE = 1000
+USAGE_BATCH_SIZE = 500
+FACTOR_RECOMPUTE_CHUNK_SIZE = 1000
+LEADERBOARD_SIZE = 10
+LEADERBOARD_MAX_SIZE = 100
+CHANGES_PAGE_SIZE = 500
+CHANGES_MAX_PAGE_SIZE = 5000
+BATCH_MAX_REQUESTS = 50
+USAGE_FILTERS = ('start_date', 'end_date', 'usage_type_id')
+EXPORT_FIELDS = ('id', 'usage_type_id', 'usage_at', 'amount', 'factor', 'emissions')
+SERIES_FIELDS = ('usage_at', 'usage_type_id', 'amount', 'emissions')
+SERIES_MAX_SIZE = 100000
+# Names accepted by the `fields` query parameter and the columns each one reads;
+# `user` and `usage_type` are the only ones joining another table.
+USAGE_FIELDS = {
+    'id': ('id',),
+    'user': ('user_id__name',),
+    'usage_type': ('usage_type_id__name', 'usage_type_id__unit', 'usage_type_id__factor'),
+    'usage_type_id': ('usage_type_id',),
+    'usage_at': ('usage_at',),
+    'amount': ('amount',),
+    'emissions': ('emissions',),
+    'resolution': ('resolution',),
+    'sample_count': ('sample_count',),
+}
+
+
+def apply_effective_factors(usages):
+    """Set the factor snapshot and emissions of Usages from the factor
+    version effective at their `usage_at`.
+    Versions of all the UsageTypes involved are fetched in one query; a
+    UsageType without a version covering `usage_at` falls back to its `factor`.
+        Args:
+            usages (list): [Required]. Unsaved or changed Usage models.
+        Returns (list):
+            Returns the same Usage models.
+    """
+    versions = {}
+    usage_type_ids = {usage.usage_type_id_id for usage in usages}
+    for version in UsageTypeFactor.objects.filter(usage_type_id__in=usage_type_ids):
+        versions.setdefault(version.usage_type_id_id, []).append(version)
+
+    for usage in usages:
+        candidates = versions.get(usage.usage_type_id_id, [])
+        index = bisect.bisect_right([version.valid_from for version in candidates], usage.usage_at) - 1
+        if index >= 0 and candidates[index].covers(usage.usage_at):
+            usage.apply_factor(candidates[index].factor)
+        else:
+            usage.apply_factor(usage.usage_type_id.factor)
+    return usages
+
+
+def bulk_create_usages(rows, batch_size=USAGE_BATCH_SIZE):
+    """Create many Usages with bulk inserts, computing their emissions.
+    Rows carrying an `idempotency_key` already stored for the same User are
+    not written again: the stored Usage is returned in their place. The
+    insert is attempted first, so the lookup of stored keys only runs when
+    the unique index reports a conflict. The rows of each shard are written
+    in their own transaction.
+        Args:
+            rows (list): [Required]. Dicts with `user_id`, `usage_type_id`
+                (model instances), `usage_at`, `amount` and optionally `idempotency_key`.
+            batch_size (int): [Optional]. Rows per INSERT statement.
+        Returns (list):
+            Returns the created or previously stored Usage models, in the order of `rows`.
+    """
+    usages = apply_effective_factors([Usage(**row) for row in rows])
+    created = {}
+    for alias, shard_usages in group_by_shard(usages, lambda usage: usage.user_id_id).items():
+        with use_shard(alias):
+            created.update(zip(map(id, shard_usages), _create_usages(shard_usages, batch_size)))
+    return [created[id(usage)] for usage in usages]
+
+
+def _create_usages(usages, batch_size):
+    try:
+        return _insert_usages(_unique_by_key(usages), batch_size, usages)
+    except IntegrityError:
+        if not any(usage.idempotency_key for usage in usages):
+            raise
+        # The transaction was rolled back, forget the keys of the batches that went through.
+        for usage in usages:
+            usage.pk = None
+            usage._state.adding = True
+
+    stored = {}
+    keys = {usage.idempotency_key for usage in usages if usage.idempotency_key}
+    user_ids = {usage.user_id_id for usage in usages if usage.idempotency_key}
+    for usage in Usage.objects.filter(user_id__in=user_ids, idempotency_key__in=keys) \
+            .select_related('user_id', 'usage_type_id'):
+        stored[(usage.user_id_id, usage.idempotency_key)] = usage
+
+    resolved = [stored.get((usage.user_id_id, usage.idempotency_key), usage) if usage.idempotency_key else usage
+                for usage in usages]
+    pending = _unique_by_key([usage for usage in resolved if usage.pk is None])
+    return _insert_usages(pending, batch_size, resolved)
+
+
+def _unique_by_key(usages):
+    seen = set()
+    unique = []
+    for usage in usages:
+        key = (usage.user_id_id, usage.idempotency_key)
+        if usage.idempotency_key and key in seen:
+            continue
+        seen.add(key)
+        unique.append(usage)
+    return unique
+
+
+def _insert_usages(pending, batch_size, ordered):
+    with atomic():
+        Usage.objects.bulk_create(stamp_usages(allocate_usage_ids(pending)), batch_size=batch_size)
+        apply_usage_deltas(usage_deltas(pending))
+        observe_usages(pending)
+        by_user = {}
+        for usage in pending:
+            by_user.setdefault(usage.user_id_id, []).append(usage)
+        events = []
+        for user_id, created in by_user.items():
+            payloads = [usage_payload(usage) for usage in created]
+            notify_usage_event(user_id, 'created', {period_of(usage.usage_at) for usage in created}, usages=payloads)
+            events.append(outbox_event(user_id, 'usage', 'created', usages=payloads))
+        record_events(events)
+
+    # Rows repeating a key of the same batch resolve to the first one.
+    first_by_key = {(usage.user_id_id, usage.idempotency_key): usage for usage in reversed(pending)
+                    if usage.idempotency_key}
+    return [first_by_key.get((usage.user_id_id, usage.idempotency_key), usage) if usage.pk is None else usage
+            for usage in ordered]
+
+
+def create_usage_type_factor(usage_type_id, factor, valid_from, valid_to=None):
+    """Add a factor version to a UsageType and queue the recomputation
+    of the Usages it covers.
+    An open ended version that started earlier is closed at `valid_from`, and
+    a new version without `valid_to` ends where the next version starts.
+        Args:
+            usage_type_id (int): [Required].
+            factor (float): [Required].
+            valid_from (datetime): [Required].
+            valid_to (datetime): [Optional].
+        Returns (tuple):
+            Returns the created UsageTypeFactor and FactorRecomputeJob models.
+        Raises:
+            ValidationError: If the validity range overlaps another version.
+    """
+    with transaction.atomic():
+        usage_type = UsageTypes.objects.select_for_update().get(pk=usage_type_id)
+        versions = UsageTypeFactor.objects.filter(usage_type_id=usage_type)
+
+        if valid_to is None:
+            next_version = versions.filter(valid_from__gt=valid_from).order_by('valid_from').first()
+            valid_to = next_version.valid_from if next_version else None
+        if valid_to is not None and valid_to <= valid_from:
+            raise ValidationError({'valid_to': 'valid_to must be later than valid_from.'})
+
+        overlapping = versions.filter(valid_from__gte=valid_from)
+        if valid_to is not None:
+            overlapping = overlapping.filter(valid_from__lt=valid_to)
+        if overlapping.exists():
+            raise ValidationError({'valid_from': 'The validity range overlaps an existing factor version.'})
+
+        versions.filter(Q(valid_from__lt=valid_from) & (Q(valid_to__isnull=True) | Q(valid_to__gt=valid_from))) \
+            .update(valid_to=valid_from)
+        version = UsageTypeFactor.objects.create(usage_type_id=usage_type, factor=factor,
+                                                 valid_from=valid_from, valid_to=valid_to)
+        job = FactorRecomputeJob.objects.create(factor_version=version)
+    return version, job
 
 
 def create_user(data):
@@ -32,9 +248,12 @@ def create_user(data):
             None.
     """
     user = User(name=data.get('name'))
-    user.save()
+    with atomic(shard_for(user.pk)):
+        user.save()
+        record_event(user.pk, 'user', 'created', name=user.name)
 
 
+@on_user_shard
 def delete_all_usage_by_user_id(user_id=None):
     """Delete all Usages for a particular user from the database.
         Args:
@@ -42,24 +261,87 @@ def delete_all_usage_by_user_id(user_id=None):
         Returns (int):
             Number of records deleted.
     """
-    queryset = Usage.objects.filter(user_id=user_id)
-    count = queryset.count()
-    queryset.delete()
+    with atomic():
+        forget_user(user_id)
+        count, _ = Usage.objects.filter(user_id=user_id).delete()
+        count += delete_segments(user_id)
+        record_reset(user_id)
+        notify_usage_event(user_id, 'reset')
+        record_event(user_id, 'usage', 'reset')
     return count
 
 
-def delete_usage(usage_id):
+@on_user_shard
+def delete_usage(usage_id, user_id=None):
     """Delete a Usage from the database.
         Args:
             usage_id (int): [Required].
+            user_id (string): [Optional]. Only delete a Usage of this User;
+                without it the Usage is looked up on the current shard.
         Returns (None):
             None.
     """
-    Usage.objects.get(pk=usage_id).delete()
+    with atomic():
+        queryset = Usage.objects.select_for_update()
+        if user_id is not None:
+            queryset = queryset.filter(user_id=user_id)
+        usage = queryset.get(pk=usage_id)
+        usage.delete()
+        apply_usage_deltas(usage_deltas([usage], sign=-1))
+        record_tombstones(usage.user_id_id, [usage_id])
+        notify_usage_event(usage.user_id_id, 'deleted', [period_of(usage.usage_at)], count=1)
+        record_event(usage.user_id_id, 'usage', 'deleted', usage_ids=[usage_id])
+
+
+@on_user_shard
+def delete_usages(user_id, chunk_size=USAGE_BATCH_SIZE, **kwargs):
+    """Delete the live Usages of a User matching the filters of `get_usages`.
+        Each chunk of primary keys is removed with one DELETE statement and
+        its rollup deltas computed with one aggregate query, in a transaction
+        of its own. Archived Usages are read-only, so a range reaching them is
+        rejected (see `check_live_range`).
+        Args:
+            user_id (string): [Required].
+            chunk_size (int): [Optional]. Usages deleted per transaction.
+            **kwargs (dict): [Optional]. Same filters as `get_usages`.
+        Returns (int):
+            Number of records deleted.
+    """
+    check_live_range(user_id, **kwargs)
+    matching = filter_usages(user_id, **kwargs)
+    deleted = 0
+    last_id = 0
+    while True:
+        usage_ids = list(matching.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not usage_ids:
+            return deleted
+        with atomic():
+            chunk = Usage.objects.filter(pk__in=usage_ids)
+            removed = queryset_deltas(chunk, sign=-1)
+            count, _ = chunk.delete()
+            apply_usage_deltas(removed)
+            record_tombstones(user_id, usage_ids)
+            notify_usage_event(user_id, 'deleted', [period for _, _, period in removed], count=count)
+            record_event(user_id, 'usage', 'deleted', usage_ids=usage_ids)
+        deleted += count
+        last_id = usage_ids[-1]
+
+
+@on_user_shard
+def delete_emissions_budget(user_id, usage_type_id):
+    """Delete the emissions budget of a User for a UsageType. Its recorded events are kept.
+        Args:
+            user_id (string): [Required].
+            usage_type_id (int): [Required].
+        Returns (int):
+            Number of budgets deleted.
+    """
+    count, _ = EmissionsBudget.objects.filter(user_id=user_id, usage_type_id=usage_type_id).delete()
+    return count
 
 
 def delete_usage_type(usage_type_id):
-    """Delete a UsageType from the database.
+    """Delete a UsageType from the database, and its copies from the other shards.
         Args:
             usage_type_id (int): [Required].
         Returns (None):
@@ -68,16 +350,25 @@ def delete_usage_type(usage_type_id):
     UsageTypes.objects.get(pk=usage_type_id).delete()
 
 
+@on_user_shard
 def delete_user(user_id):
-    """Delete a User from the database.
+    """Delete a User from the database, with its data on its shard.
         Args:
             user_id (string): [Required].
         Returns (None):
             None.
     """
-    User.objects.get(pk=user_id).delete()
+    with atomic(shard_for(user_id)):
+        user = User.objects.get(pk=user_id)
+        forget_user(user.pk)
+        forget_statistics(user.pk)
+        delete_segments(user.pk)
+        user.delete()
+        record_reset(user_id)
+        record_event(user_id, 'user', 'deleted')
 
 
+@coalesce
 def get_all_usage_types():
     """Get all UsageTypes from the database.
         Args:
@@ -90,47 +381,460 @@ def get_all_usage_types():
     return {'Usage Types': usage_types_data}
 
 
-def get_all_users():
-    """Get all Users from the database.
+def get_all_users(search=None, prefix=None, after=None, limit=USERS_PAGE_SIZE):
+    """Get one page of Users from the database, ordered by name.
+        Only the `id` and `name` columns are selected and pages are fetched
+        by keyset (`name > after`) so deep pages cost the same as the first one.
         Args:
-            None.
+            search (string): [Optional]. Substring the user name must contain.
+            prefix (string): [Optional]. Prefix the user name must start with.
+            after (string): [Optional]. Name of the last user of the previous page.
+            limit (int): [Optional]. Page size, capped at USERS_MAX_PAGE_SIZE.
+        Returns (dict):
+            Returns a dict containing list of Users and the cursor of the next page.
+        Raises (ValidationError):
+            If `limit` is not an integer.
+    """
+    try:
+        limit = max(1, min(int(limit), USERS_MAX_PAGE_SIZE))
+    except ValueError:
+        raise ValidationError({'limit': 'Expected integer limit.'})
+    queryset = search_users(search=search, prefix=prefix)
+    if after:
+        queryset = queryset.filter(name__gt=after)
+
+    users_data = [{"id": user_id.hex, "name": name}
+                  for user_id, name in queryset.values_list('id', 'name')[:limit + 1]]
+    next_cursor = users_data[limit - 1]['name'] if len(users_data) > limit else None
+    return {'users': users_data[:limit], 'next': next_cursor}
+
+
+def iter_users(search=None, prefix=None, chunk_size=USERS_PAGE_SIZE):
+    """Iterate over all matching Users without materializing the table.
+        Args:
+            search (string): [Optional]. Substring the user name must contain.
+            prefix (string): [Optional]. Prefix the user name must start with.
+            chunk_size (int): [Optional]. Rows fetched from the cursor per round trip.
+        Returns (generator):
+            Yields a dict with the `id` and `name` of each User.
+    """
+    queryset = search_users(search=search, prefix=prefix).values_list('id', 'name')
+    for user_id, name in queryset.iterator(chunk_size=chunk_size):
+        yield {"id": user_id.hex, "name": name}
+
+
+def search_users(search=None, prefix=None):
+    """Build a User queryset filtered by name, ordered by name.
+        On SQLite the name is matched through the `app_user_name_fts` FTS5
+        trigram table, on PostgreSQL through the `app_user_name_trgm` GIN index.
+        Args:
+            search (string): [Optional]. Substring the user name must contain.
+            prefix (string): [Optional]. Prefix the user name must start with.
+        Returns (QuerySet):
+            Returns a User queryset restricted to the `id` and `name` columns.
+    """
+    queryset = User.objects.only('id', 'name').order_by('name')
+    if search:
+        queryset = _filter_user_name(queryset, search, '%{}%')
+    if prefix:
+        queryset = _filter_user_name(queryset, prefix, '{}%')
+    return queryset
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _filter_user_name(queryset, value, template):
+    pattern = template.format(_escape_like(value))
+    if connection.vendor == 'sqlite' and _has_user_name_fts():
+        # FTS5 only answers a LIKE without ESCAPE from the trigram index, so the
+        # index is probed with the value unescaped, which can only match more
+        # names, and names are rechecked exactly when the value holds wildcards.
+        queryset = queryset.extra(
+            where=["app_user.id IN (SELECT user_id FROM app_user_name_fts WHERE name LIKE %s)"],
+            params=[template.format(value)],
+        )
+        if pattern == template.format(value):
+            return queryset
+        return queryset.extra(where=["app_user.name LIKE %s ESCAPE '\\'"], params=[pattern])
+    return queryset.extra(where=["app_user.name ILIKE %s" if connection.vendor == 'postgresql'
+                                 else "app_user.name LIKE %s ESCAPE '\\'"],
+                          params=[pattern])
+
+
+def _has_user_name_fts():
+    return 'app_user_name_fts' in connection.introspection.table_names(include_views=False)
+
+
+@coalesce
+def get_emissions_leaderboard(period, limit=LEADERBOARD_SIZE):
+    """Get the Users with the highest emissions in a month.
+    Reads the top of the (period, -emissions) index of UserPeriodEmissions on
+    every shard and merges them.
+        Args:
+            period (date): [Required]. Any day of the month.
+            limit (int): [Optional]. Number of Users, capped at LEADERBOARD_MAX_SIZE.
+        Returns (dict):
+            Returns a dict containing the ranked list of Users and their emissions.
+        Raises (ValidationError):
+            If `limit` is not an integer.
+    """
+    period = date(period.year, period.month, 1)
+    try:
+        limit = max(1, min(int(limit), LEADERBOARD_MAX_SIZE))
+    except ValueError:
+        raise ValidationError({'limit': 'Expected integer limit.'})
+    entries = heapq.merge(*scatter(lambda: list(
+        UserPeriodEmissions.objects.filter(period=period).order_by('-emissions')
+        .values_list('user_id', 'user_id__name', 'emissions', 'count')[:limit]
+    )), key=lambda entry: -entry[2])
+    entries = itertools.islice(entries, limit)
+    leaderboard_data = [{"rank": rank, "id": user_id.hex, "name": name, "emissions": emissions, "count": count}
+                        for rank, (user_id, name, emissions, count) in enumerate(entries, start=1)]
+    return {'period': period.strftime('%Y-%m'), 'leaderboard': leaderboard_data}
+
+
+@on_user_shard
+def get_emissions_budgets(user_id, period):
+    """Get the emissions budgets of a User with their consumption in a month.
+    Consumption is read from the running UsagePeriodTotals, so the cost
+    depends on the number of budgets, not on the number of Usages.
+        Args:
+            user_id (string): [Required].
+            period (date): [Required]. Any day of the month.
         Returns (dict):
-            Returns a dict containing list of Users.
+            Returns a dict with, per budget, the limit, the emissions of the month,
+            the share of the limit used and the thresholds crossed in the month.
     """
-    users = User.objects.all()
-    users_data = [{"id": user.id.hex, "name": user.name} for user in users]
-    return {'users' : users_data}
+    period = date(period.year, period.month, 1)
+    budgets = list(EmissionsBudget.objects.filter(user_id=user_id).order_by('usage_type_id'))
+    usage_type_ids = [budget.usage_type_id_id for budget in budgets]
+    totals = dict(UsagePeriodTotal.objects.filter(user_id=user_id, period=period, usage_type_id__in=usage_type_ids)
+                  .values_list('usage_type_id', 'emissions'))
+    crossed = {}
+    for usage_type_id, threshold in BudgetEvent.objects.filter(user_id=user_id, period=period) \
+            .order_by('threshold').values_list('usage_type_id', 'threshold'):
+        crossed.setdefault(usage_type_id, []).append(threshold)
 
+    budgets_data = []
+    for budget in budgets:
+        emissions = totals.get(budget.usage_type_id_id, 0.0)
+        budgets_data.append({"usage_type_id": budget.usage_type_id_id, "limit": budget.limit, "emissions": emissions,
+                             "remaining": budget.limit - emissions,
+                             "used": emissions / budget.limit if budget.limit else None,
+                             "thresholds_crossed": crossed.get(budget.usage_type_id_id, [])})
+    return {"period": period.strftime('%Y-%m'), "budgets": budgets_data}
 
-def get_usage(usage_id=None):
+
+def get_factor_job(job_id):
+    """Get the progress of a FactorRecomputeJob from the database.
+        Args:
+            job_id (int): [Required].
+        Returns (dict):
+            Returns a dict containing the status and progress of the job.
+    """
+    job = FactorRecomputeJob.objects.get(pk=job_id)
+    return {"id": job.id, "factor_version": job.factor_version_id, "status": job.status,
+            "total": job.total, "processed": job.processed, "error": job.error}
+
+
+@on_user_shard
+def get_usage(usage_id=None, user_id=None, for_update=False, fields=None):
     """Get Usage from the database.
+        The owner filter is part of the primary key query, and the User and
+        UsageType are joined in, so the lookup costs a single query.
         Args:
             usage_id (int): [Required].
+            user_id (string): [Optional]. Only match a Usage of this User.
+            for_update (bool): [Optional]. Lock the Usage row until the transaction ends.
+            fields (iterable): [Optional]. Names of USAGE_FIELDS, only their columns are loaded.
         Returns (dict):
             Returns a Usage model containing one record.
     """
-    usage_data = Usage.objects.get(pk=usage_id)
+    queryset = project_usages(Usage.objects.all(), fields) if fields \
+        else Usage.objects.select_related('user_id', 'usage_type_id')
+    if for_update:
+        queryset = queryset.select_for_update(of=('self',))
+    if user_id is not None:
+        queryset = queryset.filter(user_id=user_id)
+    usage_data = queryset.get(pk=usage_id)
     return usage_data
 
 
+@on_user_shard
 def get_usages(user_id=None, *args, **kwargs):
     """Get Usage from the database.
+    When the requested range reaches archived months, the archived Usages are
+    read back from their segment files and merged in as the rows are read.
         Args:
             user_id (string): [Required].
             *args (iterable): [Optional].
             **kwargs (dict): [Optional].
         Returns (dict):
-            Returns a Usage model queryset containing one or more records.
+            Returns a Usage model queryset containing one or more records, or a
+            MergedUsages sequence when archived Usages are part of the range.
     """
     orderby = ''.join(['-', kwargs.get('orderby', 'id')]) \
         if kwargs.get('order') == 'desc' \
         else kwargs.get('orderby', 'id')
     start_date = kwargs.get('start_date', datetime(1970, 1, 1, 0, 0))
     end_date = kwargs.get('end_date', datetime.now(tz=pytz.utc))
+    usage_type_ids = _parse_usage_type_ids(kwargs.get('usage_type_id'))
+    fields = parse_usage_fields(kwargs.get('fields'))
 
-    Usage.objects.filter(user_id=user_id).order_by(orderby)
-    usage_data = Usage.objects.filter(Q(user_id=user_id) & Q(usage_at__gte=start_date) & Q(usage_at__lte=end_date)).order_by(orderby)
-    return usage_data
+    usage_data = filter_usages(user_id, **kwargs).order_by(orderby)
+    if fields:
+        usage_data = project_usages(usage_data, fields)
+
+    start, end = parse_bound(start_date), parse_bound(end_date)
+    segments = list(segments_in_range(user_id, start, end))
+    if not segments:
+        return usage_data
+
+    live = usage_data if fields else usage_data.select_related('user_id', 'usage_type_id')
+    return MergedUsages(live, segments, start, end, orderby, user_id, usage_type_ids=usage_type_ids)
+
+
+def filter_usages(user_id, start_date=None, end_date=None, usage_type_id=None, **kwargs):
+    """Build the queryset of the live Usages of a User matching the filters of `get_usages`.
+        Args:
+            user_id (string): [Required].
+            start_date (string): [Optional]. Earliest `usage_at`, defaults to the epoch.
+            end_date (string): [Optional]. Latest `usage_at`, defaults to now.
+            usage_type_id (string): [Optional]. One UsageType ID or comma separated IDs.
+            **kwargs (dict): [Optional]. Other query parameters, ignored.
+        Returns (QuerySet):
+            Returns an unordered Usage queryset.
+    """
+    queryset = user_queryset(Usage, user_id).filter(Q(user_id=user_id)
+                                                    & Q(usage_at__gte=start_date or datetime(1970, 1, 1, 0, 0))
+                                                    & Q(usage_at__lte=end_date or datetime.now(tz=pytz.utc)))
+    usage_type_ids = _parse_usage_type_ids(usage_type_id)
+    if usage_type_ids:
+        queryset = queryset.filter(usage_type_id__in=usage_type_ids)
+    return queryset
+
+
+def check_live_range(user_id, start_date=None, end_date=None, **kwargs):
+    """Reject a bulk change whose range reaches the archived Usages of a User.
+        Archive segments are immutable and keep the rollups of their months,
+        so bulk updates and deletions only apply to the Usage table; the range
+        must start after the last archived Usage.
+        Args:
+            user_id (string): [Required].
+            start_date (string): [Optional]. Earliest `usage_at`, defaults to the epoch.
+            end_date (string): [Optional]. Latest `usage_at`, defaults to now.
+            **kwargs (dict): [Optional]. Other query parameters, ignored.
+        Raises (ValidationError):
+            If an archive segment of the User overlaps the range.
+    """
+    start = parse_bound(start_date or datetime(1970, 1, 1, 0, 0))
+    end = parse_bound(end_date or datetime.now(tz=pytz.utc))
+    segment = segments_in_range(user_id, start, end).order_by('-end_at').first()
+    if segment is not None:
+        raise ValidationError({'start_date': 'Usages up to {} are archived and cannot be changed; start the range '
+                                             'after it.'.format(segment.end_at.isoformat())})
+
+
+def parse_usage_fields(value):
+    """Parse the `fields` query parameter of the Usage endpoints.
+        Args:
+            value (string): [Optional]. Comma separated names of USAGE_FIELDS.
+        Returns (tuple):
+            Returns the requested names, or None when every field is requested.
+        >>> parse_usage_fields('amount, usage_at')
+        ('amount', 'usage_at')
+    """
+    if value in (None, ''):
+        return None
+    fields = tuple(dict.fromkeys(name.strip() for name in str(value).split(',') if name.strip()))
+    unknown = [name for name in fields if name not in USAGE_FIELDS]
+    if unknown or not fields:
+        raise ValidationError({'fields': 'Expected comma separated names out of {}.'.format(', '.join(USAGE_FIELDS))})
+    return fields
+
+
+def project_usages(queryset, fields):
+    """Restrict a Usage queryset to the columns of a sparse fieldset.
+    The related tables are only joined for `user` and `usage_type`, and the
+    ordering columns stay loaded so sorting never reads a deferred field.
+        Args:
+            queryset (QuerySet): [Required]. Usage queryset.
+            fields (iterable): [Required]. Names of USAGE_FIELDS.
+        Returns (QuerySet):
+            Returns the queryset loading only the needed columns.
+    """
+    columns = {column for name in fields for column in USAGE_FIELDS[name]}
+    columns.update(name.lstrip('-') for name in queryset.query.order_by if name.lstrip('-') != 'pk')
+    related = sorted({column.split('__')[0] for column in columns if '__' in column})
+    queryset = queryset.select_related(*related) if related else queryset.select_related(None)
+    return queryset.only(*columns)
+
+
+def _parse_usage_type_ids(value):
+    if value in (None, ''):
+        return None
+    values = value if isinstance(value, (list, tuple, set)) else str(value).split(',')
+    try:
+        return {int(item) for item in values}
+    except ValueError:
+        raise ValidationError({'usage_type_id': 'Expected one or more comma separated ids.'})
+
+
+@coalesce
+@on_user_shard
+def get_usage_totals(user_id=None, **kwargs):
+    """Get amount and emissions totals per UsageType for a User.
+        Emissions are read from the stored `Usage.emissions` column, so the
+        aggregate never joins UsageTypes. Archived months in the range are
+        added from their segment files. Counts are numbers of raw readings.
+        Args:
+            user_id (string): [Required].
+            **kwargs (dict): [Optional]. Same filters as `get_usages`.
+        Returns (dict):
+            Returns a dict with the totals per UsageType and the overall emissions.
+    """
+    start_date = kwargs.get('start_date', datetime(1970, 1, 1, 0, 0))
+    end_date = kwargs.get('end_date', datetime.now(tz=pytz.utc))
+    usage_type_ids = _parse_usage_type_ids(kwargs.get('usage_type_id'))
+    live = filter_usages(user_id, **kwargs)
+    totals = {row['usage_type_id']: row for row in live
+              .order_by('usage_type_id')
+              .values('usage_type_id')
+              .annotate(amount=Sum('amount'), emissions=Sum('emissions'), count=Sum('sample_count'))}
+
+    start, end = parse_bound(start_date), parse_bound(end_date)
+    segments = list(segments_in_range(user_id, start, end))
+    if segments:
+        live_ids = set(live.filter(usage_at__lte=max(segment.end_at for segment in segments))
+                       .values_list('id', flat=True))
+        for usage in archived_usages(segments, start, end, exclude_ids=live_ids):
+            if usage_type_ids and usage.usage_type_id_id not in usage_type_ids:
+                continue
+            row = totals.setdefault(usage.usage_type_id_id, {'usage_type_id': usage.usage_type_id_id,
+                                                             'amount': 0.0, 'emissions': 0.0, 'count': 0})
+            row['amount'] += usage.amount
+            row['emissions'] = (row['emissions'] or 0.0) + (usage.emissions or 0.0)
+            row['count'] += usage.sample_count
+
+    totals = [totals[usage_type_id] for usage_type_id in sorted(totals)]
+    return {'totals': totals, 'emissions': sum(row['emissions'] or 0 for row in totals)}
+
+
+def get_usage_analytics(user_ids, window=ANALYTICS_WINDOW, start_date=None, end_date=None, usage_type_id=None,
+                        **kwargs):
+    """Get rolling averages, trend slopes, year-over-year deltas and seasonal
+    baselines per UsageType over the Usages of one or more Users.
+    The Usages are loaded as NumPy columns and every metric is vectorized,
+    see app/analytics.py.
+        Args:
+            user_ids (iterable): [Required]. IDs of the Users, one for a single User.
+            window (int): [Optional]. Days of the rolling averages, capped at ANALYTICS_MAX_WINDOW.
+            start_date (string): [Optional]. Earliest `usage_at`, defaults to the epoch.
+            end_date (string): [Optional]. Latest `usage_at`, defaults to now.
+            usage_type_id (string): [Optional]. One UsageType ID or comma separated IDs.
+            **kwargs (dict): [Optional]. Other query parameters, ignored.
+        Returns (dict):
+            Returns a dict with the metrics per UsageType.
+    """
+    try:
+        window = max(1, min(int(window), ANALYTICS_MAX_WINDOW))
+    except ValueError:
+        raise ValidationError({'window': 'Expected a number of days.'})
+    try:
+        user_ids = [uuid.UUID(str(user_id)) for user_id in user_ids]
+    except ValueError:
+        user_ids = None
+    if not user_ids:
+        raise ValidationError({'user_id': 'Expected one or more comma separated user ids.'})
+    columns = load_usage_columns(user_ids, start=parse_bound(start_date) if start_date else None,
+                                 end=parse_bound(end_date) if end_date else None,
+                                 usage_type_ids=_parse_usage_type_ids(usage_type_id))
+    return usage_analytics(columns, window=window)
+
+
+def get_usage_anomalies(user_id, start_date=None, end_date=None, usage_type_id=None, **kwargs):
+    """Get the anomalies found at ingest among the Usages of a User.
+        Args:
+            user_id (string): [Required].
+            start_date (string): [Optional]. Earliest `usage_at`, defaults to the epoch.
+            end_date (string): [Optional]. Latest `usage_at`, defaults to now.
+            usage_type_id (string): [Optional]. One UsageType ID or comma separated IDs.
+            **kwargs (dict): [Optional]. Other query parameters, ignored.
+        Returns (QuerySet):
+            Returns a UsageAnomaly queryset, latest `usage_at` first.
+    """
+    queryset = user_queryset(UsageAnomaly, user_id).filter(user_id=user_id)
+    if start_date:
+        queryset = queryset.filter(usage_at__gte=start_date)
+    if end_date:
+        queryset = queryset.filter(usage_at__lte=end_date)
+    usage_type_ids = _parse_usage_type_ids(usage_type_id)
+    if usage_type_ids:
+        queryset = queryset.filter(usage_type_id__in=usage_type_ids)
+    return queryset.order_by('-usage_at', '-id')
+
+
+def iter_usage_rows(user_id=None, **kwargs):
+    """Iterate over the Usages of a User, archived ones included, as flat rows.
+        Args:
+            user_id (string): [Required].
+            **kwargs (dict): [Optional]. Same filters and ordering as `get_usages`.
+        Returns (generator):
+            Yields tuples of `EXPORT_FIELDS`.
+    """
+    usages = get_usages(user_id, **kwargs)
+    if isinstance(usages, QuerySet):
+        yield from usages.values_list(*EXPORT_FIELDS).iterator(chunk_size=USAGE_BATCH_SIZE)
+        return
+    for usage in usages:
+        yield _usage_row(usage, EXPORT_FIELDS)
+
+
+def _usage_row(usage, names):
+    return tuple(getattr(usage, Usage._meta.get_field(name).attname) for name in names)
+
+
+@on_user_shard
+def get_usage_series(user_id, limit=SERIES_MAX_SIZE, offset=0, **kwargs):
+    """Get the Usages of a User as parallel columns, for charts.
+    Rows are read as tuples of SERIES_FIELDS without building models, and
+    the User and UsageTypes they reference are sent once instead of per row.
+        Args:
+            user_id (string): [Required].
+            limit (int): [Optional]. Rows per page, capped at SERIES_MAX_SIZE.
+            offset (int): [Optional]. Rows to skip.
+            **kwargs (dict): [Optional]. Same filters and ordering as `get_usages`.
+        Returns (dict):
+            Returns a dict with one list per column of SERIES_FIELDS, `usage_at`
+            in Unix seconds, the referenced `users` and `usage_types` keyed by id,
+            and the `next_offset` of the following page, or None.
+    """
+    try:
+        limit, offset = max(1, min(int(limit), SERIES_MAX_SIZE)), max(0, int(offset))
+    except ValueError:
+        raise ValidationError({'limit': 'Expected integer limit and offset.'})
+    kwargs.pop('fields', None)
+    usages = get_usages(user_id, **kwargs)
+    if isinstance(usages, QuerySet):
+        rows = list(usages.values_list(*SERIES_FIELDS)[offset:offset + limit + 1])
+    else:
+        rows = [_usage_row(usage, SERIES_FIELDS) for usage in usages[offset:offset + limit + 1]]
+    has_more = len(rows) > limit
+    usage_at, usage_type_ids, amounts, emissions = (list(column) for column in zip(*rows[:limit])) \
+        if rows else ([], [], [], [])
+
+    usage_types = UsageTypes.objects.filter(pk__in=set(usage_type_ids)).values('id', 'name', 'unit', 'factor')
+    return {
+        "users": {str(user.id): {"name": user.name} for user in User.objects.filter(pk=user_id).only('name')},
+        "usage_types": {usage_type.pop('id'): usage_type for usage_type in usage_types},
+        "usage_at": [moment.timestamp() for moment in usage_at],
+        "usage_type_id": usage_type_ids,
+        "amount": amounts,
+        "emissions": emissions,
+        "next_offset": offset + limit if has_more else None,
+    }
 
 
 def get_usage_type_by_id(usage_type_id):
@@ -144,6 +848,95 @@ def get_usage_type_by_id(usage_type_id):
     return usage_type_data
 
 
+def get_usage_type_factors(usage_type_id):
+    """Get all factor versions of a UsageType from the database.
+        Args:
+            usage_type_id (int): [Required].
+        Returns (dict):
+            Returns a dict containing list of factor versions ordered by `valid_from`.
+    """
+    versions = UsageTypeFactor.objects.filter(usage_type_id=usage_type_id).order_by('valid_from')
+    versions_data = [{"id": version.id, "factor": version.factor,
+                      "valid_from": version.valid_from, "valid_to": version.valid_to} for version in versions]
+    return {'factors': versions_data}
+
+
+@on_user_shard
+def get_usage_changes(user_id, since=0, limit=CHANGES_PAGE_SIZE):
+    """Get the Usage writes and deletions of a User after a cursor.
+    Both tables are read through their (user_id, change_seq) index, so the
+    cost depends on the number of changes, not on the size of the history.
+    Values shared by several rows (set-based updates) are never split across pages.
+        Args:
+            user_id (string): [Required].
+            since (int): [Optional]. Cursor returned by the previous call, 0 for everything.
+            limit (int): [Optional]. Page size, capped at CHANGES_MAX_PAGE_SIZE.
+        Returns (dict):
+            Returns a dict with the ordered list of changes, the next cursor and
+            whether more changes are waiting. A `reset` change means every Usage
+            written before it was deleted.
+        Raises (ValidationError):
+            If `since` is not a non-negative integer or `limit` not an integer.
+    """
+    try:
+        since = int(since)
+    except ValueError:
+        since = -1
+    if since < 0:
+        raise ValidationError({'since': 'Expected a cursor returned by a previous call, or 0.'})
+    try:
+        limit = max(1, min(int(limit), CHANGES_MAX_PAGE_SIZE))
+    except ValueError:
+        raise ValidationError({'limit': 'Expected integer limit.'})
+    fields = ('id', 'change_seq', 'usage_type_id', 'usage_at', 'amount', 'emissions')
+    usages = Usage.objects.filter(user_id=user_id, change_seq__gt=since).order_by('change_seq', 'id')
+    tombstones = UsageTombstone.objects.filter(user_id=user_id, change_seq__gt=since).order_by('change_seq', 'id')
+
+    changes = [dict(zip(('op',) + fields, ('upsert',) + row))
+               for row in usages.values_list(*fields)[:limit + 1]]
+    changes += [{'op': 'delete' if usage_id else 'reset', 'id': usage_id, 'change_seq': change_seq}
+                for usage_id, change_seq in tombstones.values_list('usage_id', 'change_seq')[:limit + 1]]
+    changes.sort(key=lambda change: change['change_seq'])
+
+    has_more = len(changes) > limit
+    if has_more:
+        last_seq = changes[limit - 1]['change_seq']
+        changes = [change for change in changes[:limit] if change['change_seq'] < last_seq] + [
+            dict(zip(('op',) + fields, ('upsert',) + row))
+            for row in usages.filter(change_seq=last_seq).values_list(*fields)
+        ] + [
+            {'op': 'delete' if usage_id else 'reset', 'id': usage_id, 'change_seq': change_seq}
+            for usage_id, change_seq in tombstones.filter(change_seq=last_seq).values_list('usage_id', 'change_seq')
+        ]
+
+    cursor = changes[-1]['change_seq'] if changes else since
+    return {'changes': changes, 'cursor': cursor, 'has_more': has_more}
+
+
+@coalesce
+@on_user_shard
+def get_usage_percentile(user_id, usage_type_id, period):
+    """Get where a User's monthly total of a UsageType ranks among all Users.
+    Reads one UsagePeriodTotal row and the stripes of one UsageTypeSketch,
+    whatever the number of Usages.
+        Args:
+            user_id (string): [Required].
+            usage_type_id (int): [Required].
+            period (date): [Required]. Any day of the month.
+        Returns (dict):
+            Returns a dict with the User's total amount, its percentile and the
+            number of Users in the distribution.
+    """
+    period = date(period.year, period.month, 1)
+    total = UsagePeriodTotal.objects.filter(user_id=user_id, usage_type_id=usage_type_id, period=period).first()
+    amount = total.amount if total else 0.0
+    sketch = load_sketch(usage_type_id, period)
+    rank = sketch.rank(amount) if sketch else None
+    return {"usage_type_id": int(usage_type_id), "period": period.strftime('%Y-%m'), "amount": amount,
+            "percentile": round(rank * 100, 2) if rank is not None else None,
+            "users": sketch.count if sketch else 0}
+
+
 def get_user_name_by_id(user_id):
     """Get User name from the database using user_id.
         Args:
@@ -177,6 +970,152 @@ def get_user_id_by_name(name):
     return user.id
 
 
+def run_factor_recompute_job(job, chunk_size=FACTOR_RECOMPUTE_CHUNK_SIZE, progress=None):
+    """Recompute the factor snapshot and emissions of the Usages covered by
+    a factor version, one bounded transaction per chunk of primary keys.
+    Progress is saved after every chunk, so an interrupted job resumes after
+    the last recomputed Usage. Usage ids are unique across shards, so every
+    chunk takes the lowest pending ids of all the shards.
+        Args:
+            job (FactorRecomputeJob): [Required].
+            chunk_size (int): [Optional]. Usages updated per transaction.
+            progress (callable): [Optional]. Called with the job after every chunk.
+        Returns (FactorRecomputeJob):
+            Returns the finished job.
+    """
+    version = job.factor_version
+    affected = Usage.objects.filter(usage_type_id=version.usage_type_id_id, usage_at__gte=version.valid_from)
+    if version.valid_to is not None:
+        affected = affected.filter(usage_at__lt=version.valid_to)
+
+    job.status = FactorRecomputeJob.RUNNING
+    if job.total is None:
+        job.total = sum(scatter(affected.count))
+    job.save(update_fields=['status', 'total', 'updated_at'])
+
+    try:
+        while True:
+            pending = scatter(lambda: list(affected.filter(pk__gt=job.last_usage_id).order_by('pk')
+                                           .values_list('pk', flat=True)[:chunk_size]))
+            chunk_ids = sorted(itertools.chain.from_iterable(pending))[:chunk_size]
+            if not chunk_ids:
+                break
+            with atomic(*shard_aliases()):
+                for alias, shard_ids in zip(shard_aliases(), pending):
+                    usage_ids = [usage_id for usage_id in shard_ids if usage_id <= chunk_ids[-1]]
+                    if not usage_ids:
+                        continue
+                    with use_shard(alias):
+                        chunk = Usage.objects.filter(pk__in=usage_ids)
+                        removed = queryset_deltas(chunk, sign=-1)
+                        by_user = {}
+                        for user_id, usage_id, usage_at, amount, emissions in chunk.values_list(
+                                'user_id', 'pk', 'usage_at', 'amount', 'emissions'):
+                            usage = Usage(id=usage_id, usage_type_id_id=version.usage_type_id_id, usage_at=usage_at,
+                                          amount=amount, emissions=amount * version.factor)
+                            by_user.setdefault(user_id, []).append(
+                                usage_payload(usage, {'amount': amount, 'emissions': emissions}))
+                        job.processed += chunk.update(factor=version.factor,
+                                                      emissions=F('amount') * version.factor,
+                                                      change_seq=allocate_change_seq())
+                        apply_usage_deltas(merge_deltas(removed, queryset_deltas(chunk)))
+                        for user_id, payloads in by_user.items():
+                            notify_usage_event(user_id, 'updated', {period_of(usage['usage_at']) for usage in payloads},
+                                               count=len(payloads), usages=payloads)
+                        record_events([outbox_event(user_id, 'usage', 'updated',
+                                                    usage_ids=[usage['id'] for usage in payloads],
+                                                    changes={'factor': version.factor})
+                                       for user_id, payloads in by_user.items()])
+                job.last_usage_id = chunk_ids[-1]
+                job.save(update_fields=['processed', 'last_usage_id', 'updated_at'])
+            if progress:
+                progress(job)
+    except Exception as error:
+        job.status = FactorRecomputeJob.FAILED
+        job.error = str(error)
+        job.save(update_fields=['status', 'error', 'updated_at'])
+        raise
+
+    job.status = FactorRecomputeJob.DONE
+    job.save(update_fields=['status', 'updated_at'])
+    return job
+
+
+@on_user_shard
+def update_usages(user_id, changes, chunk_size=USAGE_BATCH_SIZE, **kwargs):
+    """Update the live Usages of a User matching the filters of `get_usages`.
+        Every chunk is written with set-based UPDATE statements: a new
+        UsageType gets its factor resolved with one UPDATE per factor version,
+        a new amount keeps the factor snapshot of each Usage. Archived Usages
+        are read-only, so a range reaching them is rejected (see `check_live_range`).
+        Args:
+            user_id (string): [Required].
+            changes (dict): [Required]. New `usage_type_id` (UsageTypes) and/or `amount`.
+            chunk_size (int): [Optional]. Usages updated per transaction.
+            **kwargs (dict): [Optional]. Same filters as `get_usages`.
+        Returns (int):
+            Number of records updated.
+    """
+    usage_type = changes.get('usage_type_id')
+    versions = list(usage_type.factors.order_by('valid_from')) if usage_type else []
+    outbox_changes = {'usage_type_id': usage_type.pk} if usage_type else {}
+    if 'amount' in changes:
+        outbox_changes['amount'] = float(changes['amount'])
+    check_live_range(user_id, **kwargs)
+    matching = filter_usages(user_id, **kwargs)
+    updated = 0
+    last_id = 0
+    while True:
+        usage_ids = list(matching.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not usage_ids:
+            return updated
+        with atomic():
+            chunk = Usage.objects.filter(pk__in=usage_ids)
+            removed = queryset_deltas(chunk, sign=-1)
+            fields = {'change_seq': allocate_change_seq()}
+            if 'amount' in changes:
+                fields['amount'] = float(changes['amount'])
+            if usage_type:
+                fields['usage_type_id'] = usage_type
+            count = chunk.update(**fields)
+
+            if usage_type:
+                uncovered = chunk
+                for version in versions:
+                    covered = Q(usage_at__gte=version.valid_from)
+                    if version.valid_to is not None:
+                        covered &= Q(usage_at__lt=version.valid_to)
+                    chunk.filter(covered).update(factor=version.factor, emissions=F('amount') * version.factor)
+                    uncovered = uncovered.exclude(covered)
+                uncovered.update(factor=usage_type.factor, emissions=F('amount') * usage_type.factor)
+            else:
+                chunk.update(emissions=F('amount') * F('factor'))
+            changed = merge_deltas(removed, queryset_deltas(chunk))
+            apply_usage_deltas(changed)
+            notify_usage_event(user_id, 'updated', [period for _, _, period in changed], count=count)
+            record_event(user_id, 'usage', 'updated', usage_ids=usage_ids, changes=outbox_changes)
+        updated += count
+        last_id = usage_ids[-1]
+
+
+@on_user_shard
+def set_emissions_budget(user_id, usage_type_id, limit):
+    """Create or change the monthly emissions budget of a User for a UsageType.
+    Thresholds the current month already reached under the new limit are recorded at once.
+        Args:
+            user_id (string): [Required].
+            usage_type_id (int): [Required].
+            limit (float): [Required]. Emissions allowed per calendar month.
+        Returns (EmissionsBudget):
+            Returns the saved budget.
+    """
+    with atomic():
+        budget, _ = EmissionsBudget.objects.update_or_create(user_id_id=user_id, usage_type_id_id=usage_type_id,
+                                                             defaults={'limit': float(limit)})
+        check_budget(budget, period_of(datetime.now(tz=pytz.utc)))
+    return budget
+
+
 def update_user(request, data, user_id):
     """Update User in the database using User ID.
         Args:
@@ -189,7 +1128,9 @@ def update_user(request, data, user_id):
     if request.user.id.hex != user_id:
         raise PermissionDenied
 
-    user = User.objects.get(pk=user_id)
-    user.name = data.get('name')
-    user.save()
+    with atomic(shard_for(user_id)):
+        user = User.objects.get(pk=user_id)
+        user.name = data.get('name')
+        user.save()
+        record_event(user_id, 'user', 'updated', name=user.name)
     return user.name
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+"""Ingestion of Usage files delivered to a spool directory.
+Partners drop CSV (`.csv`, with a header line) or NDJSON (`.ndjson`,
+`.jsonl`) files in `incoming/`, renaming them in once complete. Each record
+has the `user` and `usage_type` names, `usage_at`, `amount` and optionally
+an `idempotency_key`. A file is claimed by moving it to `processing/`, read
+one line at a time and sent in batches of INGEST_BATCH_SIZE records to a pool
+of worker processes, which resolve the names through per-process caches and
+insert the Usages with `bulk_create_usages`. At most two batches per worker
+are in flight, so memory stays bounded whatever the size of the file.
+
+Every record gets an idempotency key made of the file and its line number,
+so loading a batch twice stores its Usages once. After each batch the byte
+offset reached is saved to a checkpoint next to the file; an interrupted
+file resumes from it. Records that cannot be loaded are written with their
+line number and the reason to a rejected-rows report, `<name>.rejected.csv`,
+moved to `done/` with the file. Run one ingestion service per spool directory.
+"""
+import csv
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import time
+
+from collections import deque
+from contextlib import nullcontext
+
+import django
+
+from django.conf import settings
+from django.core.exceptions import MultipleObjectsReturned
+from django.db import DatabaseError, OperationalError, connections
+from rest_framework.exceptions import ValidationError
+
+from app.controller import bulk_create_usages, get_usage_type_by_name, get_user_id_by_name
+from app.models import Usage, UsageTypes, User
+from app.serializers import UsageSerializer
+from app.sharding import group_by_shard, use_shard
+
+INGEST_FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+REPORT_FIELDS = ('line', 'reason', 'record')
+INGEST_ATTEMPTS = 8
+INGEST_RETRY_SECONDS = 0.05
+
+
+def spool_path(*parts):
+    return os.path.join(settings.INGEST_SPOOL_DIR, *parts)
+
+
+def file_format(name):
+    """Return `csv` or `ndjson` for the name of a spool file, None for files to leave alone.
+        >>> file_format('readings.jsonl'), file_format('.readings.csv.part')
+        ('ndjson', None)
+    """
+    if name.startswith('.'):
+        return None
+    return INGEST_FORMATS.get(os.path.splitext(name)[1].lower())
+
+
+def claim_files():
+    """Return the paths of the files to load, claiming the new ones.
+    Files left in `processing/` by an interrupted run come first, then the
+    files of `incoming/`, oldest first, moved to `processing/`.
+    """
+    for directory in ('incoming', 'processing', 'done'):
+        os.makedirs(spool_path(directory), exist_ok=True)
+    claimed = sorted(spool_path('processing', name) for name in os.listdir(spool_path('processing'))
+                     if file_format(name))
+    incoming = [entry for entry in os.scandir(spool_path('incoming')) if entry.is_file() and file_format(entry.name)]
+    for entry in sorted(incoming, key=lambda entry: entry.stat().st_mtime):
+        target = spool_path('processing', entry.name)
+        try:
+            os.rename(entry.path, target)
+        except FileNotFoundError:
+            continue
+        claimed.append(target)
+    return claimed
+
+
+def read_checkpoint(path):
+    try:
+        with open(path + '.checkpoint') as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, state):
+    with open(path + '.checkpoint.tmp', 'w') as stream:
+        json.dump(state, stream)
+    os.replace(path + '.checkpoint.tmp', path + '.checkpoint')
+
+
+def file_key(path):
+    """Return a short key identifying the content of a spool file for the idempotency keys of its records."""
+    stat = os.stat(path)
+    return hashlib.sha1('{}:{}:{}'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode()) \
+        .hexdigest()[:16]
+
+
+def read_batches(stream, fmt, header, line, batch_size):
+    """Yield the records of an open binary file in batches.
+        Args:
+            stream (file): [Required]. Positioned after the last loaded line.
+            fmt (string): [Required]. `csv` or `ndjson`.
+            header (list): [Optional]. Column names of a CSV file.
+            line (int): [Required]. Number of the last line read.
+            batch_size (int): [Required]. Records per batch.
+        Returns (generator):
+            Yields dicts with the parsed `records` as `(line, dict)`, the `rejected` lines
+            as `(line, reason, text)`, and the `offset` and `line` reached.
+    """
+    batch = {'records': [], 'rejected': []}
+    offset = stream.tell()
+    for raw in stream:
+        line += 1
+        offset += len(raw)
+        try:
+            text = raw.decode('utf-8').rstrip('\r\n')
+        except UnicodeDecodeError:
+            batch['rejected'].append((line, 'Not UTF-8 text.', raw.decode('utf-8', 'replace').rstrip('\r\n')))
+            text = ''
+        if text.strip():
+            try:
+                batch['records'].append((line, parse_record(text, fmt, header)))
+            except ValueError as error:
+                batch['rejected'].append((line, str(error), text))
+        if len(batch['records']) + len(batch['rejected']) >= batch_size:
+            yield dict(batch, offset=offset, line=line)
+            batch = {'records': [], 'rejected': []}
+    if batch['records'] or batch['rejected']:
+        yield dict(batch, offset=offset, line=line)
+
+
+def parse_record(text, fmt, header):
+    """Parse one line of a spool file into a dict.
+        >>> parse_record('penny,Water,2022-03-01T10:00:00Z,5', 'csv', ['user', 'usage_type', 'usage_at', 'amount'])
+        {'user': 'penny', 'usage_type': 'Water', 'usage_at': '2022-03-01T10:00:00Z', 'amount': '5'}
+    """
+    if fmt == 'ndjson':
+        try:
+            record = json.loads(text)
+        except json.JSONDecodeError:
+            raise ValueError('Not a JSON object.')
+        if not isinstance(record, dict):
+            raise ValueError('Not a JSON object.')
+        return record
+    values = next(csv.reader([text]))
+    if len(values) != len(header):
+        raise ValueError('Expected {} columns, got {}.'.format(len(header), len(values)))
+    return dict(zip(header, values))
+
+
+@functools.lru_cache(maxsize=None)
+def _fields():
+    return UsageSerializer().fields
+
+
+@functools.lru_cache(maxsize=settings.INGEST_NAME_CACHE_SIZE)
+def cached_user_id(name):
+    try:
+        return get_user_id_by_name(name)
+    except User.DoesNotExist:
+        return None
+
+
+@functools.lru_cache(maxsize=settings.INGEST_NAME_CACHE_SIZE)
+def cached_usage_type(name):
+    try:
+        return get_usage_type_by_name(name)
+    except (UsageTypes.DoesNotExist, MultipleObjectsReturned):
+        return None
+
+
+_cached_file = None
+
+
+def init_worker():
+    """Set up Django in a worker process, which opens connections of its own."""
+    django.setup()
+
+
+def load_records(key, records):
+    """Insert a batch of parsed records. Runs in a worker process.
+    The name caches are cleared for every new file, so users and usage types
+    created since the previous file are found.
+        Args:
+            key (string): [Required]. `file_key` of the file of the records.
+            records (list): [Required]. `(line, dict)` pairs.
+        Returns (tuple):
+            Returns the number of Usages inserted, the number of records already
+            stored by an earlier run, and the rejected records as `(line, reason)`.
+    """
+    global _cached_file
+    if _cached_file != key:
+        cached_user_id.cache_clear()
+        cached_usage_type.cache_clear()
+        _cached_file = key
+    rows, rejected = [], []
+    for line, record in records:
+        try:
+            rows.append((line, usage_row(record, '{}:{}'.format(key, line))))
+        except ValueError as error:
+            rejected.append((line, str(error)))
+    pending = new_rows(rows)
+    try:
+        insert_rows([row for _, row in pending])
+        inserted = len(pending)
+    except OperationalError:
+        raise
+    except DatabaseError:
+        # A row the database refuses, e.g. of a usage type deleted since it was
+        # resolved, fails the whole batch: insert the rows one by one to reject only it.
+        inserted = 0
+        for line, row in pending:
+            try:
+                insert_rows([row])
+                inserted += 1
+            except OperationalError:
+                raise
+            except DatabaseError as error:
+                rejected.append((line, '{}: {}'.format(type(error).__name__, error)))
+    return inserted, len(rows) - len(pending), rejected
+
+
+def new_rows(rows):
+    """Return the `(line, row)` pairs whose idempotency key is neither stored nor repeated in the batch."""
+    stored = set()
+    for alias, shard_rows in group_by_shard(rows, lambda item: item[1]['user_id_id']).items():
+        with use_shard(alias):
+            stored.update(Usage.objects.filter(
+                user_id__in={row['user_id_id'] for _, row in shard_rows},
+                idempotency_key__in={row['idempotency_key'] for _, row in shard_rows},
+            ).values_list('user_id', 'idempotency_key'))
+    pending = []
+    for line, row in rows:
+        key = (row['user_id_id'], row['idempotency_key'])
+        if key not in stored:
+            stored.add(key)
+            pending.append((line, row))
+    return pending
+
+
+def insert_rows(rows):
+    """Insert rows with `bulk_create_usages`, trying again when concurrent workers collide."""
+    for attempt in range(INGEST_ATTEMPTS):
+        try:
+            if rows:
+                bulk_create_usages(rows, batch_size=len(rows))
+            return
+        except OperationalError:
+            # Concurrent workers can fail to get the write lock (SQLite) or serialize
+            # (PostgreSQL); the batch was rolled back and is tried again.
+            if attempt == INGEST_ATTEMPTS - 1:
+                raise
+            time.sleep(INGEST_RETRY_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def usage_row(record, idempotency_key):
+    """Validate a record and return the row of its Usage for `bulk_create_usages`.
+    The values are checked with the fields of UsageSerializer, as for the API.
+        Raises:
+            ValueError: With the reason the record is rejected.
+    """
+    missing = [name for name in ('user', 'usage_type', 'usage_at', 'amount') if record.get(name) in (None, '')]
+    if missing:
+        raise ValueError('Missing {}.'.format(', '.join(missing)))
+    user_id = cached_user_id(str(record['user']))
+    if user_id is None:
+        raise ValueError('Unknown user {!r}.'.format(record['user']))
+    usage_type = cached_usage_type(str(record['usage_type']))
+    if usage_type is None:
+        raise ValueError('Unknown or ambiguous usage type {!r}.'.format(record['usage_type']))
+    values = {name: validate_field(name, record[name]) for name in ('usage_at', 'amount')}
+    values['idempotency_key'] = validate_field('idempotency_key', record.get('idempotency_key') or None)
+    # Only the id of the User is needed, so the row sets the column directly.
+    return {'user_id_id': user_id, 'usage_type_id': usage_type, 'usage_at': values['usage_at'],
+            'amount': values['amount'], 'idempotency_key': values['idempotency_key'] or idempotency_key}
+
+
+def validate_field(name, value):
+    try:
+        return _fields()[name].run_validation(value)
+    except ValidationError as error:
+        raise ValueError('{}: {}'.format(name, ' '.join(str(detail) for detail in error.detail)))
+
+
+def ingest_file(path, workers=0, batch_size=None, progress=None):
+    """Load a claimed spool file, resuming from its checkpoint, and move it to `done/`.
+        Args:
+            path (string): [Required]. Path of the file in `processing/`.
+            workers (int): [Optional]. Worker processes loading the batches; with 0
+                they are loaded in the current process.
+            batch_size (int): [Optional]. Records per batch, INGEST_BATCH_SIZE by default.
+            progress (callable): [Optional]. Called with the checkpoint state after every batch.
+        Returns (dict):
+            Returns the final checkpoint state, with the numbers of lines read and
+            of Usages `loaded`, records `stored` by an earlier run and records `rejected`.
+    """
+    batch_size = batch_size or settings.INGEST_BATCH_SIZE
+    fmt = file_format(os.path.basename(path))
+    report_path = path + '.rejected'
+    key = file_key(path)
+    state = read_checkpoint(path)
+    if state is None or state['key'] != key:
+        state = {'key': key, 'offset': 0, 'line': 0, 'header': None, 'loaded': 0, 'rejected': 0, 'report_size': 0}
+    state.setdefault('stored', 0)
+
+    max_in_flight = 2 * workers or 1
+    with worker_pool(workers) as pool, open(path, 'rb') as stream, open(report_path, 'a+', newline='') as report:
+        # Rows reported after the checkpoint are reported again.
+        report.truncate(state['report_size'])
+        report.seek(state['report_size'])
+        writer = csv.writer(report)
+        if not state['report_size']:
+            writer.writerow(REPORT_FIELDS)
+        if fmt == 'csv' and state['header'] is None:
+            first = stream.readline()
+            header = next(csv.reader([first.decode('utf-8-sig', 'replace').rstrip('\r\n')]), [])
+            state['header'] = [name.strip() for name in header]
+            state['offset'], state['line'] = len(first), 1
+        stream.seek(state['offset'])
+
+        in_flight = deque()
+        for batch in read_batches(stream, fmt, state['header'], state['line'], batch_size):
+            if pool:
+                result = pool.apply_async(load_records, (state['key'], batch['records']))
+            else:
+                result = _Done(load_records(state['key'], batch['records']))
+            in_flight.append((batch, result))
+            while len(in_flight) >= max_in_flight:
+                _commit_batch(path, state, writer, report, *in_flight.popleft(), progress)
+        while in_flight:
+            _commit_batch(path, state, writer, report, *in_flight.popleft(), progress)
+
+    done = spool_path('done', os.path.basename(path))
+    if state['rejected']:
+        os.replace(report_path, done + '.rejected.csv')
+    else:
+        os.remove(report_path)
+    # Without its checkpoint a file left in `processing/` is loaded again, which stores nothing twice.
+    if os.path.exists(path + '.checkpoint'):
+        os.remove(path + '.checkpoint')
+    os.replace(path, done)
+    return state
+
+
+def _commit_batch(path, state, writer, report, batch, result, progress):
+    """Wait for a batch and checkpoint it. Batches are committed in file order."""
+    loaded, stored, rejected = result.get()
+    records = dict(batch['records'])
+    rows = batch['rejected'] + [(line, reason, json.dumps(records[line])) for line, reason in rejected]
+    writer.writerows(sorted(rows))
+    report.flush()
+    state.update(offset=batch['offset'], line=batch['line'], loaded=state['loaded'] + loaded,
+                 stored=state['stored'] + stored, rejected=state['rejected'] + len(rows), report_size=report.tell())
+    write_checkpoint(path, state)
+    if progress:
+        progress(state)
+
+
+class _Done:
+    """Result of a batch loaded in the current process, with the interface of AsyncResult."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def worker_pool(workers):
+    """Return a pool of `workers` processes loading batches, a null context for 0."""
+    if not workers:
+        return nullcontext()
+    # Connections are not shared with forked workers.
+    connections.close_all()
+    return multiprocessing.Pool(workers, initializer=init_worker)
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+"""Live feed of Usage writes, pushed to dashboards with Server-Sent Events.
+Writes register an event that is published once their transaction commits.
+Events go through a broker to the `Hub` of every serving process, and the
+hub fans them out to the per-connection queues of the subscribed users:
+    1. LocalBroker - delivers to the hub of the publishing process only.
+    2. SocketBroker - stand-in for a pub/sub server on one host: every
+       serving process binds a Unix datagram socket in a shared directory
+       and publishers send each event to all of them.
+The broker class is chosen with the USAGE_FEED_BROKER setting. Subscribers
+are plain coroutines waiting on a bounded queue, so one event loop holds
+thousands of idle connections.
+"""
+import asyncio
+import json
+import os
+import re
+import socket
+import threading
+import uuid
+
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from app.models import UsagePeriodTotal
+from app.sharding import user_queryset
+
+FEED_QUEUE_SIZE = 100
+FEED_KEEPALIVE_SECONDS = 15
+FEED_PATH = re.compile(r'^/app/user/(?P<user_id>[^/]+)/usage/stream$')
+
+
+class Hub:
+    """In-process fan-out of feed messages to subscriber queues.
+    `publish` may be called from any thread; messages are handed to each
+    subscriber's event loop. A subscriber that falls `max_queue` messages
+    behind loses its oldest messages.
+    """
+
+    def __init__(self, max_queue=FEED_QUEUE_SIZE):
+        self.max_queue = max_queue
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """Return a new queue receiving the messages of a User. Must run inside an event loop."""
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(user_id, {})[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            queues = self._subscribers.get(user_id, {})
+            queues.pop(queue, None)
+            if not queues:
+                self._subscribers.pop(user_id, None)
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    def publish(self, user_id, message):
+        with self._lock:
+            queues = list(self._subscribers.get(user_id, {}).items())
+        for queue, loop in queues:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, message)
+            except RuntimeError:
+                self.unsubscribe(user_id, queue)
+
+
+def _offer(queue, message):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+
+class LocalBroker:
+    """Delivers messages to the hub of the publishing process."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def start(self):
+        """Start receiving messages from other processes, once per serving event loop."""
+
+    def wants(self, user_id):
+        """Return False when nobody can be listening, so the event is not even built."""
+        return self.hub.has_subscribers(user_id)
+
+    def publish(self, user_id, message):
+        self.hub.publish(user_id, message)
+
+
+class SocketBroker(LocalBroker):
+    """Delivers messages to every process serving the feed on this host,
+    through one Unix datagram socket per process in `path`."""
+
+    def __init__(self, hub, path):
+        super().__init__(hub)
+        self.path = str(path)
+        self._socket = None
+
+    def start(self):
+        if self._socket is not None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(os.path.join(self.path, '{}-{}.sock'.format(os.getpid(), uuid.uuid4().hex[:8])))
+        self._socket.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._socket.fileno(), self._receive)
+
+    def wants(self, user_id):
+        return os.path.isdir(self.path) and any(name.endswith('.sock') for name in os.listdir(self.path))
+
+    def publish(self, user_id, message):
+        data = json.dumps({'user_id': user_id, 'message': message}).encode('utf-8')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+            for name in os.listdir(self.path):
+                if not name.endswith('.sock'):
+                    continue
+                try:
+                    sender.sendto(data, os.path.join(self.path, name))
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # The process that bound the socket is gone.
+                    _remove(os.path.join(self.path, name))
+                except BlockingIOError:
+                    continue
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except BlockingIOError:
+                return
+            payload = json.loads(data)
+            self.hub.publish(payload['user_id'], payload['message'])
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+hub = Hub()
+_broker = None
+
+
+def get_broker():
+    """Return the broker configured by USAGE_FEED_BROKER and USAGE_FEED_BROKER_OPTIONS."""
+    global _broker
+    if _broker is None:
+        _broker = import_string(settings.USAGE_FEED_BROKER)(hub, **settings.USAGE_FEED_BROKER_OPTIONS)
+    return _broker
+
+
+def notify_usage_event(user_id, event, periods=(), **payload):
+    """Publish a feed event for a User once the current transaction commits.
+    The event carries the running totals of the months in `periods`.
+        Args:
+            user_id (string): [Required].
+            event (string): [Required]. `created`, `updated`, `deleted` or `reset`.
+            periods (iterable): [Optional]. Months (first day) whose totals changed.
+            **payload (dict): [Optional]. Extra fields of the event.
+        Returns (None):
+            None.
+    """
+    user_id = uuid.UUID(str(user_id)).hex
+    periods = set(periods)
+    transaction.on_commit(lambda: publish_usage_event(user_id, event, periods, payload))
+
+
+def publish_usage_event(user_id, event, periods, payload):
+    broker = get_broker()
+    if not broker.wants(user_id):
+        return
+    totals = user_queryset(UsagePeriodTotal, user_id).filter(user_id=user_id, period__in=periods) \
+        .order_by('period', 'usage_type_id').values('usage_type_id', 'period', 'amount', 'emissions', 'count')
+    message = dict(payload, event=event, totals=[dict(total, period=total['period'].strftime('%Y-%m'))
+                                                 for total in totals])
+    broker.publish(user_id, json.dumps(message, cls=DjangoJSONEncoder))
+
+
+def usage_payload(usage, previous=None):
+    """Return the event payload of a Usage, with the `previous` amount and emissions of an updated one."""
+    payload = {'id': usage.id, 'usage_type_id': usage.usage_type_id_id, 'usage_at': usage.usage_at,
+               'amount': float(usage.amount), 'emissions': usage.emissions}
+    if previous is not None:
+        payload['previous'] = {'amount': previous['amount'], 'emissions': previous['emissions']}
+    return payload
+
+
+class LiveFeedApplication:
+    """ASGI application serving `app/user/<id>/usage/stream` as Server-Sent
+    Events and passing every other connection to `application`.
+    The JWT access token is read from the `Authorization` header or, as
+    browsers' EventSource cannot set headers, from the `token` query parameter.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        match = FEED_PATH.match(scope.get('path', '')) if scope['type'] == 'http' else None
+        if match is None:
+            return await self.application(scope, receive, send)
+        user_id = await sync_to_async(_authorize)(scope, match.group('user_id'))
+        if user_id is None:
+            return await _reject(send, 401, 'Authentication credentials were not provided or are not valid.')
+        if user_id is False:
+            return await _reject(send, 403, 'You do not have permission to perform this action.')
+        await self.stream(user_id, receive, send)
+
+    async def stream(self, user_id, receive, send):
+        broker = get_broker()
+        broker.start()
+        queue = hub.subscribe(user_id)
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+            await send({'type': 'http.response.body', 'body': b': connected\n\n', 'more_body': True})
+            while True:
+                message = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({message, disconnected}, timeout=FEED_KEEPALIVE_SECONDS,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    message.cancel()
+                    return
+                if message in done:
+                    body = 'data: {}\n\n'.format(message.result())
+                else:
+                    message.cancel()
+                    body = ': keepalive\n\n'
+                await send({'type': 'http.response.body', 'body': body.encode('utf-8'), 'more_body': True})
+        finally:
+            disconnected.cancel()
+            hub.unsubscribe(user_id, queue)
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _reject(send, status, detail):
+    body = json.dumps({'detail': detail}).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _authorize(scope, user_id):
+    """Return the hex id of the feed's User, None if unauthenticated, False if forbidden."""
+    headers = dict(scope.get('headers', []))
+    raw_token = headers.get(b'authorization', b'').decode('latin1').partition('Bearer ')[2] \
+        or parse_qs(scope.get('query_string', b'').decode('latin1')).get('token', [''])[0]
+    if not raw_token:
+        return None
+    authentication = JWTAuthentication()
+    try:
+        user = authentication.get_user(authentication.get_validated_token(raw_token))
+    except (AuthenticationFailed, InvalidToken):
+        return None
+    if not (user.is_superuser or user.id.hex == user_id):
+        return False
+    try:
+        return uuid.UUID(user_id).hex
+    except ValueError:
+        return False
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.archive import ARCHIVE_DELETE_CHUNK_SIZE, archive_cutoff, archive_usages
+
+
+class Command(BaseCommand):
+    help = 'Move Usages older than the retention period to compressed columnar segment files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.USAGE_RETENTION_DAYS,
+                            help='Retention period in days, whole months before it are archived.')
+        parser.add_argument('--chunk-size', type=int, default=ARCHIVE_DELETE_CHUNK_SIZE,
+                            help='Usages deleted from the table per transaction.')
+
+    def handle(self, *args, **options):
+        cutoff = archive_cutoff(options['older_than_days'])
+        self.stdout.write('Archiving usages before {:%Y-%m-%d}'.format(cutoff))
+        count = archive_usages(cutoff, chunk_size=options['chunk_size'], progress=self.report)
+        self.stdout.write(self.style.SUCCESS('Archived {} usages'.format(count)))
+
+    def report(self, segment):
+        self.stdout.write('User {} {:%Y-%m}: {} usages -> {}'.format(
+            segment.user_id_id.hex, segment.period, segment.row_count, segment.path))
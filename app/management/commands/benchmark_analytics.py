@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import time
+import uuid
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.analytics import ANALYTICS_WINDOW, load_usage_columns, usage_analytics
+from app.models import Usage, UsageTypes, User
+from app.sharding import atomic, shard_for, use_shard
+
+
+class Command(BaseCommand):
+    help = 'Time the usage analytics on generated readings, optionally loaded from the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Readings to generate.')
+        parser.add_argument('--types', type=int, default=5, help='Usage types the readings are spread over.')
+        parser.add_argument('--days', type=int, default=3 * 365, help='Days of history the readings cover.')
+        parser.add_argument('--window', type=int, default=ANALYTICS_WINDOW, help='Days of the rolling averages.')
+        parser.add_argument('--database', action='store_true',
+                            help='Insert the readings for a throwaway User and time loading them back as well. '
+                                 'Everything is rolled back afterwards.')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        rows = options['rows']
+        columns = {
+            'usage_at': np.datetime64('2020-01-01T00:00:00', 'us')
+            + rng.integers(0, options['days'] * 86400, rows) * np.timedelta64(1, 's'),
+            'amount': rng.gamma(2.0, 5.0, rows),
+            'factor': rng.choice([0.5, 1.0, 2.0], rows),
+            'usage_type_id': rng.integers(1, options['types'] + 1, rows),
+        }
+        if options['database']:
+            columns = self.load(columns)
+        self.time('usage_analytics', lambda: usage_analytics(columns, window=options['window']))
+
+    def load(self, columns):
+        user_id = uuid.uuid4()
+        with use_shard(shard_for(user_id)), atomic():
+            user = User.objects.create(id=user_id, name='benchmark-{}'.format(user_id.hex), password='!')
+            types = {type_id: UsageTypes.objects.create(name='benchmark-{}-{}'.format(user_id.hex, type_id),
+                                                        unit='kwh', factor=1.0).id
+                     for type_id in np.unique(columns['usage_type_id']).tolist()}
+            usage_at = columns['usage_at'].astype('datetime64[us]').astype(str)
+            start = time.perf_counter()
+            with connections[Usage.objects.db].cursor() as cursor:
+                cursor.executemany(
+                    'INSERT INTO {} (user_id_id, usage_type_id_id, usage_at, amount, factor, emissions, change_seq, '
+                    'resolution, sample_count) VALUES (%s, %s, %s, %s, %s, %s, 0, 0, 1)'.format(Usage._meta.db_table),
+                    ((user.id.hex, types[type_id], moment.replace('T', ' '), amount, factor, amount * factor)
+                     for type_id, moment, amount, factor in zip(columns['usage_type_id'].tolist(), usage_at.tolist(),
+                                                                 columns['amount'].tolist(),
+                                                                 columns['factor'].tolist())))
+            self.stdout.write('insert {} rows: {:.2f}s'.format(len(usage_at), time.perf_counter() - start))
+            loaded = self.time('load_usage_columns', lambda: load_usage_columns([user.id]))
+            connections[Usage.objects.db].set_rollback(True)
+            connections['default'].set_rollback(True)
+        return loaded
+
+    def time(self, label, func):
+        start = time.perf_counter()
+        result = func()
+        self.stdout.write(self.style.SUCCESS('{}: {:.3f}s'.format(label, time.perf_counter() - start)))
+        return result
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app.compaction import COMPACTION_CHUNK_SIZE, RESOLUTIONS, compact_usages, compaction_cutoff
+
+
+class Command(BaseCommand):
+    help = 'Replace old raw Usages with hourly or daily aggregates, following USAGE_COMPACTION_POLICY by default.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolution', choices=sorted(RESOLUTIONS),
+                            help='Resolution of the aggregates, requires --older-than-days.')
+        parser.add_argument('--older-than-days', type=int,
+                            help='Age in days after which Usages are compacted.')
+        parser.add_argument('--chunk-size', type=int, default=COMPACTION_CHUNK_SIZE,
+                            help='Usages rewritten per transaction.')
+
+    def handle(self, *args, **options):
+        if (options['resolution'] is None) != (options['older_than_days'] is None):
+            raise CommandError('--resolution and --older-than-days must be given together.')
+        policy = [(options['resolution'], options['older_than_days'])] if options['resolution'] \
+            else settings.USAGE_COMPACTION_POLICY
+
+        for label, older_than_days in sorted(policy, key=lambda tier: RESOLUTIONS[tier[0]]):
+            resolution = RESOLUTIONS[label]
+            cutoff = compaction_cutoff(resolution, older_than_days)
+            self.stdout.write('Compacting usages before {:%Y-%m-%d %H:%M} to {} resolution'.format(cutoff, label))
+            count = compact_usages(resolution, cutoff, chunk_size=options['chunk_size'], progress=self.report)
+            self.stdout.write(self.style.SUCCESS('Replaced {} usages with {} aggregates'.format(count, label)))
+
+    def report(self, user_id, usage_type_id, count):
+        self.stdout.write('User {} usage type {}: {} usages'.format(user_id.hex, usage_type_id, count))
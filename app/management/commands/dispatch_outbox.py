@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.outbox import dispatch_outbox, get_sink, outbox_status
+
+
+class Command(BaseCommand):
+    help = 'Deliver the change events of the outbox to the sink configured by OUTBOX_SINK.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE,
+                            help='Events delivered per batch and shard.')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep polling for new events instead of exiting when none is due.')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds between polls in --watch mode.')
+
+    def handle(self, *args, **options):
+        sink = get_sink()
+        while True:
+            result = dispatch_outbox(sink, batch_size=options['batch_size'])
+            if result['delivered']:
+                self.stdout.write('Delivered {} events, lag mean {:.3f}s max {:.3f}s'.format(
+                    result['delivered'], result['lag_mean'], result['lag_max']))
+            if result['failed']:
+                self.stderr.write('Failed to deliver {} events, retrying later'.format(result['failed']))
+            if result['delivered']:
+                continue
+
+            if not options['watch']:
+                status = outbox_status()
+                self.stdout.write(self.style.SUCCESS('{} events pending, {} retrying, oldest {:.1f}s'.format(
+                    status['pending'], status['retrying'], status['lag'])))
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.ingest import claim_files, ingest_file
+
+
+class Command(BaseCommand):
+    help = 'Load the CSV and NDJSON usage files dropped in the incoming directory of INGEST_SPOOL_DIR.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.INGEST_WORKERS,
+                            help='Worker processes inserting the batches; 0 loads them in this process.')
+        parser.add_argument('--batch-size', type=int, default=settings.INGEST_BATCH_SIZE,
+                            help='Records per batch.')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep polling for new files instead of exiting when the spool is empty.')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds between polls in --watch mode.')
+
+    def handle(self, *args, **options):
+        while True:
+            for path in claim_files():
+                name = os.path.basename(path)
+                # Files left by an interrupted run resume after their last checkpoint.
+                self.stdout.write('{}: loading'.format(name))
+                try:
+                    state = ingest_file(path, workers=options['workers'], batch_size=options['batch_size'],
+                                        progress=lambda state: self.report(name, state))
+                except Exception as error:
+                    # The file stays in processing/ and resumes from its checkpoint on the next poll.
+                    self.stderr.write('{}: failed - {}'.format(name, error))
+                    continue
+                summary = '{}: {} usages loaded, {} already stored, {} rows rejected'.format(
+                    name, state['loaded'], state['stored'], state['rejected'])
+                self.stdout.write(self.style.SUCCESS(summary))
+
+            if not options['watch']:
+                return
+            time.sleep(options['interval'])
+
+    def report(self, name, state):
+        self.stdout.write('{}: {} lines read'.format(name, state['line']))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app.sharding import (
+    SHARD_MOVE_CHUNK_SIZE,
+    is_sharded,
+    misplaced_users,
+    move_user,
+    shard_aliases,
+    shard_for,
+    sync_reference_tables
+)
+
+
+class Command(BaseCommand):
+    help = 'Copy Users and UsageTypes to every shard and move the data of each User to the shard owning it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drain', action='append', default=[], metavar='ALIAS',
+                            help='Database alias of a retired shard to empty as well, may be repeated.')
+        parser.add_argument('--chunk-size', type=int, default=SHARD_MOVE_CHUNK_SIZE,
+                            help='Rows copied per INSERT statement.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only list the Users that would move.')
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError('Only one shard configured, set PLANETLY_SQLITE_SHARDS.')
+        for alias in options['drain']:
+            if alias not in settings.DATABASES or alias in shard_aliases():
+                raise CommandError('{} is not a retired shard database.'.format(alias))
+
+        if not options['dry_run']:
+            copied = sync_reference_tables(chunk_size=options['chunk_size'])
+            self.stdout.write('Copied {} Users and UsageTypes to the shards'.format(copied))
+
+        moved = 0
+        for source in list(shard_aliases()) + options['drain']:
+            for user_id in misplaced_users(source):
+                target = shard_for(user_id)
+                moved += 1
+                if options['dry_run']:
+                    self.stdout.write('User {}: {} -> {}'.format(user_id.hex, source, target))
+                    continue
+                rows = move_user(user_id, source, target, chunk_size=options['chunk_size'])
+                self.stdout.write('User {}: {} -> {}, {} rows'.format(user_id.hex, source, target, rows))
+        self.stdout.write(self.style.SUCCESS('{} {} users'.format('Would move' if options['dry_run'] else 'Moved', moved)))
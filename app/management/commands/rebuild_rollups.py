@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from app.rollups import rebuild_usage_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the usage period totals and quantile sketches from the Usage table and the archive.'
+
+    def handle(self, *args, **options):
+        count = rebuild_usage_rollups()
+        self.stdout.write(self.style.SUCCESS('Rebuilt {} usage period totals'.format(count)))
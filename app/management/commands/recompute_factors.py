@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.controller import FACTOR_RECOMPUTE_CHUNK_SIZE, run_factor_recompute_job
+from app.models import FactorRecomputeJob
+
+
+class Command(BaseCommand):
+    help = 'Recompute the emissions of the Usages affected by new UsageType factor versions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=FACTOR_RECOMPUTE_CHUNK_SIZE,
+                            help='Usages updated per transaction.')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep polling for new jobs instead of exiting when the queue is empty.')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds between polls in --watch mode.')
+
+    def handle(self, *args, **options):
+        while True:
+            # Jobs left running by an interrupted worker resume after their last chunk.
+            jobs = FactorRecomputeJob.objects.filter(
+                status__in=[FactorRecomputeJob.PENDING, FactorRecomputeJob.RUNNING]
+            ).select_related('factor_version').order_by('id')
+            for job in jobs:
+                self.stdout.write('Job {}: recomputing factor version {}'.format(job.id, job.factor_version_id))
+                try:
+                    run_factor_recompute_job(job, chunk_size=options['chunk_size'], progress=self.report)
+                except Exception as error:
+                    self.stderr.write('Job {}: failed - {}'.format(job.id, error))
+                    continue
+                self.stdout.write(self.style.SUCCESS('Job {}: done'.format(job.id)))
+
+            if not options['watch']:
+                return
+            time.sleep(options['interval'])
+
+    def report(self, job):
+        self.stdout.write('Job {}: {}/{} usages'.format(job.id, job.processed, job.total))
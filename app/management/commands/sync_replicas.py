@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from app.replicas import copy_sqlite_database
+
+
+class Command(BaseCommand):
+    help = 'Refresh the local SQLite read replicas with a consistent copy of the primary database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep copying instead of exiting after one pass.')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds between copies in --watch mode.')
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES[DEFAULT_DB_ALIAS]
+        replicas = {alias: settings.DATABASES[alias] for alias in settings.DATABASE_REPLICAS}
+        if not replicas:
+            raise CommandError('No replicas configured, set PLANETLY_SQLITE_REPLICAS.')
+        for alias, database in [(DEFAULT_DB_ALIAS, primary)] + list(replicas.items()):
+            if database['ENGINE'] != 'django.db.backends.sqlite3':
+                raise CommandError('{} is not a SQLite database, use its native replication.'.format(alias))
+
+        while True:
+            for alias, database in replicas.items():
+                size = copy_sqlite_database(primary['NAME'], database['NAME'])
+                self.stdout.write('{}: copied {} bytes'.format(alias, size))
+            if not options['watch']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,67 @@
+from django.db import migrations
+from django.db.backends.sqlite3.base import Database
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS app_user_name_fts "
+    "USING fts5(user_id UNINDEXED, name, tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS app_user_name_fts_ai AFTER INSERT ON app_user BEGIN "
+    "INSERT INTO app_user_name_fts(user_id, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS app_user_name_fts_ad AFTER DELETE ON app_user BEGIN "
+    "DELETE FROM app_user_name_fts WHERE user_id = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS app_user_name_fts_au AFTER UPDATE OF name ON app_user BEGIN "
+    "UPDATE app_user_name_fts SET name = new.name WHERE user_id = old.id; END",
+    "INSERT INTO app_user_name_fts(user_id, name) SELECT id, name FROM app_user",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS app_user_name_fts_au",
+    "DROP TRIGGER IF EXISTS app_user_name_fts_ad",
+    "DROP TRIGGER IF EXISTS app_user_name_fts_ai",
+    "DROP TABLE IF EXISTS app_user_name_fts",
+]
+
+POSTGRESQL_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS app_user_name_trgm ON app_user USING gin (name gin_trgm_ops)",
+]
+
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS app_user_name_trgm",
+]
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        for statement in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+def _sqlite_has_fts5(connection):
+    # The trigram tokenizer ships with SQLite 3.34.
+    if Database.sqlite_version_info < (3, 34, 0):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        options = {row[0] for row in cursor.fetchall()}
+    return 'ENABLE_FTS5' in options
+
+
+def forward(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite' and not _sqlite_has_fts5(schema_editor.connection):
+        return
+    _run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD})(apps, schema_editor)
+
+
+backward = _run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, backward),
+    ]
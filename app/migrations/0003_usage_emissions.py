@@ -0,0 +1,39 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:09
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_emissions(apps, schema_editor):
+    Usage = apps.get_model('app', 'Usage')
+    UsageTypes = apps.get_model('app', 'UsageTypes')
+    for usage_type in UsageTypes.objects.all():
+        Usage.objects.filter(usage_type_id=usage_type.id, factor__isnull=True).update(
+            factor=usage_type.factor,
+            emissions=F('amount') * usage_type.factor,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_user_name_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usage',
+            name='emissions',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='usage',
+            name='factor',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='usage',
+            index=models.Index(fields=['user_id', 'usage_at'], name='app_usage_user_at_idx'),
+        ),
+        migrations.RunPython(backfill_emissions, migrations.RunPython.noop),
+    ]
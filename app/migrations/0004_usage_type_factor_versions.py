@@ -0,0 +1,58 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_usage_emissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FactorRecomputeJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], db_index=True, default='pending', max_length=10)),
+                ('total', models.BigIntegerField(null=True)),
+                ('processed', models.BigIntegerField(default=0)),
+                ('last_usage_id', models.BigIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UsageTypeFactor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('factor', models.FloatField()),
+                ('valid_from', models.DateTimeField()),
+                ('valid_to', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['usage_type_id', 'valid_from'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='usage',
+            index=models.Index(fields=['usage_type_id', 'usage_at'], name='app_usage_type_at_idx'),
+        ),
+        migrations.AddField(
+            model_name='usagetypefactor',
+            name='usage_type_id',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='factors', to='app.usagetypes'),
+        ),
+        migrations.AddField(
+            model_name='factorrecomputejob',
+            name='factor_version',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='app.usagetypefactor'),
+        ),
+        migrations.AddConstraint(
+            model_name='usagetypefactor',
+            constraint=models.UniqueConstraint(fields=('usage_type_id', 'valid_from'), name='app_factor_type_from_uniq'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_usage_type_factor_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageTypeSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField()),
+                ('data', models.BinaryField()),
+                ('usage_type_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.usagetypes')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UsagePeriodTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField()),
+                ('amount', models.FloatField(default=0)),
+                ('emissions', models.FloatField(default=0)),
+                ('count', models.BigIntegerField(default=0)),
+                ('usage_type_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.usagetypes')),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='usagetypesketch',
+            constraint=models.UniqueConstraint(fields=('usage_type_id', 'period'), name='app_type_sketch_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='usageperiodtotal',
+            constraint=models.UniqueConstraint(fields=('user_id', 'usage_type_id', 'period'), name='app_period_total_uniq'),
+        ),
+    ]
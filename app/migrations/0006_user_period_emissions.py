@@ -0,0 +1,33 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:14
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_usage_rollups_and_sketches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserPeriodEmissions',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField()),
+                ('emissions', models.FloatField(default=0)),
+                ('count', models.BigIntegerField(default=0)),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='userperiodemissions',
+            index=models.Index(fields=['period', '-emissions'], name='app_leaderboard_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='userperiodemissions',
+            constraint=models.UniqueConstraint(fields=('user_id', 'period'), name='app_user_period_uniq'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:15
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def backfill_change_seq(apps, schema_editor):
+    Usage = apps.get_model('app', 'Usage')
+    ChangeCounter = apps.get_model('app', 'ChangeCounter')
+    Usage.objects.update(change_seq=F('id'))
+    last = Usage.objects.aggregate(last=Max('change_seq'))['last'] or 0
+    ChangeCounter.objects.update_or_create(name='usage', defaults={'value': last})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_user_period_emissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeCounter',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UsageTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.UUIDField()),
+                ('usage_id', models.BigIntegerField(null=True)),
+                ('change_seq', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='usage',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='usage',
+            index=models.Index(fields=['user_id', 'change_seq'], name='app_usage_user_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usagetombstone',
+            index=models.Index(fields=['user_id', 'change_seq'], name='app_tombstone_user_seq_idx'),
+        ),
+        migrations.RunPython(backfill_change_seq, migrations.RunPython.noop),
+    ]
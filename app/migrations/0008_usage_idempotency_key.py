@@ -0,0 +1,22 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_usage_change_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usage',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='usage',
+            constraint=models.UniqueConstraint(condition=models.Q(('idempotency_key__isnull', False)), fields=('user_id', 'idempotency_key'), name='app_usage_idempotency_uniq'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_usage_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField()),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('row_count', models.BigIntegerField()),
+                ('start_at', models.DateTimeField()),
+                ('end_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='usagearchivesegment',
+            index=models.Index(fields=['user_id', 'start_at'], name='app_segment_user_start_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_usage_archive_segments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usage',
+            name='resolution',
+            field=models.PositiveIntegerField(choices=[(0, 'raw'), (3600, 'hour'), (86400, 'day')], default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='usage',
+            name='sample_count',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
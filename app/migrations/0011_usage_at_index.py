@@ -0,0 +1,17 @@
+# Generated by Django 4.0.3 on 2026-10-19 17:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_usage_resolution'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usage',
+            index=models.Index(fields=['usage_at'], name='app_usage_at_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.0.3 on 2026-10-19 18:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_usage_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageStatistic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.BigIntegerField(default=0)),
+                ('mean', models.FloatField(default=0)),
+                ('variance', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField()),
+                ('usage_type_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.usagetypes')),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UsageAnomaly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('usage_id', models.BigIntegerField()),
+                ('usage_at', models.DateTimeField()),
+                ('amount', models.FloatField()),
+                ('expected', models.FloatField()),
+                ('score', models.FloatField()),
+                ('detected_at', models.DateTimeField(auto_now_add=True)),
+                ('usage_type_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.usagetypes')),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='usagestatistic',
+            constraint=models.UniqueConstraint(fields=('user_id', 'usage_type_id'), name='app_usage_statistic_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='usageanomaly',
+            index=models.Index(fields=['user_id', 'usage_at'], name='app_anomaly_user_at_idx'),
+        ),
+    ]
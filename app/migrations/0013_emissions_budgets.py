@@ -0,0 +1,46 @@
+# Generated by Django 4.0.3 on 2026-10-19 18:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_usage_anomalies'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmissionsBudget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('limit', models.FloatField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('usage_type_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.usagetypes')),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BudgetEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField()),
+                ('threshold', models.FloatField()),
+                ('limit', models.FloatField()),
+                ('emissions', models.FloatField()),
+                ('crossed_at', models.DateTimeField(auto_now_add=True)),
+                ('usage_type_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.usagetypes')),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='emissionsbudget',
+            constraint=models.UniqueConstraint(fields=('user_id', 'usage_type_id'), name='app_budget_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='budgetevent',
+            constraint=models.UniqueConstraint(fields=('user_id', 'usage_type_id', 'period', 'threshold'), name='app_budget_event_uniq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.3 on 2026-10-19 18:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_outbox_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='changecounter',
+            name='limit',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
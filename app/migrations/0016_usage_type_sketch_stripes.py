@@ -0,0 +1,51 @@
+# Generated by Django 4.0.3 on 2026-10-19 18:31
+
+import uuid
+
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+
+from app.sketches import QuantileSketch
+
+SKETCH_STRIPES = 16
+
+
+def stripe_sketches(apps, schema_editor):
+    # Sketches live on the primary; the totals of other shards are added back by `rebuild_rollups`.
+    if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+        return
+    UsagePeriodTotal = apps.get_model('app', 'UsagePeriodTotal')
+    UsageTypeSketch = apps.get_model('app', 'UsageTypeSketch')
+    sketches = {}
+    for user_id, usage_type_id, period, amount in UsagePeriodTotal.objects.values_list(
+            'user_id', 'usage_type_id', 'period', 'amount'):
+        stripe = uuid.UUID(str(user_id)).int % SKETCH_STRIPES
+        sketches.setdefault((usage_type_id, period, stripe), QuantileSketch()).add(amount)
+    UsageTypeSketch.objects.all().delete()
+    UsageTypeSketch.objects.bulk_create([
+        UsageTypeSketch(usage_type_id_id=usage_type_id, period=period, stripe=stripe, data=sketch.to_bytes())
+        for (usage_type_id, period, stripe), sketch in sketches.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_change_counter_blocks'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='usagetypesketch',
+            name='app_type_sketch_uniq',
+        ),
+        migrations.AddField(
+            model_name='usagetypesketch',
+            name='stripe',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='usagetypesketch',
+            constraint=models.UniqueConstraint(fields=('usage_type_id', 'period', 'stripe'), name='app_type_sketch_stripe_uniq'),
+        ),
+        migrations.RunPython(stripe_sketches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.3 on 2026-10-19 18:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_usage_type_sketch_stripes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usagearchivesegment',
+            name='max_id',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='usagearchivesegment',
+            name='min_id',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
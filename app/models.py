@@ -6,7 +6,9 @@ import pytz
 from datetime import datetime
 
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import Q
 
 
 class UserManager(BaseUserManager):
@@ -79,7 +81,18 @@ class Usage(models.Model):
     :param usage_type_id (ForeignKey): ID of usage_type.
     :param usage_at (DateTime): Time at which a usage was created. [Default - current time]
     :param amount (Number): Current usage.
+    :param factor (Number): Snapshot of the UsageType factor used to compute emissions.
+    :param emissions (Number): Stored `amount * factor`, computed at write time.
+    :param change_seq (Number): Value of the `usage` ChangeCounter when the row was last written.
+    :param idempotency_key (Characters): Optional client supplied key, unique per user.
+    :param resolution (Number): Seconds aggregated by the row, 0 for a raw reading. [Default - 0]
+    :param sample_count (Number): Number of raw readings aggregated by the row. [Default - 1]
     """
+    class Resolution(models.IntegerChoices):
+        RAW = 0, 'raw'
+        HOUR = 3600, 'hour'
+        DAY = 86400, 'day'
+
     user_id = models.ForeignKey(
         'User',
         on_delete=models.CASCADE,
@@ -90,6 +103,31 @@ class Usage(models.Model):
     )
     usage_at = models.DateTimeField(datetime.now(tz=pytz.utc))
     amount = models.FloatField()
+    factor = models.FloatField(null=True, editable=False)
+    emissions = models.FloatField(null=True, editable=False)
+    change_seq = models.BigIntegerField(default=0, editable=False)
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True)
+    resolution = models.PositiveIntegerField(choices=Resolution.choices, default=Resolution.RAW, editable=False)
+    sample_count = models.PositiveIntegerField(default=1, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'idempotency_key'], condition=Q(idempotency_key__isnull=False),
+                                    name='app_usage_idempotency_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['user_id', 'usage_at'], name='app_usage_user_at_idx'),
+            models.Index(fields=['usage_type_id', 'usage_at'], name='app_usage_type_at_idx'),
+            models.Index(fields=['user_id', 'change_seq'], name='app_usage_user_seq_idx'),
+            models.Index(fields=['usage_at'], name='app_usage_at_idx'),
+        ]
+
+    def apply_factor(self, factor):
+        """
+        Store `factor` as the snapshot for this usage and recompute its emissions.
+        """
+        self.factor = float(factor)
+        self.emissions = float(self.amount) * self.factor
 
 
 class UsageTypes(models.Model):
@@ -103,5 +141,368 @@ class UsageTypes(models.Model):
     unit = models.CharField(max_length=100)
     factor = models.FloatField()
 
+    def __str__(self):
+        return '{} ({})'.format(self.name, self.unit)
+
+
+class UsageTypeFactor(models.Model):
+    """
+    The class representing the schema of the UsageTypeFactor table.
+    A version of a UsageType factor, effective from `valid_from` until `valid_to`.
+    :param usage_type_id (ForeignKey): ID of usage_type.
+    :param factor (Number): Rate for the resource during the validity range.
+    :param valid_from (DateTime): Start of the validity range (inclusive).
+    :param valid_to (DateTime): End of the validity range (exclusive). [Default - open ended]
+    """
+    usage_type_id = models.ForeignKey(
+        'UsageTypes',
+        on_delete=models.CASCADE,
+        related_name='factors',
+    )
+    factor = models.FloatField()
+    valid_from = models.DateTimeField()
+    valid_to = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['usage_type_id', 'valid_from']
+        constraints = [
+            models.UniqueConstraint(fields=['usage_type_id', 'valid_from'], name='app_factor_type_from_uniq'),
+        ]
+
+    def covers(self, moment):
+        return self.valid_from <= moment and (self.valid_to is None or moment < self.valid_to)
+
+
+class FactorRecomputeJob(models.Model):
+    """
+    The class representing the schema of the FactorRecomputeJob table.
+    Tracks the recomputation of the Usages affected by a new UsageTypeFactor.
+    :param factor_version (ForeignKey): ID of the UsageTypeFactor to apply.
+    :param status (Characters): pending, running, done or failed.
+    :param total (Number): Number of Usages in the validity range when the job started.
+    :param processed (Number): Number of Usages recomputed so far.
+    :param last_usage_id (Number): Highest Usage ID already recomputed, the job resumes after it.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, PENDING), (RUNNING, RUNNING), (DONE, DONE), (FAILED, FAILED)]
+
+    factor_version = models.ForeignKey(
+        'UsageTypeFactor',
+        on_delete=models.CASCADE,
+        related_name='jobs',
+    )
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    total = models.BigIntegerField(null=True)
+    processed = models.BigIntegerField(default=0)
+    last_usage_id = models.BigIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class UsagePeriodTotal(models.Model):
+    """
+    The class representing the schema of the UsagePeriodTotal table.
+    Running totals of a User's Usages of one UsageType in one calendar month,
+    maintained on every Usage write.
+    :param user_id (ForeignKey): ID of user.
+    :param usage_type_id (ForeignKey): ID of usage_type.
+    :param period (Date): First day of the month.
+    :param amount (Number): Sum of `Usage.amount`.
+    :param emissions (Number): Sum of `Usage.emissions`.
+    :param count (Number): Number of Usages.
+    """
+    user_id = models.ForeignKey(
+        'User',
+        on_delete=models.CASCADE,
+    )
+    usage_type_id = models.ForeignKey(
+        'UsageTypes',
+        on_delete=models.CASCADE,
+    )
+    period = models.DateField()
+    amount = models.FloatField(default=0)
+    emissions = models.FloatField(default=0)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'usage_type_id', 'period'], name='app_period_total_uniq'),
+        ]
+
+
+class UserPeriodEmissions(models.Model):
+    """
+    The class representing the schema of the UserPeriodEmissions table.
+    Running emissions total of a User over all UsageTypes in one calendar month,
+    indexed by period and descending emissions for the leaderboard.
+    :param user_id (ForeignKey): ID of user.
+    :param period (Date): First day of the month.
+    :param emissions (Number): Sum of `Usage.emissions`.
+    :param count (Number): Number of Usages.
+    """
+    user_id = models.ForeignKey(
+        'User',
+        on_delete=models.CASCADE,
+    )
+    period = models.DateField()
+    emissions = models.FloatField(default=0)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'period'], name='app_user_period_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['period', '-emissions'], name='app_leaderboard_idx'),
+        ]
+
+
+class UsageTypeSketch(models.Model):
+    """
+    The class representing the schema of the UsageTypeSketch table.
+    Quantile sketch of the per-user `UsagePeriodTotal.amount` of one UsageType in one month,
+    split in stripes of Users that are merged on read, see app/rollups.py.
+    :param usage_type_id (ForeignKey): ID of usage_type.
+    :param period (Date): First day of the month.
+    :param stripe (Number): Stripe of the Users counted.
+    :param data (Binary): Encoded `app.sketches.QuantileSketch`.
+    """
+    usage_type_id = models.ForeignKey(
+        'UsageTypes',
+        on_delete=models.CASCADE,
+    )
+    period = models.DateField()
+    stripe = models.PositiveSmallIntegerField(default=0)
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['usage_type_id', 'period', 'stripe'], name='app_type_sketch_stripe_uniq'),
+        ]
+
+
+class ChangeCounter(models.Model):
+    """
+    The class representing the schema of the ChangeCounter table.
+    A named, monotonically increasing counter.
+    :param name (Characters): Name of the counter.
+    :param value (Number): Last value handed out.
+    :param limit (Number): Last value of the block reserved for a counter handing out blocks of another one.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+    limit = models.BigIntegerField(null=True)
+
+
+class UsageTombstone(models.Model):
+    """
+    The class representing the schema of the UsageTombstone table.
+    Records a Usage deletion for incremental sync. `user_id` is not a foreign
+    key so tombstones outlive the deletion of the User.
+    :param user_id (UUID): ID of the user the Usage belonged to.
+    :param usage_id (Number): ID of the deleted Usage, null when all Usages of the user were deleted.
+    :param change_seq (Number): Value of the `usage` ChangeCounter at deletion.
+    """
+    user_id = models.UUIDField()
+    usage_id = models.BigIntegerField(null=True)
+    change_seq = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'change_seq'], name='app_tombstone_user_seq_idx'),
+        ]
+
+
+class UsageArchiveSegment(models.Model):
+    """
+    The class representing the schema of the UsageArchiveSegment table.
+    Catalog of the columnar segment files holding archived Usages of a User.
+    :param user_id (ForeignKey): ID of user.
+    :param period (Date): First day of the archived month.
+    :param path (Characters): Path of the segment file, relative to USAGE_ARCHIVE_DIR.
+    :param row_count (Number): Number of Usages in the segment.
+    :param start_at (DateTime): Earliest `usage_at` in the segment.
+    :param end_at (DateTime): Latest `usage_at` in the segment.
+    :param min_id (Number): Lowest Usage ID in the segment.
+    :param max_id (Number): Highest Usage ID in the segment.
+    """
+    user_id = models.ForeignKey(
+        'User',
+        on_delete=models.CASCADE,
+    )
+    period = models.DateField()
+    path = models.CharField(max_length=255, unique=True)
+    row_count = models.BigIntegerField()
+    start_at = models.DateTimeField()
+    end_at = models.DateTimeField()
+    min_id = models.BigIntegerField(null=True)
+    max_id = models.BigIntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'start_at'], name='app_segment_user_start_idx'),
+        ]
+
+
+class UsageStatistic(models.Model):
+    """
+    The class representing the schema of the UsageStatistic table.
+    Checkpoint of the exponentially weighted statistics of the readings of one
+    User and UsageType, see app/anomalies.py.
+    :param user_id (ForeignKey): ID of user.
+    :param usage_type_id (ForeignKey): ID of usage_type.
+    :param count (Number): Number of readings observed.
+    :param mean (Number): Weighted mean of `Usage.amount`.
+    :param variance (Number): Weighted variance of `Usage.amount`.
+    :param updated_at (DateTime): Time of the checkpoint.
+    """
+    user_id = models.ForeignKey(
+        'User',
+        on_delete=models.CASCADE,
+    )
+    usage_type_id = models.ForeignKey(
+        'UsageTypes',
+        on_delete=models.CASCADE,
+    )
+    count = models.BigIntegerField(default=0)
+    mean = models.FloatField(default=0)
+    variance = models.FloatField(default=0)
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'usage_type_id'], name='app_usage_statistic_uniq'),
+        ]
+
+
+class UsageAnomaly(models.Model):
+    """
+    The class representing the schema of the UsageAnomaly table.
+    A reading found out of line with the statistics of its User and UsageType at ingest.
+    `usage_id` is not a foreign key so anomalies outlive the deletion of the Usage.
+    :param user_id (ForeignKey): ID of user.
+    :param usage_type_id (ForeignKey): ID of usage_type.
+    :param usage_id (Number): ID of the Usage.
+    :param usage_at (DateTime): `usage_at` of the Usage.
+    :param amount (Number): `amount` of the Usage.
+    :param expected (Number): Weighted mean of the readings before it.
+    :param score (Number): Distance to `expected` in standard deviations.
+    :param detected_at (DateTime): Time of the detection.
+    """
+    user_id = models.ForeignKey(
+        'User',
+        on_delete=models.CASCADE,
+    )
+    usage_type_id = models.ForeignKey(
+        'UsageTypes',
+        on_delete=models.CASCADE,
+    )
+    usage_id = models.BigIntegerField()
+    usage_at = models.DateTimeField()
+    amount = models.FloatField()
+    expected = models.FloatField()
+    score = models.FloatField()
+    detected_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'usage_at'], name='app_anomaly_user_at_idx'),
+        ]
+
+
+class EmissionsBudget(models.Model):
+    """
+    The class representing the schema of the EmissionsBudget table.
+    Monthly emissions limit of a User for one UsageType, checked against the
+    UsagePeriodTotal of every month.
+    :param user_id (ForeignKey): ID of user.
+    :param usage_type_id (ForeignKey): ID of usage_type.
+    :param limit (Number): Emissions allowed per calendar month.
+    :param updated_at (DateTime): Time the limit was last set.
+    """
+    user_id = models.ForeignKey(
+        'User',
+        on_delete=models.CASCADE,
+    )
+    usage_type_id = models.ForeignKey(
+        'UsageTypes',
+        on_delete=models.CASCADE,
+    )
+    limit = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'usage_type_id'], name='app_budget_uniq'),
+        ]
+
+
+class BudgetEvent(models.Model):
+    """
+    The class representing the schema of the BudgetEvent table.
+    Records the first time the emissions of a month reached a share of the budget.
+    The unique constraint makes each threshold of a month recorded exactly once.
+    :param user_id (ForeignKey): ID of user.
+    :param usage_type_id (ForeignKey): ID of usage_type.
+    :param period (Date): First day of the month.
+    :param threshold (Number): Share of the limit reached, one of BUDGET_THRESHOLDS.
+    :param limit (Number): Limit of the budget at the time.
+    :param emissions (Number): Emissions of the month when the threshold was reached.
+    :param crossed_at (DateTime): Time of the crossing.
+    """
+    user_id = models.ForeignKey(
+        'User',
+        on_delete=models.CASCADE,
+    )
+    usage_type_id = models.ForeignKey(
+        'UsageTypes',
+        on_delete=models.CASCADE,
+    )
+    period = models.DateField()
+    threshold = models.FloatField()
+    limit = models.FloatField()
+    emissions = models.FloatField()
+    crossed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'usage_type_id', 'period', 'threshold'],
+                                    name='app_budget_event_uniq'),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """
+    The class representing the schema of the OutboxEvent table.
+    A change of a Usage or User waiting to be delivered to downstream systems.
+    Written in the transaction of the change, and deleted once delivered.
+    `user_id` is not a foreign key so the events outlive the deletion of the User.
+    :param event_id (UUID): ID of the event, for consumers to drop repeated deliveries.
+    :param user_id (UUID): ID of the user the change belongs to.
+    :param topic (Characters): `usage` or `user`.
+    :param event (Characters): `created`, `updated`, `deleted` or `reset`.
+    :param payload (JSON): Details of the change.
+    :param created_at (DateTime): Time of the change.
+    :param attempts (Number): Failed deliveries so far.
+    :param next_attempt_at (DateTime): Time before which a failed event is not retried.
+    """
+    event_id = models.UUIDField(default=uuid.uuid4, unique=True)
+    user_id = models.UUIDField()
+    topic = models.CharField(max_length=10)
+    event = models.CharField(max_length=10)
+    payload = models.JSONField(encoder=DjangoJSONEncoder, default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'id'], name='app_outbox_user_idx'),
+        ]
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""Transactional outbox of the changes of Usages and Users, for downstream systems.
+Writes append an OutboxEvent in their own transaction, on the shard of the
+User, so an event is recorded if and only if its change is committed. The
+background jobs rewriting Usages do the same for every chunk: the factor
+recompute (`updated`), compaction (`compacted`) and archiving (`archived`). The
+`dispatch_outbox` command delivers the events in batches to the sink chosen
+with the OUTBOX_SINK setting:
+    1. FileSink - appends the events to a newline delimited JSON file.
+    2. HttpSink - POSTs each batch as a JSON array to a URL, standing in for
+       the ingestion endpoint of a downstream system.
+Delivery is at least once: events are deleted only after the sink accepted
+their batch, so a dispatcher stopped in between delivers them again and
+consumers drop repeats by `id`. The events of a User are delivered in the
+order they were written: a failed batch is retried with exponential backoff,
+and the later events of its Users wait for it. Run one dispatcher at a time.
+"""
+import json
+import os
+import urllib.request
+
+from datetime import datetime, timedelta
+
+import pytz
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Min, Q
+from django.utils.module_loading import import_string
+
+from app.models import OutboxEvent
+from app.sharding import scatter
+
+
+def outbox_event(user_id, topic, event, **payload):
+    """Return an unsaved OutboxEvent, to be written with `record_events`."""
+    return OutboxEvent(user_id=user_id, topic=topic, event=event, payload=payload)
+
+
+def record_event(user_id, topic, event, **payload):
+    """Append a change event to the outbox. Must run in the transaction of the change.
+        Args:
+            user_id (string): [Required].
+            topic (string): [Required]. `usage` or `user`.
+            event (string): [Required]. `created`, `updated`, `deleted`, `reset`,
+                `compacted` or `archived`.
+            **payload (dict): [Optional]. Details of the change.
+        Returns (OutboxEvent):
+            Returns the saved event.
+    """
+    return OutboxEvent.objects.create(user_id=user_id, topic=topic, event=event, payload=payload)
+
+
+def record_events(events):
+    """Append unsaved events of Users of the current shard to the outbox with one INSERT."""
+    if events:
+        OutboxEvent.objects.bulk_create(events)
+
+
+def retry_delay(attempts):
+    """Return the seconds to wait before the next delivery of events that failed `attempts` times.
+        >>> [retry_delay(attempts) for attempts in (1, 2, 3)]
+        [1, 2, 4]
+    """
+    return min(settings.OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1), settings.OUTBOX_MAX_RETRY_SECONDS)
+
+
+def event_message(event):
+    """Return the message delivered to the sinks for an event."""
+    return {'id': str(event.event_id), 'user_id': event.user_id.hex, 'topic': event.topic, 'event': event.event,
+            'payload': event.payload, 'created_at': event.created_at}
+
+
+class FileSink:
+    """Appends every event as a line of JSON to `path`."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def deliver(self, messages):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a') as stream:
+            stream.writelines(json.dumps(message, cls=DjangoJSONEncoder) + '\n' for message in messages)
+            stream.flush()
+            os.fsync(stream.fileno())
+
+
+class HttpSink:
+    """POSTs every batch as a JSON array to `url`. Any response but a 2xx fails the batch."""
+
+    def __init__(self, url, timeout=10, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+
+    def deliver(self, messages):
+        request = urllib.request.Request(self.url, data=json.dumps(messages, cls=DjangoJSONEncoder).encode(),
+                                         headers=self.headers, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+def get_sink():
+    """Return the sink configured by OUTBOX_SINK and OUTBOX_SINK_OPTIONS."""
+    return import_string(settings.OUTBOX_SINK)(**settings.OUTBOX_SINK_OPTIONS)
+
+
+def due_events(now, batch_size):
+    """Return the oldest events of the current shard that can be delivered now.
+    Events waiting for a retry hold back the later events of their User.
+    """
+    due = Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+    events = OutboxEvent.objects.filter(due)
+    for user_id, first in OutboxEvent.objects.exclude(due).values('user_id').annotate(first=Min('pk')) \
+            .values_list('user_id', 'first'):
+        events = events.exclude(user_id=user_id, pk__gt=first)
+    return list(events.order_by('pk')[:batch_size])
+
+
+def dispatch_events(sink, batch_size):
+    """Deliver one batch of due events of the current shard.
+    Delivered events are deleted; a failed batch is retried after `retry_delay`.
+        Args:
+            sink (object): [Required]. Has a `deliver(messages)` method raising OSError on failure.
+            batch_size (int): [Required]. Events delivered at most.
+        Returns (dict):
+            Returns the number of events `delivered` and `failed`, and the seconds
+            between the writes and the delivery of the events, as `lag`.
+    """
+    now = datetime.now(tz=pytz.utc)
+    events = due_events(now, batch_size)
+    if not events:
+        return {'delivered': 0, 'failed': 0, 'lag': []}
+    event_ids = [event.pk for event in events]
+    try:
+        sink.deliver([event_message(event) for event in events])
+    except OSError:
+        attempts = max(event.attempts for event in events) + 1
+        OutboxEvent.objects.filter(pk__in=event_ids).update(
+            attempts=attempts, next_attempt_at=now + timedelta(seconds=retry_delay(attempts)))
+        return {'delivered': 0, 'failed': len(events), 'lag': []}
+    OutboxEvent.objects.filter(pk__in=event_ids).delete()
+    delivered_at = datetime.now(tz=pytz.utc)
+    return {'delivered': len(events), 'failed': 0,
+            'lag': [(delivered_at - event.created_at).total_seconds() for event in events]}
+
+
+def dispatch_outbox(sink, batch_size=None):
+    """Deliver one batch of due events of every shard.
+        Args:
+            sink (object): [Required].
+            batch_size (int): [Optional]. Events delivered at most per shard, OUTBOX_BATCH_SIZE by default.
+        Returns (dict):
+            Returns the numbers of events `delivered` and `failed`, and the mean and
+            maximum seconds between their writes and their delivery.
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    results = scatter(lambda: dispatch_events(sink, batch_size))
+    lag = [seconds for result in results for seconds in result['lag']]
+    return {
+        'delivered': sum(result['delivered'] for result in results),
+        'failed': sum(result['failed'] for result in results),
+        'lag_mean': sum(lag) / len(lag) if lag else None,
+        'lag_max': max(lag) if lag else None,
+    }
+
+
+def outbox_status():
+    """Return the backlog of the outbox over all shards.
+        Returns (dict):
+            Returns the number of `pending` events, of them `retrying` after a failure,
+            and the age in seconds of the oldest one, as `lag`.
+    """
+    totals = scatter(lambda: OutboxEvent.objects.aggregate(
+        pending=Count('pk'), retrying=Count('pk', filter=Q(attempts__gt=0)), oldest=Min('created_at')))
+    oldest = [total['oldest'] for total in totals if total['oldest'] is not None]
+    return {
+        'pending': sum(total['pending'] for total in totals),
+        'retrying': sum(total['retrying'] for total in totals),
+        'lag': (datetime.now(tz=pytz.utc) - min(oldest)).total_seconds() if oldest else 0.0,
+    }
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""Routing of read queries to database replicas.
+`ReplicaRoutingMiddleware` marks each request as eligible for replicas when
+its method is safe and its client has not written recently; `ReplicaRouter`
+then sends the reads of eligible requests to one of DATABASE_REPLICAS. Any
+write, and any read inside a transaction, goes to the primary, and once a
+request has written its remaining reads follow it there. `WriteTrackingRouter`,
+listed before the other routers, notices the writes whichever router sends
+them, shards included. After a write the client stays on the primary for
+REPLICA_STICKY_SECONDS, so it reads its own writes while replicas catch up:
+the response carries a signed cookie, and the client is also recorded in the
+REPLICA_STICKY_CACHE cache, which every server process must share. Queries
+run outside a request (management commands, jobs) always use the primary.
+
+Locally, replicas are SQLite copies of the primary refreshed by
+`manage.py sync_replicas` (see `copy_sqlite_database`).
+"""
+import contextvars
+import hashlib
+import os
+import random
+import sqlite3
+
+from contextlib import closing
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_CACHE_PREFIX = 'replicas:sticky:'
+STICKY_COOKIE_SALT = 'app.replicas.sticky'
+
+
+class RoutingState:
+    """Routing decisions of the current request.
+    Attributes:
+        use_replica (bool): Reads may go to a replica.
+        wrote (bool): A write was routed during the request.
+    """
+
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+_state = contextvars.ContextVar('replica_routing_state', default=None)
+
+
+def reads_own_writes():
+    """Return True if the current request must read its client's latest writes from the primary:
+    it is not a safe request, it wrote, or its client wrote in the last REPLICA_STICKY_SECONDS."""
+    state = _state.get()
+    return state is not None and (not state.use_replica or state.wrote)
+
+
+class WriteTrackingRouter:
+    """Database router recording that the current request wrote, leaving the choice of database to the next routers."""
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return None
+
+
+class ReplicaRouter:
+    """Database router sending the reads of eligible requests to DATABASE_REPLICAS."""
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        replicas = settings.DATABASE_REPLICAS
+        if state is None or not state.use_replica or state.wrote or not replicas \
+                or transaction.get_connection(DEFAULT_DB_ALIAS).in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    """Decide per request whether reads may use a replica, and keep clients
+    that just wrote on the primary."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        client = client_key(request)
+        safe = request.method in SAFE_METHODS
+        state = RoutingState(use_replica=safe and not self.is_sticky(request, client))
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if not safe or state.wrote:
+            caches[settings.REPLICA_STICKY_CACHE].set(STICKY_CACHE_PREFIX + client, True,
+                                                      timeout=settings.REPLICA_STICKY_SECONDS)
+            response.set_signed_cookie(settings.REPLICA_STICKY_COOKIE, '1', salt=STICKY_COOKIE_SALT,
+                                       max_age=settings.REPLICA_STICKY_SECONDS, httponly=True, samesite='Lax')
+        return response
+
+    def is_sticky(self, request, client):
+        """Return True if the client wrote in the last REPLICA_STICKY_SECONDS."""
+        cookie = request.get_signed_cookie(settings.REPLICA_STICKY_COOKIE, default=None, salt=STICKY_COOKIE_SALT,
+                                           max_age=settings.REPLICA_STICKY_SECONDS)
+        return cookie is not None or bool(caches[settings.REPLICA_STICKY_CACHE].get(STICKY_CACHE_PREFIX + client))
+
+
+def client_key(request):
+    """Return a digest identifying the client of a request by its credentials, or its address."""
+    credentials = request.META.get('HTTP_AUTHORIZATION') \
+        or request.COOKIES.get(settings.SESSION_COOKIE_NAME) \
+        or request.META.get('REMOTE_ADDR', '')
+    return hashlib.sha1(credentials.encode('utf-8')).hexdigest()
+
+
+def copy_sqlite_database(source, target):
+    """Copy a SQLite database with the online backup API and swap the copy in atomically.
+    New connections to `target` see the fresh copy; open ones keep reading the old file.
+        Args:
+            source (string): [Required]. Path of the primary database.
+            target (string): [Required]. Path of the replica.
+        Returns (int):
+            Size of the replica in bytes.
+    """
+    tmp_path = '{}.tmp'.format(target)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with closing(sqlite3.connect(str(source))) as primary, closing(sqlite3.connect(tmp_path)) as replica:
+        primary.backup(replica)
+    os.replace(tmp_path, target)
+    return os.path.getsize(target)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""Incrementally maintained aggregates over the Usage table.
+Every Usage write is turned into deltas keyed by `(user_id, usage_type_id,
+period)`, where period is the first day of the calendar month of `usage_at`.
+Deltas are applied to:
+    1. UsagePeriodTotal - per user, usage type and month running totals.
+    2. UsageTypeSketch - per usage type and month quantile sketch of those totals.
+    3. UserPeriodEmissions - per user and month emissions, ranked by the leaderboard.
+The new totals are then checked against the emissions budgets (app/budgets.py).
+Deltas can be built from model instances (`usage_deltas`) or with a single
+aggregate query over a queryset (`queryset_deltas`) for set-based writes.
+Counts are numbers of raw readings, so compacted Usages count their `sample_count`.
+Totals and leaderboard entries live on the shard of their User; sketches,
+which span all Users, live on the primary. Every sketch is split in
+SKETCH_STRIPES rows, each counting the Users hashed to it, so concurrent
+writes of different Users rarely wait for the same row; reads merge them.
+"""
+import uuid
+
+from datetime import date
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth
+from django.utils.dateparse import parse_datetime
+
+from app.archive import segment_deltas
+from app.budgets import check_budgets
+from app.models import Usage, UsageArchiveSegment, UsagePeriodTotal, UsageTypeSketch, UserPeriodEmissions
+from app.sharding import atomic, group_by_shard, on_user_shard, shard_aliases, use_shard
+from app.sketches import QuantileSketch
+
+SKETCH_STRIPES = 16
+
+
+def period_of(moment):
+    """Return the first day of the month of `moment` (datetime or ISO string)."""
+    if isinstance(moment, str):
+        moment = parse_datetime(moment)
+    return date(moment.year, moment.month, 1)
+
+
+def sketch_stripe(user_id):
+    """Return the sketch stripe counting a User.
+        >>> sketch_stripe('00000000-0000-0000-0000-000000000011')
+        1
+    """
+    return uuid.UUID(str(user_id)).int % SKETCH_STRIPES
+
+
+def usage_deltas(usages, sign=1):
+    """Build deltas from Usage models.
+        Args:
+            usages (iterable): [Required]. Usage models.
+            sign (int): [Optional]. 1 for added Usages, -1 for removed ones.
+        Returns (dict):
+            Returns a dict of `[amount, emissions, count]` keyed by
+            `(user_id, usage_type_id, period)`.
+    """
+    deltas = {}
+    for usage in usages:
+        key = (usage.user_id_id, usage.usage_type_id_id, period_of(usage.usage_at))
+        delta = deltas.setdefault(key, [0.0, 0.0, 0])
+        delta[0] += sign * float(usage.amount)
+        delta[1] += sign * (usage.emissions or 0.0)
+        delta[2] += sign * usage.sample_count
+    return deltas
+
+
+def queryset_deltas(queryset, sign=1):
+    """Build deltas from a Usage queryset with one aggregate query.
+        Args:
+            queryset (QuerySet): [Required]. Usage queryset.
+            sign (int): [Optional]. 1 for added Usages, -1 for removed ones.
+        Returns (dict):
+            Returns a dict of `[amount, emissions, count]` keyed by
+            `(user_id, usage_type_id, period)`.
+    """
+    rows = queryset.order_by() \
+        .annotate(period=TruncMonth('usage_at')) \
+        .values('user_id', 'usage_type_id', 'period') \
+        .annotate(total_amount=Sum('amount'), total_emissions=Sum('emissions'), total_count=Sum('sample_count'))
+    return {
+        (row['user_id'], row['usage_type_id'], period_of(row['period'])):
+            [sign * row['total_amount'], sign * (row['total_emissions'] or 0.0), sign * row['total_count']]
+        for row in rows
+    }
+
+
+def merge_deltas(*deltas):
+    """Merge several delta dicts into one."""
+    merged = {}
+    for delta in deltas:
+        for key, (amount, emissions, count) in delta.items():
+            total = merged.setdefault(key, [0.0, 0.0, 0])
+            total[0] += amount
+            total[1] += emissions
+            total[2] += count
+    return merged
+
+
+def apply_usage_deltas(deltas):
+    """Apply deltas to the running totals, the quantile sketches and the leaderboard.
+    The deltas of each shard are applied in one transaction.
+        Args:
+            deltas (dict): [Required]. Output of `usage_deltas`, `queryset_deltas`
+                or `merge_deltas`.
+        Returns (None):
+            None.
+    """
+    for alias, keys in group_by_shard(sorted(deltas, key=str), lambda key: key[0]).items():
+        with use_shard(alias), atomic(savepoint=False):
+            _apply_shard_deltas({key: deltas[key] for key in keys})
+
+
+def _apply_shard_deltas(deltas):
+    sketch_changes = {}
+    leaderboard_changes = {}
+    emission_changes = {}
+    for (user_id, usage_type_id, period), (amount, emissions, count) in sorted(deltas.items(), key=str):
+        if not (amount or emissions or count):
+            continue
+        leaderboard_delta = leaderboard_changes.setdefault((user_id, period), [0.0, 0])
+        leaderboard_delta[0] += emissions
+        leaderboard_delta[1] += count
+
+        total, _ = UsagePeriodTotal.objects.select_for_update().get_or_create(
+            user_id_id=user_id, usage_type_id_id=usage_type_id, period=period)
+        old_amount = total.amount if total.count > 0 else None
+        old_emissions = total.emissions
+
+        total.amount += amount
+        total.emissions += emissions
+        total.count += count
+        if total.count > 0:
+            total.save(update_fields=['amount', 'emissions', 'count'])
+            new_amount = total.amount
+        else:
+            total.delete()
+            new_amount = None
+
+        if old_amount != new_amount:
+            sketch_changes.setdefault((usage_type_id, period, sketch_stripe(user_id)), []).append(
+                (old_amount, new_amount))
+        emission_changes[(user_id, usage_type_id, period)] = (old_emissions, total.emissions)
+
+    for (usage_type_id, period, stripe), changes in sorted(sketch_changes.items(), key=str):
+        _update_sketch(usage_type_id, period, stripe, changes)
+    for (user_id, period), (emissions, count) in leaderboard_changes.items():
+        _update_user_period_emissions(user_id, period, emissions, count)
+    check_budgets(emission_changes)
+
+
+@on_user_shard
+def forget_user(user_id):
+    """Remove every contribution of a User from the aggregates.
+    Used before deleting all the Usages of a User, without loading them.
+        Args:
+            user_id (string): [Required].
+        Returns (None):
+            None.
+    """
+    totals = UsagePeriodTotal.objects.filter(user_id=user_id)
+    apply_usage_deltas({
+        (total.user_id_id, total.usage_type_id_id, total.period): [-total.amount, -total.emissions, -total.count]
+        for total in totals
+    })
+
+
+def load_sketch(usage_type_id, period):
+    """Return the QuantileSketch of a UsageType and month, merging its stripes, or None if nothing was recorded."""
+    sketch = None
+    for data in UsageTypeSketch.objects.filter(usage_type_id=usage_type_id, period=period).values_list('data',
+                                                                                                      flat=True):
+        stripe = QuantileSketch.from_bytes(bytes(data))
+        if sketch is None:
+            sketch = stripe
+        else:
+            sketch.merge(stripe)
+    return sketch
+
+
+@transaction.atomic
+def rebuild_usage_rollups():
+    """Recompute all the aggregates from the Usage table and the archive segments of every shard.
+        Returns (int):
+            Number of UsagePeriodTotal rows written.
+    """
+    UsageTypeSketch.objects.all().delete()
+    sketches = {}
+    written = 0
+    for alias in shard_aliases():
+        with use_shard(alias), atomic():
+            UsagePeriodTotal.objects.all().delete()
+            UserPeriodEmissions.objects.all().delete()
+
+            totals = []
+            leaderboard = {}
+            deltas = merge_deltas(queryset_deltas(Usage.objects.all()),
+                                  segment_deltas(UsageArchiveSegment.objects.all()))
+            for (user_id, usage_type_id, period), (amount, emissions, count) in deltas.items():
+                totals.append(UsagePeriodTotal(user_id_id=user_id, usage_type_id_id=usage_type_id, period=period,
+                                               amount=amount, emissions=emissions, count=count))
+                sketches.setdefault((usage_type_id, period, sketch_stripe(user_id)), QuantileSketch()).add(amount)
+                entry = leaderboard.setdefault((user_id, period),
+                                               UserPeriodEmissions(user_id_id=user_id, period=period))
+                entry.emissions += emissions
+                entry.count += count
+            UsagePeriodTotal.objects.bulk_create(totals, batch_size=1000)
+            UserPeriodEmissions.objects.bulk_create(leaderboard.values(), batch_size=1000)
+            written += len(totals)
+    UsageTypeSketch.objects.bulk_create([
+        UsageTypeSketch(usage_type_id_id=usage_type_id, period=period, stripe=stripe, data=sketch.to_bytes())
+        for (usage_type_id, period, stripe), sketch in sketches.items()
+    ], batch_size=1000)
+    return written
+
+
+def _update_sketch(usage_type_id, period, stripe, changes):
+    row = UsageTypeSketch.objects.select_for_update() \
+        .filter(usage_type_id=usage_type_id, period=period, stripe=stripe).first()
+    sketch = QuantileSketch.from_bytes(bytes(row.data)) if row else QuantileSketch()
+    for old_amount, new_amount in changes:
+        if old_amount is not None:
+            sketch.remove(old_amount)
+        if new_amount is not None:
+            sketch.add(new_amount)
+
+    if row:
+        row.data = sketch.to_bytes()
+        row.save(update_fields=['data'])
+    else:
+        UsageTypeSketch.objects.create(usage_type_id_id=usage_type_id, period=period, stripe=stripe,
+                                       data=sketch.to_bytes())
+
+
+def _update_user_period_emissions(user_id, period, emissions, count):
+    entries = UserPeriodEmissions.objects.filter(user_id=user_id, period=period)
+    # Only removed readings can empty an entry, which is then deleted instead of updated.
+    if count < 0 and entries.filter(count__lte=-count).delete()[0]:
+        return
+    if not entries.update(emissions=F('emissions') + emissions, count=F('count') + count) and count > 0:
+        UserPeriodEmissions.objects.create(user_id_id=user_id, period=period, emissions=emissions, count=count)
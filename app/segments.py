@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""Columnar segment files for archived Usages.
+A segment holds the Usages of one user and one month, one compressed
+column per field:
+
+    b'USEG' | header length (uint32 LE) | JSON header | column blobs
+
+The header lists the row count, the byte order and the offset and size of
+every zlib-compressed column. Segments are opened with `mmap`, so reading
+one column only touches (and decompresses) that column's bytes. Columns
+added after a segment was written read back as their `DEFAULTS`.
+
+Example:
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'example.useg')
+    >>> size = write_segment(path, {'id': [1, 2], 'usage_type_id': [1, 1], 'usage_at': [0, 60000000],
+    ...                             'amount': [1.5, 2.5], 'factor': [2.0, 2.0], 'emissions': [3.0, None],
+    ...                             'change_seq': [7, 8], 'resolution': [0, 0], 'sample_count': [1, 1]})
+    >>> with Segment(path) as segment:
+    ...     list(segment.column('amount')), segment.column('emissions')[1]
+    ([1.5, 2.5], None)
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from array import array
+from datetime import datetime, timedelta
+
+import pytz
+
+MAGIC = b'USEG'
+SEGMENT_FORMAT_VERSION = 2
+COLUMNS = (
+    ('id', 'q'),
+    ('usage_type_id', 'q'),
+    ('usage_at', 'q'),
+    ('amount', 'd'),
+    ('factor', 'd'),
+    ('emissions', 'd'),
+    ('change_seq', 'q'),
+    ('resolution', 'q'),
+    ('sample_count', 'q'),
+)
+NULLABLE = {'factor', 'emissions'}
+DEFAULTS = {'resolution': 0, 'sample_count': 1}
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+_LENGTH = struct.Struct('<I')
+
+
+def to_micros(moment):
+    """Return the number of microseconds between the epoch and an aware datetime."""
+    return (moment - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    """Return the aware UTC datetime of a number of microseconds since the epoch."""
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def write_segment(path, columns):
+    """Write a segment file atomically.
+    Args:
+        path (string): Destination of the segment.
+        columns (dict): List of values for every name of `COLUMNS`,
+            `usage_at` given in microseconds since the epoch.
+    Returns:
+        Returns the size of the file in bytes.
+    """
+    rows = len(columns['id'])
+    header = {'version': SEGMENT_FORMAT_VERSION, 'rows': rows, 'byteorder': sys.byteorder, 'columns': []}
+    blobs = []
+    offset = 0
+    for name, typecode in COLUMNS:
+        values = columns[name]
+        if name in NULLABLE:
+            values = [math.nan if value is None else value for value in values]
+        blob = zlib.compress(array(typecode, values).tobytes(), 6)
+        header['columns'].append({'name': name, 'type': typecode, 'offset': offset, 'size': len(blob)})
+        blobs.append(blob)
+        offset += len(blob)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as segment_file:
+        segment_file.write(MAGIC + _LENGTH.pack(len(header_bytes)) + header_bytes)
+        for blob in blobs:
+            segment_file.write(blob)
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+class Segment:
+    """Read-only, memory-mapped view of a segment file.
+    Attributes:
+        rows (int): Number of Usages in the segment.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:4] != MAGIC:
+            self.close()
+            raise ValueError('{} is not a usage segment.'.format(path))
+        header_length, = _LENGTH.unpack_from(self._map, 4)
+        self._data_offset = 8 + header_length
+        header = json.loads(self._map[8:self._data_offset])
+        if not 1 <= header['version'] <= SEGMENT_FORMAT_VERSION:
+            self.close()
+            raise ValueError('Unsupported segment format version {}.'.format(header['version']))
+        self.rows = header['rows']
+        self._swap = header['byteorder'] != sys.byteorder
+        self._columns = {column['name']: column for column in header['columns']}
+
+    def column(self, name):
+        """Return the values of one column, None for missing nullable values."""
+        if name not in self._columns and name in DEFAULTS:
+            return [DEFAULTS[name]] * self.rows
+        meta = self._columns[name]
+        start = self._data_offset + meta['offset']
+        values = array(meta['type'])
+        values.frombytes(zlib.decompress(self._map[start:start + meta['size']]))
+        if self._swap:
+            values.byteswap()
+        if name in NULLABLE:
+            return [None if math.isnan(value) else value for value in values]
+        return values
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
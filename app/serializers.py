@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import pytz
+
+from datetime import datetime
+
 from django.contrib.auth.password_validation import validate_password
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
 from django.forms.models import model_to_dict
 from rest_framework import serializers
 
-from app.models import User, UsageTypes, Usage
+from app.changes import stamp_usages
+from app.controller import BATCH_MAX_REQUESTS, apply_effective_factors, bulk_create_usages, create_usage_type_factor
+from app.live import notify_usage_event, usage_payload
+from app.models import User, UsageAnomaly, UsageTypeFactor, UsageTypes, Usage
+from app.outbox import record_event
+from app.rollups import apply_usage_deltas, merge_deltas, period_of, usage_deltas
+from app.sharding import atomic, shard_for
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -25,12 +37,14 @@ class UserSerializer(serializers.ModelSerializer):
         """
         Create and return a `User` with an username and password.
         """
-        user = User.objects.create(
+        user = User(
             name=validated_data['name']
         )
 
         user.set_password(validated_data['password'])
-        user.save()
+        with atomic(shard_for(user.pk)):
+            user.save()
+            record_event(user.pk, 'user', 'created', name=user.name)
 
         return user
 
@@ -40,7 +54,9 @@ class UserSerializer(serializers.ModelSerializer):
         """
         instance.name = validated_data.get('name', instance.name)
 
-        instance.save()
+        with atomic(shard_for(instance.pk)):
+            instance.save()
+            record_event(instance.pk, 'user', 'updated', name=instance.name)
 
         return instance
 
@@ -82,6 +98,96 @@ class UsageTypesSerializer(serializers.ModelSerializer):
 
         return usage_type
 
+    def update(self, instance, validated_data):
+        """
+        Update and return a `UsageType`. A new factor is added as a factor
+        version effective now, so stored Usages keep their factor snapshot.
+        """
+        factor = float(validated_data.get('factor', instance.factor))
+        with transaction.atomic():
+            instance.name = validated_data.get('name', instance.name)
+            instance.unit = validated_data.get('unit', instance.unit)
+            changed = factor != instance.factor
+            instance.factor = factor
+            instance.save()
+            if changed:
+                create_usage_type_factor(instance.pk, factor, datetime.now(tz=pytz.utc))
+        return instance
+
+
+class UsageTypeFactorSerializer(serializers.ModelSerializer):
+    """Allows serialisation and deserialisation of `UsageTypeFactor` model objects.
+    Attributes:
+        factor (DecimalField): [Required, max_digits=10, decimal_places=5].
+        valid_from (DateTimeField): [Required].
+        valid_to (DateTimeField): [Optional].
+    """
+    factor = serializers.DecimalField(max_digits=10, decimal_places=5, required=True)
+    valid_from = serializers.DateTimeField(required=True)
+    valid_to = serializers.DateTimeField(required=False, allow_null=True)
+
+    class Meta:
+        model = UsageTypeFactor
+        fields = ('id', 'factor', 'valid_from', 'valid_to')
+
+    def create(self, validated_data):
+        """
+        Create and return a `UsageTypeFactor`, queueing the recomputation of
+        the Usages it covers as `self.job`.
+        """
+        version, self.job = create_usage_type_factor(
+            self.context['usage_type_id'],
+            float(validated_data['factor']),
+            validated_data['valid_from'],
+            validated_data.get('valid_to'),
+        )
+        return version
+
+
+class PrefetchedSlugRelatedField(serializers.SlugRelatedField):
+    """SlugRelatedField that first looks up the objects prefetched by its
+    list serializer, so validating a batch does not query once per row."""
+
+    def to_internal_value(self, data):
+        prefetched = self.context.get('prefetched', {}).get(self.field_name, {})
+        try:
+            return prefetched[self.slug_key(data)]
+        except (KeyError, TypeError, ValueError, DjangoValidationError):
+            return super().to_internal_value(data)
+
+    def slug_key(self, data):
+        return self.get_queryset().model._meta.get_field(self.slug_field).to_python(data)
+
+
+class UsageListSerializer(serializers.ListSerializer):
+    """Creates a batch of `Usage` objects with a single bulk insert."""
+
+    def to_internal_value(self, data):
+        """Fetch the related objects of the whole batch with one query per field."""
+        if isinstance(data, list):
+            prefetched = self._context.setdefault('prefetched', {})
+            for name, field in self.child.fields.items():
+                if isinstance(field, PrefetchedSlugRelatedField):
+                    prefetched[name] = _prefetch(field, [row.get(name) for row in data if isinstance(row, dict)])
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        """
+        Create and return the `Usage` objects of the batch.
+        """
+        return bulk_create_usages(validated_data)
+
+
+def _prefetch(field, values):
+    keys = set()
+    for value in values:
+        try:
+            keys.add(field.slug_key(value))
+        except (TypeError, ValueError, DjangoValidationError):
+            continue
+    objects = field.get_queryset().filter(**{'{}__in'.format(field.slug_field): keys})
+    return {getattr(obj, field.slug_field): obj for obj in objects}
+
 
 class UsageSerializer(serializers.ModelSerializer):
     """Allows serialisation and deserialisation of `UsageType` model objects.
@@ -90,34 +196,155 @@ class UsageSerializer(serializers.ModelSerializer):
         usage_type_id (SlugRelatedField):
         usage_at (DateTimeField): [Required, Write_only].
         amount (DecimalField): [Required, Write_only].
+        idempotency_key (CharField): [Optional, Write_only].
     """
-    user_id = serializers.SlugRelatedField(queryset=User.objects.all(), slug_field='id')
-    usage_type_id = serializers.SlugRelatedField(queryset=UsageTypes.objects.all(), slug_field='id')
+    user_id = PrefetchedSlugRelatedField(queryset=User.objects.all(), slug_field='id')
+    usage_type_id = PrefetchedSlugRelatedField(queryset=UsageTypes.objects.all(), slug_field='id')
     usage_at = serializers.DateTimeField(write_only=True, required=True)
     amount = serializers.DecimalField(max_digits=10, decimal_places=5, write_only=True, required=True)
+    idempotency_key = serializers.CharField(write_only=True, required=False, allow_null=True, max_length=64)
 
     class Meta:
         model = Usage
-        fields = ('user_id', 'usage_type_id', 'usage_at', 'amount')
+        fields = ('user_id', 'usage_type_id', 'usage_at', 'amount', 'idempotency_key')
+        list_serializer_class = UsageListSerializer
 
     def to_representation(self, instance):
-        """Return a serialised dict containing `Usage` data"""
+        """Return a serialised dict containing `Usage` data, trimmed to the
+        sparse fieldset in `context['fields']` when there is one."""
+        if self.context.get('fields'):
+            return self.to_sparse_representation(instance, self.context['fields'])
         ret = super().to_representation(instance)
         ret['user'] = model_to_dict(instance.user_id, fields='name')
         ret['user']['id'] = instance.user_id.id
         ret['usage'] = model_to_dict(instance.usage_type_id)
         ret['usage']['usage_at'] = instance.usage_at
         ret['usage']['amount'] = instance.amount
+        ret['usage']['emissions'] = instance.emissions
+        ret['usage']['resolution'] = instance.get_resolution_display()
+        ret['usage']['sample_count'] = instance.sample_count
         del (ret['user_id'])
         del (ret['usage_type_id'])
         return ret
 
+    def to_sparse_representation(self, instance, fields):
+        """Return the requested fields of a `Usage` in the layout of `to_representation`,
+        only touching the related objects when `user` or `usage_type` are requested."""
+        ret, usage = {}, {}
+        if 'id' in fields:
+            ret['id'] = instance.id
+        if 'user' in fields:
+            ret['user'] = {'name': instance.user_id.name, 'id': instance.user_id_id}
+        if 'usage_type' in fields:
+            usage.update(model_to_dict(instance.usage_type_id))
+        elif 'usage_type_id' in fields:
+            usage['id'] = instance.usage_type_id_id
+        for name in ('usage_at', 'amount', 'emissions', 'resolution', 'sample_count'):
+            if name in fields:
+                usage[name] = instance.get_resolution_display() if name == 'resolution' else getattr(instance, name)
+        if usage:
+            ret['usage'] = usage
+        return ret
+
+    def create(self, validated_data):
+        """
+        Create and return a `Usage` with its emissions computed from the factor
+        effective at `usage_at`, or the stored one if its idempotency key was seen.
+        """
+        return bulk_create_usages([validated_data])[0]
+
     def update(self, instance, validated_data):
+        """
+        Update and return updated `Usage`.
+        The factor snapshot is only resolved again when the usage type or
+        `usage_at` changes.
+        """
+        removed = usage_deltas([instance], sign=-1)
+        previous = usage_payload(instance)
+        usage_type = validated_data.get('usage_type_id', instance.usage_type_id)
+        usage_at = validated_data.get('usage_at', instance.usage_at)
+        refresh_factor = instance.factor is None or usage_type.pk != instance.usage_type_id_id \
+            or usage_at != instance.usage_at
+
         instance.user_id = validated_data.get('user_id', instance.user_id)
-        instance.usage_type_id = validated_data.get('usage_type_id', instance.usage_type_id)
-        instance.usage_at = validated_data.get('usage_at', instance.usage_at)
+        instance.usage_type_id = usage_type
+        instance.usage_at = usage_at
         instance.amount = validated_data.get('amount', instance.amount)
+        if refresh_factor:
+            apply_effective_factors([instance])
+        else:
+            instance.apply_factor(instance.factor)
 
-        instance.save()
+        with atomic(savepoint=False):
+            stamp_usages([instance])
+            instance.save()
+            apply_usage_deltas(merge_deltas(removed, usage_deltas([instance])))
+            notify_usage_event(instance.user_id_id, 'updated', {period_of(previous['usage_at']), period_of(usage_at)},
+                               count=1, usages=[usage_payload(instance, previous)])
+            record_event(instance.user_id_id, 'usage', 'updated', usages=[usage_payload(instance)])
 
         return instance
+
+
+class UsageBulkUpdateSerializer(serializers.Serializer):
+    """Validates the changes applied by a bulk update of `Usage` objects.
+    Attributes:
+        usage_type_id (PrimaryKeyRelatedField): [Optional]. New UsageType.
+        amount (DecimalField): [Optional]. New amount.
+    """
+    usage_type_id = serializers.PrimaryKeyRelatedField(queryset=UsageTypes.objects.all(), required=False)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=5, required=False)
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError('Expected usage_type_id or amount.')
+        return attrs
+
+
+class EmissionsBudgetSerializer(serializers.Serializer):
+    """Validates the monthly emissions budget of a User for a UsageType.
+    Attributes:
+        usage_type_id (PrimaryKeyRelatedField): [Required].
+        limit (FloatField): [Required, min_value=0]. Emissions allowed per calendar month.
+    """
+    usage_type_id = serializers.PrimaryKeyRelatedField(queryset=UsageTypes.objects.all())
+    limit = serializers.FloatField(min_value=0)
+
+
+class UsageAnomalySerializer(serializers.ModelSerializer):
+    """Serialises `UsageAnomaly` model objects, read only."""
+    usage_type_id = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    class Meta:
+        model = UsageAnomaly
+        fields = ('id', 'usage_id', 'usage_type_id', 'usage_at', 'amount', 'expected', 'score', 'detected_at')
+        read_only_fields = fields
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    """Validates one sub-request of a batch.
+    Attributes:
+        method (ChoiceField): [Required]. HTTP method of the sub-request.
+        path (CharField): [Required]. Route of `app/urls.py`, with an optional query string.
+        body (JSONField): [Optional]. JSON body of the sub-request.
+        headers (DictField): [Optional]. Extra headers, such as `Idempotency-Key`.
+    """
+    method = serializers.ChoiceField(choices=('GET', 'POST', 'PUT', 'PATCH', 'DELETE'))
+    path = serializers.CharField(max_length=2000)
+    body = serializers.JSONField(required=False, allow_null=True)
+    headers = serializers.DictField(child=serializers.CharField(), required=False)
+
+
+class BatchSerializer(serializers.Serializer):
+    """Validates a batch of sub-requests.
+    Attributes:
+        requests (BatchOperationSerializer): [Required]. At most BATCH_MAX_REQUESTS sub-requests.
+        atomic (BooleanField): [Optional]. Run all the sub-requests in one transaction.
+    """
+    requests = BatchOperationSerializer(many=True, allow_empty=False)
+    atomic = serializers.BooleanField(default=False)
+
+    def validate_requests(self, value):
+        if len(value) > BATCH_MAX_REQUESTS:
+            raise serializers.ValidationError('At most {} requests per batch.'.format(BATCH_MAX_REQUESTS))
+        return value
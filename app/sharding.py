@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""Horizontal sharding of the per-user Usage data.
+The Usages of a User, and everything derived from them per user (running
+totals, leaderboard entries, tombstones and archive segments), live on one
+of the databases listed in USAGE_SHARDS, picked by a jump consistent hash of
+the user id. Growing from N to N + 1 shards only moves about 1 / (N + 1) of
+the Users, all of them to the new shard.
+
+Users and UsageTypes are reference tables: the primary ('default', always the
+first shard) holds them and every save or delete is copied to the other
+shards, so foreign keys and joins keep working inside a shard. Everything
+else (factor versions, jobs, sketches) stays on the primary, except the
+change counters, which every shard keeps for its own writes (see app/changes.py).
+
+`ShardRouter` sends the queries of sharded models to the shard of the
+current context (`use_shard`), or to the shard owning the instance being
+saved. Functions taking a `user_id` enter the shard of that User with
+`on_user_shard`, and admin-wide reads visit every shard with `scatter`.
+With a single shard the router steps aside and nothing changes.
+
+Locally, PLANETLY_SQLITE_SHARDS=N adds N - 1 SQLite shards next to the
+primary; `manage.py rebalance_shards` moves the data of Users whose owning
+shard changed.
+"""
+import contextvars
+import functools
+import inspect
+import uuid
+
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Max
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_save, pre_delete
+
+from app.models import (
+    BudgetEvent,
+    ChangeCounter,
+    EmissionsBudget,
+    OutboxEvent,
+    Usage,
+    UsageAnomaly,
+    UsageArchiveSegment,
+    UsagePeriodTotal,
+    UsageStatistic,
+    UsageTombstone,
+    UsageTypes,
+    User,
+    UserPeriodEmissions
+)
+
+USAGE_ID_COUNTER = 'usage_id'
+USAGE_ID_BLOCK_SIZE = 10000
+SHARD_MOVE_CHUNK_SIZE = 1000
+SHARDED_MODELS = (Usage, UsagePeriodTotal, UserPeriodEmissions, UsageTombstone, UsageArchiveSegment, UsageStatistic,
+                  UsageAnomaly, EmissionsBudget, BudgetEvent, OutboxEvent)
+REFERENCE_MODELS = (User, UsageTypes)
+
+_current = contextvars.ContextVar('usage_shard', default=None)
+
+
+def jump_hash(key, buckets):
+    """Map a 64-bit integer key to one of `buckets` (Lamping and Veach's jump consistent hash).
+    Adding a bucket only moves keys to the new bucket:
+        >>> [jump_hash(key, 3) for key in range(8)]
+        [0, 0, 0, 2, 1, 1, 2, 0]
+        >>> [jump_hash(key, 4) for key in range(8)]
+        [0, 0, 3, 3, 1, 1, 2, 0]
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_aliases():
+    """Return the database aliases of the shards, the primary first."""
+    return settings.USAGE_SHARDS
+
+
+def is_sharded():
+    return len(settings.USAGE_SHARDS) > 1
+
+
+def shard_for(user_id):
+    """Return the alias of the shard owning a User.
+        Args:
+            user_id (string): [Required]. UUID of the User, as a string or UUID.
+        Returns (string):
+            Returns a database alias of USAGE_SHARDS.
+        Raises:
+            ValueError: If `user_id` is not a UUID.
+    """
+    shards = settings.USAGE_SHARDS
+    if len(shards) == 1:
+        return shards[0]
+    key = (user_id if isinstance(user_id, uuid.UUID) else uuid.UUID(str(user_id))).int & 0xFFFFFFFFFFFFFFFF
+    return shards[jump_hash(key, len(shards))]
+
+
+def current_shard():
+    """Return the alias of the shard of the current context, the primary outside any."""
+    return _current.get() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_shard(alias):
+    """Route the queries of sharded models to `alias` inside the block."""
+    token = _current.set(alias)
+    try:
+        yield alias
+    finally:
+        _current.reset(token)
+
+
+def on_user_shard(func):
+    """Decorator running `func` on the shard of its `user_id` argument, when given."""
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        user_id = signature.bind_partial(*args, **kwargs).arguments.get('user_id')
+        if user_id is None:
+            return func(*args, **kwargs)
+        with use_shard(shard_for(user_id)):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def user_queryset(model, user_id):
+    """Return the queryset of a sharded model pinned to the shard of a User.
+    Use it for querysets evaluated after the current context is left.
+    """
+    if not is_sharded():
+        return model.objects.all()
+    return model.objects.using(shard_for(user_id))
+
+
+@contextmanager
+def atomic(*aliases, savepoint=True):
+    """`transaction.atomic` on the primary and on the given shards, the current one by default.
+    Usable as a decorator with `@atomic()`. The transactions of several
+    databases commit one after the other, innermost (shards) first. Blocks
+    nested in another one only need `savepoint=False` when an error is
+    never caught inside the enclosing block, which saves two statements.
+    """
+    with ExitStack() as stack:
+        stack.enter_context(transaction.atomic(savepoint=savepoint))
+        for alias in aliases or (current_shard(),):
+            if alias != DEFAULT_DB_ALIAS:
+                stack.enter_context(transaction.atomic(using=alias, savepoint=savepoint))
+        yield
+
+
+def scatter(func):
+    """Call `func()` once on every shard and return the list of its results."""
+    results = []
+    for alias in shard_aliases():
+        with use_shard(alias):
+            results.append(func())
+    return results
+
+
+def group_by_shard(items, owner):
+    """Return a dict of the items owned by each shard.
+        Args:
+            items (iterable): [Required].
+            owner (callable): [Required]. Returns the user id owning an item.
+        Returns (dict):
+            Returns lists of items, in their original order, keyed by shard alias.
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_for(owner(item)), []).append(item)
+    return groups
+
+
+def owner_of(instance):
+    """Return the user id owning an instance of a sharded model."""
+    return getattr(instance, instance._meta.get_field('user_id').attname)
+
+
+class ShardRouter:
+    """Database router sending the sharded models to the shard of the current
+    context or of the User owning the instance."""
+
+    def db_for_read(self, model, **hints):
+        if model not in SHARDED_MODELS or not is_sharded():
+            return None
+        instance = hints.get('instance')
+        if isinstance(instance, SHARDED_MODELS) and owner_of(instance) is not None:
+            return shard_for(owner_of(instance))
+        if isinstance(instance, User):
+            return shard_for(instance.pk)
+        return current_shard()
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in shard_aliases():
+            return True
+        return None
+
+
+def allocate_usage_ids(usages):
+    """Give new Usages primary keys that are unique across shards.
+    Every shard hands out ids from a block of USAGE_ID_BLOCK_SIZE ids, or
+    more for a larger batch, that it reserves from the `usage_id`
+    ChangeCounter of the primary once the previous block is used up. The
+    primary counter is seeded with the highest id stored on any shard.
+    Inserts thus only wait for the inserts of the same shard. Does nothing
+    with a single shard.
+        Args:
+            usages (list): [Required]. Unsaved Usage models.
+        Returns (list):
+            Returns the same Usage models.
+    """
+    if not usages or not is_sharded():
+        return usages
+    alias = current_shard()
+    name = '{}:{}'.format(USAGE_ID_COUNTER, alias)
+    with transaction.atomic(using=alias):
+        ChangeCounter.objects.using(alias).get_or_create(name=name)
+        counter = ChangeCounter.objects.using(alias).select_for_update().get(name=name)
+        if counter.limit is None or counter.value + len(usages) > counter.limit:
+            size = max(len(usages), USAGE_ID_BLOCK_SIZE)
+            counter.value = _reserve_usage_id_block(size) - 1
+            counter.limit = counter.value + size
+        first = counter.value + 1
+        counter.value += len(usages)
+        counter.save(using=alias, update_fields=['value', 'limit'])
+    for offset, usage in enumerate(usages):
+        usage.pk = first + offset
+    return usages
+
+
+@transaction.atomic
+def _reserve_usage_id_block(size):
+    if not ChangeCounter.objects.filter(name=USAGE_ID_COUNTER).exists():
+        highest = max(Usage.objects.using(alias).aggregate(highest=Max('id'))['highest'] or 0
+                      for alias in shard_aliases())
+        ChangeCounter.objects.get_or_create(name=USAGE_ID_COUNTER, defaults={'value': highest})
+    counter = ChangeCounter.objects.select_for_update().get(name=USAGE_ID_COUNTER)
+    first = counter.value + 1
+    counter.value += size
+    counter.save(update_fields=['value'])
+    return first
+
+
+def _reference_values(instance):
+    return {field.attname: getattr(instance, field.attname)
+            for field in instance._meta.concrete_fields if not field.primary_key}
+
+
+def replicate_reference(sender, instance, using, **kwargs):
+    """post_save receiver copying a User or UsageType saved on the primary to the other shards.
+    Raw saves are copied too, so fixtures loaded with `loaddata` reach every
+    shard; copies are updated in place, so loading a fixture again is harmless.
+    """
+    if using != DEFAULT_DB_ALIAS or not is_sharded():
+        return
+    values = _reference_values(instance)
+    for alias in shard_aliases():
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+        copies = sender._base_manager.using(alias).filter(pk=instance.pk)
+        if not copies.update(**values):
+            sender._base_manager.using(alias).create(pk=instance.pk, **values)
+
+
+def delete_reference(sender, instance, using, **kwargs):
+    """pre_delete receiver deleting the copies of a User or UsageType from the other shards.
+    Every shard is checked before any copy is deleted, so a UsageType still
+    used on one shard is kept everywhere (RestrictedError).
+    """
+    if using != DEFAULT_DB_ALIAS or not is_sharded():
+        return
+    collectors = []
+    for alias in shard_aliases():
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+        collector = Collector(using=alias)
+        collector.collect(sender._base_manager.using(alias).filter(pk=instance.pk))
+        collectors.append(collector)
+    for collector in collectors:
+        collector.delete()
+
+
+def connect_reference_replication():
+    for model in REFERENCE_MODELS:
+        post_save.connect(replicate_reference, sender=model, dispatch_uid='replicate_{}'.format(model.__name__))
+        pre_delete.connect(delete_reference, sender=model, dispatch_uid='delete_{}'.format(model.__name__))
+
+
+def sync_reference_tables(chunk_size=SHARD_MOVE_CHUNK_SIZE):
+    """Copy every User and UsageType of the primary to the other shards.
+        Args:
+            chunk_size (int): [Optional]. Rows copied per query.
+        Returns (int):
+            Number of rows written.
+    """
+    written = 0
+    for alias in shard_aliases():
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+        for model in REFERENCE_MODELS:
+            fields = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+            rows = model._base_manager.using(DEFAULT_DB_ALIAS).order_by('pk')
+            for chunk in _chunks(rows.iterator(chunk_size=chunk_size), chunk_size):
+                copies = model._base_manager.using(alias)
+                existing = set(copies.filter(pk__in=[row.pk for row in chunk]).values_list('pk', flat=True))
+                copies.bulk_create([row for row in chunk if row.pk not in existing])
+                copies.bulk_update([row for row in chunk if row.pk in existing], fields)
+                written += len(chunk)
+    return written
+
+
+def misplaced_users(alias):
+    """Return the ids of the Users with data on shard `alias` that another shard owns."""
+    user_ids = set()
+    for model in SHARDED_MODELS:
+        user_ids.update(model._base_manager.using(alias).order_by().values_list('user_id', flat=True).distinct())
+    return sorted(user_id for user_id in user_ids if shard_for(user_id) != alias)
+
+
+def move_user(user_id, source, target, chunk_size=SHARD_MOVE_CHUNK_SIZE):
+    """Move all the sharded rows of a User from one shard to another, in one
+    transaction on each. Usages keep their ids; other rows get new ones. The
+    change counters of the target are raised to the ones of the source, so
+    the change sequence of the User keeps increasing.
+        Args:
+            user_id (string): [Required].
+            source (string): [Required]. Alias of the shard holding the rows.
+            target (string): [Required]. Alias of the shard owning the User.
+            chunk_size (int): [Optional]. Rows copied per INSERT statement.
+        Returns (int):
+            Number of rows moved.
+    """
+    moved = 0
+    with transaction.atomic(using=target), transaction.atomic(using=source):
+        for name, value in ChangeCounter.objects.using(source).exclude(name__startswith=USAGE_ID_COUNTER) \
+                .values_list('name', 'value'):
+            counter, _ = ChangeCounter.objects.using(target).select_for_update().get_or_create(
+                name=name, defaults={'value': value})
+            if counter.value < value:
+                counter.value = value
+                counter.save(using=target, update_fields=['value'])
+        for model in SHARDED_MODELS:
+            rows = model._base_manager.using(source).filter(user_id=user_id)
+            for chunk in _chunks(rows.order_by('pk').iterator(chunk_size=chunk_size), chunk_size):
+                if model is not Usage:
+                    for row in chunk:
+                        row.pk = None
+                model._base_manager.using(target).bulk_create(chunk)
+                moved += len(chunk)
+            rows.delete()
+    return moved
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
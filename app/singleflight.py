@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Request coalescing ("singleflight") for expensive reads.
+Concurrent calls of a coalesced function with the same arguments in one
+process share a single execution: the first caller runs it and the others
+wait for its result, or its exception. Nothing is kept once the call
+returns, so this is not a cache. Calls made inside a transaction, on any
+database, always run on their own, so a caller still sees its uncommitted
+writes; so do calls of a request pinned to the primary (see
+`app.replicas.reads_own_writes`), which must see writes committed after an
+in-flight call started. Results are shared between callers and must not
+be mutated.
+
+Example:
+    >>> calls = []
+    >>> @coalesce
+    ... def double(value):
+    ...     calls.append(value)
+    ...     return value * 2
+    >>> double(21), calls
+    (42, [21])
+"""
+import functools
+import threading
+
+from django.db import connections
+
+from app.replicas import reads_own_writes
+
+
+class _Call:
+    """One in-flight execution and the callers waiting for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class Group:
+    """Table of in-flight calls, keyed by function and arguments.
+    Attributes:
+        shared (int): Number of calls answered by another caller's execution.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Return `func(*args, **kwargs)`, joining the execution already running under `key` if any."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self, key):
+        return key in self._calls
+
+
+group = Group()
+
+
+def coalesce(func):
+    """Decorator sharing concurrent identical calls of `func` through `group`."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if reads_own_writes() or any(connection.in_atomic_block for connection in connections.all()):
+            return func(*args, **kwargs)
+        key = (func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return func(*args, **kwargs)
+        return group.do(key, func, *args, **kwargs)
+    return wrapper
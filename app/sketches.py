@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""Mergeable quantile sketch for usage distributions.
+A log-bucketed histogram in the style of DDSketch: every positive value is
+counted in the bucket `ceil(log(value) / log(gamma))`, which bounds the
+relative error of any quantile by `relative_accuracy`. Unlike a t-digest,
+bucket counts can be decremented, so a user's period total can be moved
+from its old bucket to its new one when a reading changes.
+
+Example:
+    >>> sketch = QuantileSketch()
+    >>> for value in range(1, 101):
+    ...     sketch.add(value)
+    >>> round(sketch.quantile(0.5))
+    50
+    >>> sketch.remove(100)
+    >>> sketch.count
+    99
+    >>> QuantileSketch.from_bytes(sketch.to_bytes()).count
+    99
+"""
+import math
+import struct
+import zlib
+
+from array import array
+
+SKETCH_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<BdQiI')
+
+
+class QuantileSketch:
+    """Log-bucketed histogram with bounded relative error.
+    Attributes:
+        relative_accuracy (float): Maximum relative error of a quantile.
+        max_buckets (int): Lowest buckets are collapsed beyond this size.
+        zero_count (int): Number of values lower than or equal to zero.
+        count (int): Total number of values.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.min_key = None
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.buckets.values())
+
+    def key(self, value):
+        """Return the bucket key of a positive `value`."""
+        key = math.ceil(math.log(value) / self._log_gamma)
+        if self.min_key is not None and key < self.min_key:
+            return self.min_key
+        return key
+
+    def add(self, value, count=1):
+        """Count `value` `count` times."""
+        if value <= 0:
+            self.zero_count += count
+            return
+        key = self.key(value)
+        self.buckets[key] = self.buckets.get(key, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def remove(self, value, count=1):
+        """Forget `count` occurrences of a previously added `value`."""
+        if value <= 0:
+            self.zero_count = max(0, self.zero_count - count)
+            return
+        key = self.key(value)
+        remaining = self.buckets.get(key, 0) - count
+        if remaining > 0:
+            self.buckets[key] = remaining
+        else:
+            self.buckets.pop(key, None)
+
+    def merge(self, other):
+        """Add all the values counted by `other` to this sketch."""
+        if other.gamma != self.gamma:
+            raise ValueError('Sketches with different accuracies cannot be merged.')
+        self.zero_count += other.zero_count
+        for key, count in other.buckets.items():
+            if self.min_key is not None and key < self.min_key:
+                key = self.min_key
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def quantile(self, q):
+        """Return the estimated value at quantile `q` (0 <= q <= 1), or None if empty."""
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def rank(self, value):
+        """Return the estimated fraction of values below `value`, counting
+        half of the values that share its bucket. None if the sketch is empty."""
+        total = self.count
+        if not total:
+            return None
+        if value <= 0:
+            return self.zero_count / 2 / total
+        key = self.key(value)
+        below = self.zero_count + sum(count for bucket, count in self.buckets.items() if bucket < key)
+        return (below + self.buckets.get(key, 0) / 2) / total
+
+    def to_bytes(self):
+        """Return a compact, compressed binary encoding of the sketch."""
+        keys = sorted(self.buckets)
+        header = _HEADER.pack(SKETCH_FORMAT_VERSION, self.relative_accuracy, self.zero_count,
+                              self.min_key if self.min_key is not None else -2 ** 31, len(keys))
+        body = array('i', keys).tobytes() + array('Q', [self.buckets[key] for key in keys]).tobytes()
+        return zlib.compress(header + body)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Rebuild a sketch from the output of `to_bytes`."""
+        data = zlib.decompress(data)
+        version, relative_accuracy, zero_count, min_key, size = _HEADER.unpack_from(data)
+        if version != SKETCH_FORMAT_VERSION:
+            raise ValueError('Unsupported sketch format version {}.'.format(version))
+        sketch = cls(relative_accuracy=relative_accuracy)
+        sketch.zero_count = zero_count
+        sketch.min_key = None if min_key == -2 ** 31 else min_key
+        keys = array('i')
+        counts = array('Q')
+        offset = _HEADER.size
+        keys.frombytes(data[offset:offset + size * keys.itemsize])
+        counts.frombytes(data[offset + size * keys.itemsize:])
+        sketch.buckets = dict(zip(keys, counts))
+        return sketch
+
+    def _collapse(self):
+        keys = sorted(self.buckets)
+        overflow = keys[:len(keys) - self.max_buckets + 1]
+        self.min_key = overflow[-1]
+        self.buckets[self.min_key] = sum(self.buckets.pop(key) for key in overflow)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""Admission control: token-bucket throttles and an in-flight request limit.
+Every client has a token bucket per throttle scope. A bucket holds up to the
+number of requests of its rate (`'600/min'` allows bursts of 600) and refills
+continuously at that rate; a request takes one token or is answered 429 with
+`Retry-After` set to the time until the next token. Two DRF throttles are
+installed by default:
+    1. UserRateThrottle - one 'user' bucket per client across all endpoints.
+    2. EndpointRateThrottle - one bucket per client and `throttle_scope` of
+       the view, e.g. 'ingest' or 'reporting'.
+A view standing for several requests, such as the batch endpoint, declares
+`get_throttle_costs(request)`: the number of requests per endpoint scope,
+which take as many tokens at once, from the 'user' bucket too. Its
+sub-requests are then marked `charged_by_batch` and not throttled again.
+Clients are authenticated users, or the remote address otherwise. Buckets
+live in the store set by THROTTLE_STORE:
+    1. MemoryBucketStore - per process, nothing shared.
+    2. SQLiteBucketStore - one SQLite file shared by the processes of a host.
+
+`AdmissionControlMiddleware` caps the requests a process handles at once at
+MAX_IN_FLIGHT_REQUESTS; requests above the cap are answered 503 at once
+instead of queueing behind busy workers.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+STORE_PRUNE_INTERVAL = 1000
+
+
+def parse_rate(rate):
+    """Return the capacity and the refill rate per second of a rate such as '600/min'.
+        >>> parse_rate('600/min')
+        (600, 10.0)
+    """
+    count, period = rate.split('/')
+    return int(count), int(count) / DURATIONS[period[0]]
+
+
+def take_token(bucket, now, capacity, refill_rate, cost=1):
+    """Refill a bucket up to `now` and take `cost` tokens from it if it holds them.
+        Args:
+            bucket (tuple): [Required]. Stored `(tokens, updated_at)`, or None for a full bucket.
+            now (float): [Required]. Current time in seconds.
+            capacity (int): [Required]. Most tokens the bucket holds.
+            refill_rate (float): [Required]. Tokens added per second.
+            cost (int): [Optional]. Tokens taken by the request.
+        Returns (tuple):
+            Returns the new `(tokens, updated_at)` and the seconds to wait, 0 when the tokens were taken.
+    """
+    tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * refill_rate)
+    if tokens >= cost:
+        return (tokens - cost, now), 0
+    return (tokens, now), (cost - tokens) / refill_rate
+
+
+class MemoryBucketStore:
+    """Token buckets in a dict of the current process."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take(self, key, capacity, refill_rate, cost=1, now=None):
+        """Take `cost` tokens from the bucket `key` and return the seconds to wait, 0 when allowed."""
+        now = time.time() if now is None else now
+        with self._lock:
+            bucket, wait = take_token(self._buckets.get(key), now, capacity, refill_rate, cost)
+            self._buckets[key] = bucket + ((capacity - bucket[0]) / refill_rate + now,)
+            self._takes += 1
+            if self._takes % STORE_PRUNE_INTERVAL == 0:
+                # A full bucket is the same as no bucket.
+                for stale in [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]:
+                    del self._buckets[stale]
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBucketStore:
+    """Token buckets in a SQLite file, shared by every process opening it.
+    Each take is one short write transaction; the file is in WAL mode, so
+    readers never wait.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self._takes = 0
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                               'updated_at REAL NOT NULL, full_at REAL NOT NULL)')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, refill_rate, cost=1, now=None):
+        now = time.time() if now is None else now
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated_at FROM bucket WHERE key = ?', (key,)).fetchone()
+            (tokens, updated_at), wait = take_token(row, now, capacity, refill_rate, cost)
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)',
+                               (key, tokens, updated_at, (capacity - tokens) / refill_rate + now))
+            self._takes += 1
+            if self._takes % STORE_PRUNE_INTERVAL == 0:
+                connection.execute('DELETE FROM bucket WHERE full_at <= ?', (now,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def clear(self):
+        self.connection.execute('DELETE FROM bucket')
+
+
+_store = None
+
+
+def get_store():
+    """Return the bucket store configured by THROTTLE_STORE and THROTTLE_STORE_OPTIONS."""
+    global _store
+    if _store is None:
+        _store = import_string(settings.THROTTLE_STORE)(**settings.THROTTLE_STORE_OPTIONS)
+    return _store
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """DRF throttle taking one token per request from a bucket of the client.
+    The rate of a scope is read from DEFAULT_THROTTLE_RATES; a scope without
+    a rate is not throttled. A request costing more tokens than its bucket
+    holds takes all of them.
+    """
+    scope = None
+
+    def __init__(self):
+        self.wait_seconds = 0
+
+    def get_scope(self, request, view):
+        return self.scope
+
+    def get_costs(self, request, view):
+        """Return the tokens the request takes, keyed by scope."""
+        scope = self.get_scope(request, view)
+        return {scope: 1} if scope else {}
+
+    def get_client(self, request):
+        if request.user and request.user.is_authenticated:
+            return 'user:{}'.format(request.user.pk)
+        return 'ip:{}'.format(self.get_ident(request))
+
+    def allow_request(self, request, view):
+        if getattr(request, 'charged_by_batch', False):
+            return True
+        for scope, cost in self.get_costs(request, view).items():
+            rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope)
+            if rate is None:
+                continue
+            capacity, refill_rate = parse_rate(rate)
+            key = 'throttle:{}:{}'.format(scope, self.get_client(request))
+            self.wait_seconds = get_store().take(key, capacity, refill_rate, min(cost, capacity))
+            if self.wait_seconds:
+                return False
+        return True
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class UserRateThrottle(TokenBucketThrottle):
+    """Bucket of a client across all endpoints."""
+    scope = 'user'
+
+    def get_costs(self, request, view):
+        if hasattr(view, 'get_throttle_costs'):
+            return {self.scope: sum(view.get_throttle_costs(request).values())}
+        return super().get_costs(request, view)
+
+
+class EndpointRateThrottle(TokenBucketThrottle):
+    """Bucket of a client per `throttle_scope` of the view. The scope may be
+    a dict keyed by HTTP method, for views mixing ingest and reporting."""
+
+    def get_scope(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        if isinstance(scope, dict):
+            return scope.get(request.method)
+        return scope
+
+    def get_costs(self, request, view):
+        if hasattr(view, 'get_throttle_costs'):
+            return {scope: cost for scope, cost in view.get_throttle_costs(request).items() if scope}
+        return super().get_costs(request, view)
+
+
+class AdmissionControlMiddleware:
+    """Answer 503 with `Retry-After` when the process already handles
+    MAX_IN_FLIGHT_REQUESTS requests. Streamed bodies are not counted once
+    their view has returned."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        limit = settings.MAX_IN_FLIGHT_REQUESTS
+        with self._lock:
+            admitted = not limit or self.in_flight < limit
+            if admitted:
+                self.in_flight += 1
+        if not admitted:
+            response = HttpResponse(json.dumps({'detail': 'Server busy, retry later.'}),
+                                    status=503, content_type='application/json')
+            response['Retry-After'] = str(settings.IN_FLIGHT_RETRY_AFTER)
+            return response
+        try:
+            return self.get_response(request)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
@@ -8,8 +8,27 @@ urlpatterns = [
     path('user/', views.UsersAPIView.as_view(), name='users'),
     path('register/', views.RegisterView.as_view(), name='auth_register'),
     path('usage_types/', views.UsageTypesAPIView.as_view(), name='usage_types'),
+    path('leaderboard/', views.LeaderboardAPIView.as_view(), name='leaderboard'),
+    path('batch/', views.BatchAPIView.as_view(), name='batch'),
+    path('analytics/', views.CohortAnalyticsAPIView.as_view(), name='cohort_analytics'),
+    path('outbox/', views.OutboxAPIView.as_view(), name='outbox'),
     re_path(r'usage_type/(?P<usage_type_id>[^/]+)$', views.UsageTypeAPIView.as_view(), name='usage_type'),
+    re_path(r'usage_type/(?P<usage_type_id>[^/]+)/factors$', views.UsageTypeFactorsAPIView.as_view(),
+            name='usage_type_factors'),
+    re_path(r'factor_job/(?P<job_id>[^/]+)$', views.FactorJobAPIView.as_view(), name='factor_job'),
     re_path(r'user/(?P<user_id>[^/]+)$', views.UserAPIView.as_view(), name='user'),
     re_path(r'user/(?P<user_id>[^/]+)/usage/(?P<usage_id>[^/]+)/$', views.UsageAPIView.as_view(), name='usage'),
     re_path(r'user/(?P<user_id>[^/]+)/usage$', views.UsagesAPIView.as_view(), name='usages'),
+    re_path(r'user/(?P<user_id>[^/]+)/usage/totals$', views.UsageTotalsAPIView.as_view(), name='usage_totals'),
+    re_path(r'user/(?P<user_id>[^/]+)/usage/changes$', views.UsageChangesAPIView.as_view(), name='usage_changes'),
+    re_path(r'user/(?P<user_id>[^/]+)/usage/export$', views.UsageExportAPIView.as_view(), name='usage_export'),
+    re_path(r'user/(?P<user_id>[^/]+)/budgets$', views.EmissionsBudgetsAPIView.as_view(), name='budgets'),
+    re_path(r'user/(?P<user_id>[^/]+)/budgets/(?P<usage_type_id>[^/]+)$', views.EmissionsBudgetAPIView.as_view(),
+            name='budget'),
+    re_path(r'user/(?P<user_id>[^/]+)/usage/anomalies$', views.UsageAnomaliesAPIView.as_view(),
+            name='usage_anomalies'),
+    re_path(r'user/(?P<user_id>[^/]+)/usage/analytics$', views.UsageAnalyticsAPIView.as_view(),
+            name='usage_analytics'),
+    re_path(r'user/(?P<user_id>[^/]+)/usage_type/(?P<usage_type_id>[^/]+)/percentile$',
+            views.UsagePercentileAPIView.as_view(), name='usage_percentile'),
 ]
@@ -2,6 +2,10 @@
 
 import re
 
+from datetime import datetime
+
+from rest_framework.exceptions import ValidationError
+
 
 def sanitize_json_input(func):
     """Decorator for sanitizing JSON data.
@@ -27,3 +31,25 @@ def sanitize_json_input(func):
         return returned_value
     return wrapper
 
+
+class Echo:
+    """File-like object whose `write` returns the value, for streaming `csv.writer` output."""
+
+    def write(self, value):
+        return value
+
+
+def parse_period(value):
+    """Parse a month query parameter.
+    Args:
+        value (string): Month formatted as YYYY-MM.
+    Returns:
+        Returns a datetime of the first day of the month.
+    Raises:
+        ValidationError: If the value is missing or malformed.
+
+    """
+    try:
+        return datetime.strptime(value or '', '%Y-%m')
+    except ValueError:
+        raise ValidationError({'period': 'Expected a month formatted as YYYY-MM.'})
@@ -2,6 +2,8 @@
 ASGI config for planetly project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The live usage feed (`app/user/<id>/usage/stream`) is served here as
+Server-Sent Events; every other request goes to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
@@ -13,4 +15,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'planetly.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from app.live import LiveFeedApplication  # noqa: E402  (needs the app registry)
+
+application = LiveFeedApplication(django_application)
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
+
 from pathlib import Path
 from datetime import timedelta
 
@@ -44,10 +46,12 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'app.throttling.AdmissionControlMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'app.replicas.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -83,6 +87,40 @@ DATABASES = {
     }
 }
 
+# Read replicas receive the reads of safe-method requests (see app/replicas.py).
+# PLANETLY_SQLITE_REPLICAS=N adds N local SQLite replicas, refreshed from the
+# primary by `manage.py sync_replicas`.
+for replica in range(1, int(os.environ.get('PLANETLY_SQLITE_REPLICAS', 0)) + 1):
+    DATABASES['replica{}'.format(replica)] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.replica{}.sqlite3'.format(replica),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+# Usages and their per-user rollups are spread over USAGE_SHARDS by user id
+# (see app/sharding.py); the primary is always the first shard.
+# PLANETLY_SQLITE_SHARDS=N uses the primary and N - 1 local SQLite shards.
+# After changing it, run `manage.py rebalance_shards`.
+USAGE_SHARDS = ['default']
+for shard in range(1, int(os.environ.get('PLANETLY_SQLITE_SHARDS', 1))):
+    DATABASES['shard{}'.format(shard)] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.shard{}.sqlite3'.format(shard),
+    }
+    USAGE_SHARDS.append('shard{}'.format(shard))
+
+# WriteTrackingRouter comes first so writes routed to a shard also count.
+DATABASE_ROUTERS = ['app.replicas.WriteTrackingRouter', 'app.sharding.ShardRouter', 'app.replicas.ReplicaRouter']
+# Seconds a client that wrote keeps reading from the primary. Clients are
+# marked with a signed cookie and in REPLICA_STICKY_CACHE, which must be a
+# cache shared by all the server processes (Memcached, Redis) for clients
+# that do not keep cookies.
+REPLICA_STICKY_SECONDS = 5
+REPLICA_STICKY_CACHE = 'default'
+REPLICA_STICKY_COOKIE = 'replica_sticky'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -129,9 +167,30 @@ REST_FRAMEWORK = {
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
-    'PAGE_SIZE': 1
+    'PAGE_SIZE': 1,
+    # Token buckets per client (see app/throttling.py): 'user' covers every
+    # endpoint, the other scopes the views declaring them in `throttle_scope`.
+    'DEFAULT_THROTTLE_CLASSES': [
+        'app.throttling.UserRateThrottle',
+        'app.throttling.EndpointRateThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'user': '3000/min',
+        'ingest': '1200/min',
+        'reporting': '600/min',
+    },
 }
 
+# Store of the throttle buckets. 'app.throttling.MemoryBucketStore' counts per
+# process; to share the buckets between the workers of a host use
+# 'app.throttling.SQLiteBucketStore' with {'path': BASE_DIR / 'run' / 'throttle.sqlite3'}.
+THROTTLE_STORE = 'app.throttling.MemoryBucketStore'
+THROTTLE_STORE_OPTIONS = {}
+# Requests handled at once by a process before new ones get a 503.
+MAX_IN_FLIGHT_REQUESTS = 64
+# Retry-After (seconds) of those 503 responses.
+IN_FLIGHT_RETRY_AFTER = 1
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=5),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
@@ -165,3 +224,55 @@ SIMPLE_JWT = {
 }
 
 AUTH_USER_MODEL = 'app.User'
+
+# Usages older than USAGE_RETENTION_DAYS are moved by `manage.py archive_usage`
+# to columnar segment files under USAGE_ARCHIVE_DIR.
+USAGE_RETENTION_DAYS = 730
+USAGE_ARCHIVE_DIR = BASE_DIR / 'archive'
+
+# `manage.py compact_usage` replaces raw readings older than the given number
+# of days with hourly, then daily, aggregate Usages.
+USAGE_COMPACTION_POLICY = (
+    ('hour', 30),
+    ('day', 365),
+)
+
+# Broker carrying the live usage feed (`app/user/<id>/usage/stream`, served by
+# planetly/asgi.py) between processes. `app.live.LocalBroker` only reaches
+# subscribers of the publishing process; with several ASGI workers on one host
+# use 'app.live.SocketBroker' with {'path': BASE_DIR / 'run' / 'feed'}.
+USAGE_FEED_BROKER = 'app.live.LocalBroker'
+USAGE_FEED_BROKER_OPTIONS = {}
+
+# Streaming anomaly detection on ingest (see app/anomalies.py): a reading more
+# than ANOMALY_THRESHOLD standard deviations from the weighted mean of its user
+# and usage type, after ANOMALY_MIN_SAMPLES readings, is recorded as a UsageAnomaly.
+ANOMALY_EWMA_ALPHA = 0.05
+ANOMALY_THRESHOLD = 6.0
+ANOMALY_MIN_SAMPLES = 10
+ANOMALY_MIN_STD_RATIO = 0.25
+# Series kept in memory per process, and seconds between their checkpoints.
+ANOMALY_STORE_SIZE = 100000
+ANOMALY_CHECKPOINT_SECONDS = 60
+
+# Shares of an emissions budget whose crossing is recorded as a BudgetEvent.
+BUDGET_THRESHOLDS = (0.5, 0.8, 1.0)
+
+# Transactional outbox of Usage and User changes (see app/outbox.py), delivered
+# by `manage.py dispatch_outbox`. 'app.outbox.FileSink' appends the events to a
+# JSON lines file; 'app.outbox.HttpSink' with {'url': ...} POSTs each batch.
+OUTBOX_SINK = 'app.outbox.FileSink'
+OUTBOX_SINK_OPTIONS = {'path': BASE_DIR / 'run' / 'outbox.jsonl'}
+OUTBOX_BATCH_SIZE = 500
+# Seconds before the first retry of a failed batch, doubled per attempt up to the maximum.
+OUTBOX_RETRY_SECONDS = 1
+OUTBOX_MAX_RETRY_SECONDS = 300
+
+# Spool directory of the usage files loaded by `manage.py ingest_spool` (see
+# app/ingest.py): files dropped in its `incoming/` directory are loaded in
+# batches of INGEST_BATCH_SIZE records by INGEST_WORKERS processes.
+INGEST_SPOOL_DIR = BASE_DIR / 'spool'
+INGEST_BATCH_SIZE = 1000
+INGEST_WORKERS = 4
+# User and usage type names cached per worker process.
+INGEST_NAME_CACHE_SIZE = 10000
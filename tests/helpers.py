@@ -24,7 +24,9 @@ def api_client_admin():
 
 
 def create_usage(user_id, usage_type_id, usage_at, amount):
-    usage = Usage.objects.create(user_id=user_id, usage_type_id=usage_type_id, usage_at=usage_at, amount=amount)
+    usage = Usage(user_id=user_id, usage_type_id=usage_type_id, usage_at=usage_at, amount=amount)
+    usage.apply_factor(usage_type_id.factor)
+    usage.save()
     return usage
 
 
@@ -0,0 +1,63 @@
+import pytest
+
+from django.urls import reverse
+
+from app.admin import EstimatedCountPaginator
+from app.models import Usage, UsagePeriodTotal
+from tests.helpers import create_usage, create_usage_types, create_user, get_time_now
+
+
+@pytest.fixture
+def admin_client(client, superuser):
+    client.force_login(superuser)
+    return client
+
+
+@pytest.mark.django_db
+class TestAdmin:
+
+    def create_usages(self, count):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        for amount in range(count):
+            create_usage(user_id=user, usage_type_id=usage_type, usage_at=get_time_now(), amount=amount)
+        return user, usage_type
+
+    def test_usage_changelist_query_count(self, admin_client, django_assert_max_num_queries):
+        self.create_usages(30)
+        with django_assert_max_num_queries(10):
+            response = admin_client.get(reverse('admin:app_usage_changelist'))
+        assert response.status_code == 200
+        assert response.context['cl'].result_count == 30
+
+    def test_usage_changelist_caps_scans(self, admin_client, monkeypatch):
+        monkeypatch.setattr(EstimatedCountPaginator, 'scan_limit', 5)
+        self.create_usages(12)
+
+        response = admin_client.get(reverse('admin:app_usage_changelist'), {'resolution__exact': 0})
+        assert response.context['cl'].result_count == 5
+        assert response.context['cl'].paginator.num_pages == 1
+
+    def test_user_autocomplete(self, admin_client):
+        self.create_usages(1)
+        create_user('Leonard')
+        url = reverse('admin:autocomplete')
+        response = admin_client.get(url, {'term': 'enn', 'app_label': 'app', 'model_name': 'usage',
+                                          'field_name': 'user_id'})
+        assert response.status_code == 200
+        assert [result['text'] for result in response.json()['results']] == ['Penny']
+
+    def test_usage_add_and_delete_keep_rollups(self, admin_client):
+        user, usage_type = self.create_usages(0)
+        response = admin_client.post(reverse('admin:app_usage_add'), {
+            'user_id': user.pk, 'usage_type_id': usage_type.pk, 'usage_at_0': '2022-03-01',
+            'usage_at_1': '10:00:00', 'amount': 4, 'idempotency_key': '',
+        })
+        assert response.status_code == 302
+        usage = Usage.objects.get()
+        assert usage.emissions == 8.0
+        assert UsagePeriodTotal.objects.get().count == 1
+
+        admin_client.post(reverse('admin:app_usage_delete', args=[usage.pk]), {'post': 'yes'})
+        assert not Usage.objects.exists()
+        assert not UsagePeriodTotal.objects.exists()
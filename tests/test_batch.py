@@ -0,0 +1,62 @@
+import pytest
+
+from django.urls import reverse
+from rest_framework import status
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from app.models import Usage
+from tests.helpers import create_usage_types, create_user, get_time_now
+
+
+@pytest.mark.django_db
+class TestBatch:
+
+    def test_batch_dispatches_sub_requests(self, monkeypatch):
+        api_client, user = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        calls = []
+        authenticate = JWTAuthentication.authenticate
+        monkeypatch.setattr(JWTAuthentication, 'authenticate',
+                            lambda self, request: calls.append(request) or authenticate(self, request))
+
+        usages_path = reverse('usages', args=[user.id.hex])
+        data = {'requests': [
+            {'method': 'GET', 'path': reverse('usage_type', args=[usage_type.id])},
+            {'method': 'POST', 'path': usages_path, 'headers': {'Idempotency-Key': 'reading-1'},
+             'body': {'usage_type_id': usage_type.id, 'usage_at': get_time_now(), 'amount': 10}},
+            {'method': 'POST', 'path': usages_path, 'headers': {'Idempotency-Key': 'reading-1'},
+             'body': {'usage_type_id': usage_type.id, 'usage_at': get_time_now(), 'amount': 10}},
+            {'method': 'GET', 'path': usages_path + '?limit=10'},
+            {'method': 'GET', 'path': 'no/such/route'},
+        ]}
+        response = api_client.post(reverse('batch'), data=data, format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert len(calls) == 1
+        statuses = [sub['status'] for sub in response.data['responses']]
+        assert statuses == [200, 201, 201, 200, 404]
+        assert response.data['responses'][0]['body']['name'] == 'Heating'
+        assert response.data['responses'][3]['body']['count'] == 1
+        assert response.data['responses'][3]['body']['results'][0]['usage']['emissions'] == 20.0
+
+    def test_atomic_batch_rolls_back(self):
+        api_client, user = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        other_client, other = create_user('Leonard')
+
+        data = {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': reverse('usages', args=[user.id.hex]),
+             'body': {'usage_type_id': usage_type.id, 'usage_at': get_time_now(), 'amount': 10}},
+            {'method': 'DELETE', 'path': reverse('usages', args=[other.id.hex])},
+            {'method': 'GET', 'path': 'usage_types/'},
+        ]}
+        response = api_client.post(reverse('batch'), data=data, format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['committed'] is False
+        assert [sub['status'] for sub in response.data['responses']] == [201, 403]
+        assert not Usage.objects.exists()
+
+    def test_batch_requires_authentication(self, client):
+        response = client.post(reverse('batch'), data={'requests': []}, content_type='application/json')
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from django.urls import reverse
+from rest_framework import status
+
+from app.models import BudgetEvent
+from tests.helpers import create_usage_types, create_user, get_time_now, reverse_querystring
+
+
+def post_usage(api_client, user, usage_type, amount, usage_at='2022-03-15T10:00:00Z'):
+    return api_client.post(reverse('usages', args=[user.id.hex]), content_type="application/json",
+                           data=json.dumps({"usage_type_id": usage_type.id, "usage_at": usage_at, "amount": amount}))
+
+
+@pytest.mark.django_db
+class TestEmissionsBudgets:
+
+    def test_thresholds_are_recorded_once(self):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        response = api_client.post(reverse('budgets', args=[user.id.hex]), content_type="application/json",
+                                   data=json.dumps({"usage_type_id": heating.id, "limit": 100}))
+        assert response.status_code == status.HTTP_201_CREATED
+
+        post_usage(api_client, user, heating, 20)
+        post_usage(api_client, user, heating, 25)
+        url = reverse('usages', args=[user.id.hex])
+        api_client.delete(url)
+        post_usage(api_client, user, heating, 45)
+        post_usage(api_client, user, heating, 10, usage_at='2022-04-01T10:00:00Z')
+
+        events = BudgetEvent.objects.filter(user_id=user).order_by('period', 'threshold')
+        assert [(event.period.month, event.threshold, event.emissions) for event in events] == \
+            [(3, 0.5, 90.0), (3, 0.8, 90.0)]
+
+        response = api_client.get(reverse_querystring('budgets', args=[user.id.hex], query_kwargs={'period': '2022-03'}))
+        assert response.data == {'period': '2022-03', 'budgets': [{
+            'usage_type_id': heating.id, 'limit': 100.0, 'emissions': 90.0, 'remaining': 10.0, 'used': 0.9,
+            'thresholds_crossed': [0.5, 0.8]}]}
+
+    def test_lowering_a_limit_records_reached_thresholds(self):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        post_usage(api_client, user, heating, 30, usage_at=get_time_now())
+        url = reverse('budgets', args=[user.id.hex])
+        for limit in (1000, 50):
+            api_client.post(url, content_type="application/json",
+                            data=json.dumps({"usage_type_id": heating.id, "limit": limit}))
+
+        assert sorted(BudgetEvent.objects.values_list('threshold', flat=True)) == [0.5, 0.8, 1.0]
+        assert api_client.get(url).data['budgets'][0]['remaining'] == -10.0
+
+        assert api_client.delete(reverse('budget', args=[user.id.hex, heating.id])).status_code == status.HTTP_200_OK
+        assert api_client.get(url).data['budgets'] == []
+        assert api_client.delete(reverse('budget', args=[user.id.hex, heating.id])).status_code == \
+            status.HTTP_404_NOT_FOUND
@@ -0,0 +1,134 @@
+import csv
+import json
+
+import pytest
+
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError
+
+from app import ingest
+from app.management.commands import ingest_spool
+from app.models import Usage
+from tests.helpers import create_usage_types, create_user
+
+
+@pytest.fixture
+def spool(settings, tmp_path):
+    settings.INGEST_SPOOL_DIR = str(tmp_path)
+    (tmp_path / 'incoming').mkdir()
+    return tmp_path
+
+
+def read_report(path):
+    with open(path, newline='') as stream:
+        return [(int(row['line']), row['reason']) for row in csv.DictReader(stream)]
+
+
+@pytest.mark.django_db
+class TestSpoolIngestion:
+
+    def test_csv_and_ndjson_files_are_loaded_with_a_report_of_rejected_rows(self, spool):
+        create_usage_types('Water', 'kg', 0.5)
+        _, user = create_user('Penny')
+        (spool / 'incoming' / 'march.csv').write_text(
+            'user,usage_type,usage_at,amount\n'
+            'Penny,Water,2022-03-01T10:00:00Z,10\n'
+            '\n'
+            'Sheldon,Water,2022-03-01T10:00:00Z,1\n'
+            'Penny,Water,2022-03-02T10:00:00Z\n'
+            'Penny,Water,2022-03-03T10:00:00Z,abc\n')
+        (spool / 'incoming' / 'april.jsonl').write_text(
+            json.dumps({'user': 'Penny', 'usage_type': 'Water', 'usage_at': '2022-04-01T10:00:00Z', 'amount': 4}) +
+            '\n[1, 2]\n' +
+            json.dumps({'user': 'Penny', 'usage_type': 'Gas', 'usage_at': '2022-04-01T10:00:00Z', 'amount': 4}) + '\n')
+        (spool / 'incoming' / '.upload.csv.part').write_text('user\n')
+
+        out = StringIO()
+        call_command('ingest_spool', workers=0, stdout=out)
+        assert 'march.csv: 1 usages loaded, 0 already stored, 3 rows rejected' in out.getvalue()
+        assert 'april.jsonl: 1 usages loaded, 0 already stored, 2 rows rejected' in out.getvalue()
+        assert sorted(Usage.objects.filter(user_id=user).values_list('emissions', flat=True)) == [2.0, 5.0]
+
+        assert read_report(spool / 'done' / 'march.csv.rejected.csv') == [
+            (4, "Unknown user 'Sheldon'."), (5, 'Expected 4 columns, got 3.'),
+            (6, 'amount: A valid number is required.')]
+        assert [line for line, _ in read_report(spool / 'done' / 'april.jsonl.rejected.csv')] == [2, 3]
+        assert not list((spool / 'processing').iterdir())
+        assert [path.name for path in (spool / 'incoming').iterdir()] == ['.upload.csv.part']
+
+    def test_interrupted_files_resume_from_their_checkpoint(self, spool, monkeypatch):
+        create_usage_types('Water', 'kg', 0.5)
+        _, user = create_user('Penny')
+        lines = ['user,usage_type,usage_at,amount']
+        lines += ['Penny,Water,2022-03-{:02d}T10:00:00Z,{}'.format(day, day) for day in range(1, 11)]
+        lines.insert(3, 'Nobody,Water,2022-03-01T10:00:00Z,1')
+        (spool / 'incoming' / 'march.csv').write_text('\n'.join(lines) + '\n')
+
+        calls = []
+        write_checkpoint = ingest.write_checkpoint
+
+        def interrupted(path, state):
+            # Stop after the second batch is inserted, before it is checkpointed.
+            calls.append(state['line'])
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            write_checkpoint(path, state)
+        monkeypatch.setattr(ingest, 'write_checkpoint', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            call_command('ingest_spool', workers=0, batch_size=4, stdout=StringIO())
+        checkpoint = ingest.read_checkpoint(str(spool / 'processing' / 'march.csv'))
+        assert (checkpoint['line'], checkpoint['loaded'], checkpoint['rejected']) == (5, 3, 1)
+        assert Usage.objects.filter(user_id=user).count() == 7
+
+        monkeypatch.setattr(ingest, 'write_checkpoint', write_checkpoint)
+        out = StringIO()
+        call_command('ingest_spool', workers=0, batch_size=4, stdout=out)
+        assert 'march.csv: 6 usages loaded, 4 already stored, 1 rows rejected' in out.getvalue()
+        assert Usage.objects.filter(user_id=user).count() == 10
+        assert read_report(spool / 'done' / 'march.csv.rejected.csv') == [(4, "Unknown user 'Nobody'.")]
+        assert not (spool / 'processing' / 'march.csv.checkpoint').exists()
+
+    def test_rows_the_database_refuses_are_rejected_without_stopping_the_service(self, spool, monkeypatch):
+        create_usage_types('Water', 'kg', 0.5)
+        _, user = create_user('Penny')
+        (spool / 'incoming' / 'march.csv').write_text(
+            'user,usage_type,usage_at,amount\n' +
+            ''.join('Penny,Water,2022-03-{:02d}T10:00:00Z,{}\n'.format(day, day) for day in range(1, 5)))
+        (spool / 'incoming' / 'april.csv').write_text('user,usage_type,usage_at,amount\n')
+        bulk_create_usages = ingest.bulk_create_usages
+
+        def refuse_three(rows, **kwargs):
+            if any(row['amount'] == 3 for row in rows):
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            return bulk_create_usages(rows, **kwargs)
+        monkeypatch.setattr(ingest, 'bulk_create_usages', refuse_three)
+
+        out = StringIO()
+        call_command('ingest_spool', workers=0, stdout=out)
+        assert 'march.csv: 3 usages loaded, 0 already stored, 1 rows rejected' in out.getvalue()
+        assert 'april.csv: 0 usages loaded' in out.getvalue()
+        assert Usage.objects.filter(user_id=user).count() == 3
+        assert read_report(spool / 'done' / 'march.csv.rejected.csv') == [
+            (4, 'IntegrityError: FOREIGN KEY constraint failed')]
+
+    def test_a_failing_file_does_not_stop_the_others(self, spool, monkeypatch):
+        create_usage_types('Water', 'kg', 0.5)
+        create_user('Penny')
+        for name in ('a.csv', 'b.csv'):
+            (spool / 'incoming' / name).write_text(
+                'user,usage_type,usage_at,amount\nPenny,Water,2022-03-01T10:00:00Z,1\n')
+        ingest_file = ingest.ingest_file
+
+        def fail_a(path, **kwargs):
+            if path.endswith('a.csv'):
+                raise OperationalError('database is locked')
+            return ingest_file(path, **kwargs)
+        monkeypatch.setattr(ingest_spool, 'ingest_file', fail_a)
+
+        out, err = StringIO(), StringIO()
+        call_command('ingest_spool', workers=0, stdout=out, stderr=err)
+        assert 'a.csv: failed - database is locked' in err.getvalue()
+        assert 'b.csv: 1 usages loaded' in out.getvalue()
+        assert (spool / 'processing' / 'a.csv').exists()
@@ -0,0 +1,73 @@
+import json
+import pytest
+
+from django.urls import reverse
+from rest_framework import status
+
+from app.models import UserPeriodEmissions
+from tests.helpers import create_usage_types, create_user, reverse_querystring
+
+
+def post_usage(api_client, user, usage_type, amount, usage_at='2022-03-15T10:00:00Z'):
+    url = reverse('usages', args=[user.id.hex])
+    data = json.dumps({"usage_type_id": usage_type.id, "usage_at": usage_at, "amount": amount})
+    return api_client.post(url, data=data, content_type="application/json")
+
+
+@pytest.mark.django_db
+class TestLeaderboard:
+
+    def test_leaderboard_admin(self, api_client_admin):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        water = create_usage_types('Water', 'kg', 1.0)
+        api_client_1, user_1 = create_user('Penny')
+        api_client_2, user_2 = create_user('Sheldon')
+        api_client_3, user_3 = create_user('Howard')
+
+        post_usage(api_client_1, user_1, heating, 10)
+        post_usage(api_client_1, user_1, water, 5)
+        post_usage(api_client_2, user_2, heating, 20)
+        post_usage(api_client_3, user_3, water, 1)
+        post_usage(api_client_3, user_3, water, 100, usage_at='2022-04-01T10:00:00Z')
+
+        url = reverse_querystring('leaderboard', query_kwargs={'period': '2022-03', 'limit': 2})
+        response = api_client_admin.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert [(entry['name'], entry['emissions']) for entry in response.data['leaderboard']] == \
+            [('Sheldon', 40.0), ('Penny', 25.0)]
+
+    def test_leaderboard_follows_user_deletion(self, api_client_admin):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client_1, user_1 = create_user('Penny')
+        api_client_2, user_2 = create_user('Sheldon')
+        post_usage(api_client_1, user_1, heating, 10)
+        post_usage(api_client_2, user_2, heating, 20)
+
+        api_client_admin.delete(reverse('user', args=[user_2.id.hex]))
+
+        url = reverse_querystring('leaderboard', query_kwargs={'period': '2022-03'})
+        response = api_client_admin.get(url)
+        assert [entry['name'] for entry in response.data['leaderboard']] == ['Penny']
+        assert UserPeriodEmissions.objects.count() == 1
+
+    def test_leaderboard_forbidden(self):
+        api_client, user = create_user('Penny')
+        url = reverse_querystring('leaderboard', query_kwargs={'period': '2022-03'})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    def test_leaderboard_limit(self, api_client_admin, monkeypatch):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        for index in range(3):
+            api_client, user = create_user('User {}'.format(index))
+            post_usage(api_client, user, heating, index + 1)
+
+        url = reverse_querystring('leaderboard', query_kwargs={'period': '2022-03', 'limit': 'all'})
+        response = api_client_admin.get(url)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert 'limit' in response.data
+
+        monkeypatch.setattr('app.controller.LEADERBOARD_MAX_SIZE', 2)
+        url = reverse_querystring('leaderboard', query_kwargs={'period': '2022-03', 'limit': 1000})
+        response = api_client_admin.get(url)
+        assert [entry['name'] for entry in response.data['leaderboard']] == ['User 2', 'User 1']
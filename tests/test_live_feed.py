@@ -0,0 +1,137 @@
+import asyncio
+import json
+
+from io import StringIO
+
+import pytest
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from app.live import Hub, LiveFeedApplication, SocketBroker, hub
+from app.models import Usage, User
+from tests.helpers import create_usage_types, create_user, get_time_now, reverse_querystring
+
+
+async def not_found(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def open_feed(user, token):
+    inbox = asyncio.Queue()
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'path': '/app/user/{}/usage/stream'.format(user.id.hex),
+             'query_string': 'token={}'.format(token).encode(), 'headers': []}
+    task = asyncio.ensure_future(LiveFeedApplication(not_found)(scope, inbox.get, send))
+    return task, inbox, sent
+
+
+def events(sent):
+    return [json.loads(message['body'][len(b'data: '):]) for message in sent
+            if message.get('body', b'').startswith(b'data: ')]
+
+
+@pytest.mark.django_db(transaction=True)
+class TestLiveFeed:
+
+    def test_feed_pushes_created_usages_and_totals(self):
+        api_client, user = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        token = RefreshToken.for_user(user).access_token
+
+        def post_usages():
+            url = reverse('usages', args=[user.id.hex])
+            for amount in (10, 5):
+                api_client.post(url, data=json.dumps({'usage_type_id': usage_type.id, 'usage_at': get_time_now(),
+                                                      'amount': amount}), content_type='application/json')
+
+        async def scenario():
+            task, inbox, sent = open_feed(user, token)
+            while not hub.has_subscribers(user.id.hex):
+                await asyncio.sleep(0.01)
+            await sync_to_async(post_usages)()
+            while len(events(sent)) < 2:
+                await asyncio.sleep(0.01)
+            await inbox.put({'type': 'http.disconnect'})
+            await task
+            return sent
+
+        sent = async_to_sync(scenario)()
+        assert sent[0]['status'] == 200
+        created = events(sent)
+        assert [event['event'] for event in created] == ['created', 'created']
+        assert created[1]['usages'][0]['amount'] == 5
+        assert created[1]['totals'][0]['emissions'] == 30.0
+        assert created[1]['totals'][0]['count'] == 2
+        assert not hub.has_subscribers(user.id.hex)
+
+    def test_feed_pushes_updated_usages(self):
+        api_client, user = create_user('Penny')
+        admin_client, admin = create_user('Sheldon')
+        User.objects.filter(pk=admin.pk).update(is_staff=True)
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        token = RefreshToken.for_user(user).access_token
+        api_client.post(reverse('usages', args=[user.id.hex]), content_type='application/json',
+                        data=json.dumps({'usage_type_id': usage_type.id, 'usage_at': '2022-03-15T10:00:00Z',
+                                         'amount': 10}))
+        usage_id = Usage.objects.get().pk
+
+        def update_usage():
+            url = reverse_querystring('usages', args=[user.id.hex], postfix=usage_id)
+            api_client.put(url, data=json.dumps({'amount': 20, 'usage_at': '2022-03-15T10:00:00Z'}),
+                           content_type='application/json')
+            admin_client.post(reverse('usage_type_factors', args=[usage_type.id]), content_type='application/json',
+                              data=json.dumps({'factor': 3.0, 'valid_from': '2022-01-01T00:00:00Z'}))
+            call_command('recompute_factors', stdout=StringIO())
+
+        async def scenario():
+            task, inbox, sent = open_feed(user, token)
+            while not hub.has_subscribers(user.id.hex):
+                await asyncio.sleep(0.01)
+            await sync_to_async(update_usage)()
+            while len(events(sent)) < 2:
+                await asyncio.sleep(0.01)
+            await inbox.put({'type': 'http.disconnect'})
+            await task
+            return sent
+
+        edited, recomputed = events(async_to_sync(scenario)())
+        assert edited['event'] == recomputed['event'] == 'updated'
+        assert edited['usages'][0]['id'] == recomputed['usages'][0]['id'] == usage_id
+        assert (edited['usages'][0]['amount'], edited['usages'][0]['emissions']) == (20.0, 40.0)
+        assert edited['usages'][0]['previous'] == {'amount': 10.0, 'emissions': 20.0}
+        assert edited['totals'][0]['emissions'] == 40.0
+        assert recomputed['usages'][0]['emissions'] == 60.0
+        assert recomputed['usages'][0]['previous'] == {'amount': 20.0, 'emissions': 40.0}
+        assert recomputed['totals'][0]['emissions'] == 60.0
+
+    def test_feed_requires_owner_token(self):
+        api_client, user = create_user('Penny')
+        other_client, other = create_user('Howard')
+
+        async def scenario(token):
+            task, inbox, sent = open_feed(user, token)
+            await task
+            return sent[0]['status']
+
+        assert async_to_sync(scenario)('') == 401
+        assert async_to_sync(scenario)(RefreshToken.for_user(other).access_token) == 403
+
+
+def test_socket_broker_delivers_between_hubs(tmp_path):
+    receiving = Hub()
+
+    async def scenario():
+        SocketBroker(receiving, tmp_path).start()
+        queue = receiving.subscribe('penny')
+        SocketBroker(Hub(), tmp_path).publish('penny', '{"event": "reset"}')
+        return await asyncio.wait_for(queue.get(), 1)
+
+    assert asyncio.run(scenario()) == '{"event": "reset"}'
@@ -0,0 +1,141 @@
+import json
+
+import pytest
+
+from datetime import datetime, timedelta
+from io import StringIO
+
+import pytz
+
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework import status
+
+from app.archive import archive_usages
+from app.compaction import compact_usages
+from app.models import OutboxEvent, Usage
+from app.outbox import dispatch_outbox
+from tests.helpers import create_usage, create_usage_types, create_user
+
+
+def post_usage(api_client, user, usage_type, amount):
+    return api_client.post(reverse('usages', args=[user.id.hex]), content_type="application/json",
+                           data=json.dumps({"usage_type_id": usage_type.id, "usage_at": "2022-03-15T10:00:00Z",
+                                            "amount": amount}))
+
+
+class ListSink:
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.messages = []
+
+    def deliver(self, messages):
+        if self.fail:
+            raise ConnectionRefusedError
+        self.messages.extend(messages)
+
+
+@pytest.mark.django_db
+class TestOutbox:
+
+    def test_writes_append_events_in_their_transaction(self):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        post_usage(api_client, user, heating, 10)
+        usage_id = Usage.objects.get().pk
+        response = api_client.put(reverse('usage', args=[user.id.hex, usage_id]), content_type="application/json",
+                                  data=json.dumps({"usage_at": "2022-03-15T10:00:00Z", "amount": 12}))
+        assert response.status_code == status.HTTP_200_OK
+        api_client.patch(reverse('usages', args=[user.id.hex]), content_type="application/json",
+                         data=json.dumps({"amount": 5}))
+        api_client.delete(reverse('usage', args=[user.id.hex, usage_id]))
+        api_client.put(reverse('user', args=[user.id.hex]), content_type="application/json",
+                       data=json.dumps({"name": "Penelope"}))
+
+        events = list(OutboxEvent.objects.order_by('pk'))
+        assert [(event.topic, event.event) for event in events] == [
+            ('usage', 'created'), ('usage', 'updated'), ('usage', 'updated'), ('usage', 'deleted'),
+            ('user', 'updated')]
+        assert {event.user_id for event in events} == {user.id}
+        assert events[0].payload['usages'][0]['amount'] == 10.0
+        assert events[1].payload['usages'][0]['emissions'] == 24.0
+        assert events[2].payload == {'usage_ids': [usage_id], 'changes': {'amount': 5.0}}
+        assert events[4].payload == {'name': 'Penelope'}
+
+        response = api_client.post(reverse('usages', args=[user.id.hex]), content_type="application/json",
+                                   data=json.dumps({"usage_type_id": 0, "amount": 1}))
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert OutboxEvent.objects.count() == 5
+
+    def test_dispatch_delivers_batches_to_the_file_sink(self, settings, tmp_path):
+        settings.OUTBOX_SINK_OPTIONS = {'path': tmp_path / 'outbox' / 'events.jsonl'}
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        for amount in (1, 2, 3):
+            post_usage(api_client, user, heating, amount)
+
+        out = StringIO()
+        call_command('dispatch_outbox', batch_size=2, stdout=out)
+        assert 'Delivered 2 events' in out.getvalue() and 'Delivered 1 events' in out.getvalue()
+        assert '0 events pending' in out.getvalue()
+        lines = [json.loads(line) for line in (tmp_path / 'outbox' / 'events.jsonl').read_text().splitlines()]
+        assert [line['payload']['usages'][0]['amount'] for line in lines] == [1.0, 2.0, 3.0]
+        assert {line['user_id'] for line in lines} == {user.id.hex}
+        assert len({line['id'] for line in lines}) == 3
+        assert not OutboxEvent.objects.exists()
+
+    def test_failed_batches_back_off_and_hold_back_later_events_of_their_users(self, api_client_admin):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        other_client, other = create_user('Sheldon')
+        post_usage(api_client, user, heating, 1)
+
+        result = dispatch_outbox(ListSink(fail=True))
+        assert (result['delivered'], result['failed']) == (0, 1)
+        event = OutboxEvent.objects.get()
+        assert event.attempts == 1 and event.next_attempt_at > event.created_at
+
+        post_usage(api_client, user, heating, 2)
+        post_usage(other_client, other, heating, 3)
+        sink = ListSink()
+        result = dispatch_outbox(sink)
+        assert [message['user_id'] for message in sink.messages] == [other.id.hex]
+        assert result['lag_max'] >= 0
+
+        response = api_client_admin.get(reverse('outbox'))
+        assert (response.data['pending'], response.data['retrying']) == (2, 1)
+        assert api_client.get(reverse('outbox')).status_code == status.HTTP_403_FORBIDDEN
+
+        OutboxEvent.objects.update(next_attempt_at=None)
+        dispatch_outbox(sink)
+        assert [message['payload']['usages'][0]['amount'] for message in sink.messages] == [3.0, 1.0, 2.0]
+
+    def test_background_jobs_append_an_event_per_chunk(self, api_client_admin, settings, tmp_path):
+        settings.USAGE_ARCHIVE_DIR = tmp_path
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        _, user = create_user('Penny')
+        start = datetime(2020, 1, 15, 10, 0, tzinfo=pytz.utc)
+        usages = [create_usage(user_id=user, usage_type_id=heating, usage_at=start + timedelta(minutes=minute),
+                               amount=1) for minute in (0, 20, 40)]
+        OutboxEvent.objects.all().delete()
+
+        response = api_client_admin.post(reverse('usage_type_factors', args=[heating.id]),
+                                         content_type="application/json",
+                                         data=json.dumps({"factor": 3.0, "valid_from": "2020-01-01T00:00:00Z"}))
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        call_command('recompute_factors', chunk_size=2, stdout=StringIO())
+        assert compact_usages(Usage.Resolution.HOUR, datetime(2021, 1, 1, tzinfo=pytz.utc)) == 3
+        aggregate = Usage.objects.get()
+        assert archive_usages(datetime(2021, 1, 1, tzinfo=pytz.utc)) == 1
+
+        events = list(OutboxEvent.objects.filter(topic='usage').order_by('pk'))
+        assert [(event.user_id, event.event) for event in events] == [
+            (user.id, 'updated'), (user.id, 'updated'), (user.id, 'compacted'), (user.id, 'archived')]
+        assert [event.payload['usage_ids'] for event in events[:2]] == [
+            [usage.pk for usage in usages[:2]], [usages[2].pk]]
+        assert events[0].payload['changes'] == {'factor': 3.0}
+        assert events[2].payload['replaced_ids'] == [usage.pk for usage in usages]
+        assert events[2].payload['usages'][0]['id'] == aggregate.pk
+        assert events[2].payload['usages'][0]['emissions'] == 9.0
+        assert events[3].payload['usage_ids'] == [aggregate.pk]
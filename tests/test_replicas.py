@@ -0,0 +1,84 @@
+import sqlite3
+
+import pytest
+
+from django.core.cache import cache
+from django.db import router
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from app.models import Usage, UsageTypes
+from app.replicas import ReplicaRouter, ReplicaRoutingMiddleware, copy_sqlite_database
+from app.sharding import use_shard
+
+
+@pytest.fixture
+def replicas(settings):
+    settings.DATABASE_REPLICAS = ['replica']
+    cache.clear()
+
+
+def route(method, token='first', write=False, cookies=None, view=None):
+    replica_router = ReplicaRouter()
+    databases = []
+
+    def route_queries(request):
+        if write:
+            databases.append(replica_router.db_for_write(Usage))
+        databases.append(replica_router.db_for_read(Usage))
+        return HttpResponse()
+
+    request = getattr(RequestFactory(), method.lower())('/app/usage_types/', HTTP_AUTHORIZATION=token)
+    request.COOKIES.update({name: cookie.value for name, cookie in (cookies or {}).items()})
+    response = ReplicaRoutingMiddleware(view or route_queries)(request)
+    response.databases = databases
+    return response
+
+
+def test_safe_requests_read_from_replicas(replicas):
+    assert route('GET').databases == ['replica']
+    assert route('POST').databases == ['default']
+    assert ReplicaRouter().db_for_read(Usage) == 'default'
+
+
+def test_clients_stick_to_the_primary_after_writing(replicas):
+    assert route('GET', write=True).databases == ['default', 'default']
+    assert route('GET').databases == ['default']
+    assert route('GET', token='second').databases == ['replica']
+
+
+def test_the_signed_cookie_keeps_clients_on_the_primary_across_processes(replicas, settings):
+    cookies = route('POST').cookies
+    # Another process, with its own cache, only sees the cookie.
+    cache.clear()
+    assert route('GET', cookies=cookies).databases == ['default']
+    assert route('GET').databases == ['replica']
+
+    cookies[settings.REPLICA_STICKY_COOKIE].set(settings.REPLICA_STICKY_COOKIE, 'forged', 'forged')
+    assert route('GET', cookies=cookies).databases == ['replica']
+
+
+def test_writes_routed_to_a_shard_are_recorded(replicas, settings):
+    settings.USAGE_SHARDS = ['default', 'shard1']
+    databases = []
+
+    def view(request):
+        with use_shard('shard1'):
+            databases.append(router.db_for_write(Usage))
+        databases.append(router.db_for_read(UsageTypes))
+        return HttpResponse()
+
+    route('GET', view=view)
+    assert databases == ['shard1', 'default']
+    assert route('GET').databases == ['default']
+
+
+def test_copy_sqlite_database(tmp_path):
+    primary = str(tmp_path / 'db.sqlite3')
+    with sqlite3.connect(primary) as connection:
+        connection.execute('CREATE TABLE usage (amount REAL)')
+        connection.execute('INSERT INTO usage VALUES (2.5)')
+
+    copy_sqlite_database(primary, str(tmp_path / 'db.replica1.sqlite3'))
+    with sqlite3.connect(str(tmp_path / 'db.replica1.sqlite3')) as connection:
+        assert connection.execute('SELECT amount FROM usage').fetchall() == [(2.5,)]
@@ -0,0 +1,190 @@
+import json
+import uuid
+
+from datetime import date
+
+import pytest
+
+from django.core.management import call_command
+from django.db import connections
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from app.controller import get_emissions_leaderboard
+from app.models import ChangeCounter, Usage, UsagePeriodTotal, UsageTypes, User, UserPeriodEmissions
+from app.rollups import queryset_deltas
+from app.sharding import USAGE_ID_BLOCK_SIZE, jump_hash, move_user, shard_for, use_shard
+from tests.helpers import create_usage_types, reverse_querystring
+
+SHARDS = ['default', 'shard1', 'shard2']
+
+
+@pytest.fixture(scope='module')
+def shard_databases(tmp_path_factory, django_db_setup, django_db_blocker):
+    directory = tmp_path_factory.mktemp('shards')
+    configured = connections.configure_settings(dict(
+        {'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+        **{alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': str(directory / alias)} for alias in SHARDS[1:]}
+    ))
+    for alias in SHARDS[1:]:
+        connections.settings[alias] = configured[alias]
+    with override_settings(USAGE_SHARDS=SHARDS), django_db_blocker.unblock():
+        for alias in SHARDS[1:]:
+            call_command('migrate', database=alias, verbosity=0)
+        yield SHARDS
+    for alias in SHARDS[1:]:
+        connections[alias].close()
+        del connections[alias]
+        del connections.settings[alias]
+
+
+def user_on(alias, name):
+    """Create a User whose id hashes to `alias`."""
+    user_id = next(user_id for user_id in (uuid.UUID(int=number) for number in range(1, 1000))
+                   if shard_for(user_id) == alias and not User.objects.filter(pk=user_id).exists())
+    user = User.objects.create(id=user_id, name=name, password='js.sj')
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+    return client, user
+
+
+def post_usage(client, user, usage_type, amount, usage_at='2022-03-15T10:00:00Z'):
+    return client.post(reverse('usages', args=[user.id.hex]), content_type='application/json',
+                       data=json.dumps({'usage_type_id': usage_type.id, 'usage_at': usage_at, 'amount': amount}))
+
+
+def test_jump_hash_only_moves_users_to_new_shards():
+    keys = range(2000)
+    before = [jump_hash(key, 3) for key in keys]
+    after = [jump_hash(key, 4) for key in keys]
+    moved = [new for old, new in zip(before, after) if old != new]
+    assert set(moved) == {3}
+    assert 350 < len(moved) < 650
+    assert set(before) == {0, 1, 2}
+
+
+@pytest.mark.django_db(transaction=True, databases='__all__')
+class TestSharding:
+
+    def test_usages_live_on_the_shard_of_their_user(self, shard_databases):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        client_1, user_1 = user_on('shard1', 'Penny')
+        client_2, user_2 = user_on('shard2', 'Sheldon')
+
+        assert post_usage(client_1, user_1, heating, 10).status_code == status.HTTP_201_CREATED
+        assert post_usage(client_2, user_2, heating, 20).status_code == status.HTTP_201_CREATED
+        post_usage(client_2, user_2, heating, 5, usage_at='2022-04-01T10:00:00Z')
+        usage_id = Usage.objects.using('shard2').get(amount=5).id
+
+        assert Usage.objects.using('default').count() == 0
+        assert list(Usage.objects.using('shard1').values_list('user_id', flat=True)) == [user_1.id]
+        assert Usage.objects.using('shard2').filter(user_id=user_2).count() == 2
+        assert len(set(Usage.objects.using('shard1').values_list('id', flat=True))
+                   | set(Usage.objects.using('shard2').values_list('id', flat=True))) == 3
+        assert UsageTypes.objects.using('shard2').get(pk=heating.pk).name == 'Heating'
+        assert UsagePeriodTotal.objects.using('shard2').filter(user_id=user_2).count() == 2
+        with use_shard('shard2'):
+            assert {key: value for key, value in queryset_deltas(Usage.objects.all()).items()} == {
+                (total.user_id_id, total.usage_type_id_id, total.period): [total.amount, total.emissions, total.count]
+                for total in UsagePeriodTotal.objects.all()
+            }
+
+        response = client_2.get(reverse('usages', args=[user_2.id.hex]), {'limit': 10})
+        assert [usage['usage']['amount'] for usage in response.data['results']] == [20.0, 5.0]
+        response = client_2.get(reverse('usage', args=[user_2.id.hex, usage_id]))
+        assert response.data['usage']['amount'] == 5.0
+        response = client_2.put(reverse('usage', args=[user_2.id.hex, usage_id]), content_type='application/json',
+                                 data=json.dumps({'usage_at': '2022-04-01T10:00:00Z', 'amount': 6}))
+        assert response.status_code == status.HTTP_200_OK
+        assert client_1.get(reverse('usage', args=[user_1.id.hex, usage_id])).status_code == \
+            status.HTTP_404_NOT_FOUND
+        assert client_2.get(reverse('usage_totals', args=[user_2.id.hex])).data['emissions'] == 52.0
+
+        assert client_2.delete(reverse('usages', args=[user_2.id.hex])).status_code == status.HTTP_200_OK
+        assert Usage.objects.using('shard2').count() == 0
+        assert UsagePeriodTotal.objects.using('shard2').count() == 0
+        assert Usage.objects.using('shard1').count() == 1
+
+    def test_shards_allocate_ids_and_change_sequences_on_their_own(self, shard_databases):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        client_1, user_1 = user_on('shard1', 'Penny')
+        client_2, user_2 = user_on('shard2', 'Sheldon')
+        for amount in (1, 2):
+            post_usage(client_1, user_1, heating, amount)
+        post_usage(client_2, user_2, heating, 3)
+
+        ids_1 = sorted(Usage.objects.using('shard1').values_list('id', flat=True))
+        ids_2 = list(Usage.objects.using('shard2').values_list('id', flat=True))
+        assert ids_1[1] == ids_1[0] + 1
+        assert abs(ids_2[0] - ids_1[0]) >= USAGE_ID_BLOCK_SIZE
+        # The primary counter is only touched once per block.
+        assert ChangeCounter.objects.get(name='usage_id').value == 2 * USAGE_ID_BLOCK_SIZE
+
+        def change_counters():
+            return [ChangeCounter.objects.using(alias).filter(name='usage').values_list('value', flat=True).first()
+                    for alias in SHARDS]
+        assert change_counters() == [None, 2, 1]
+        move_user(user_1.pk, 'shard1', 'shard2')
+        assert change_counters() == [None, 2, 2]
+
+    def test_leaderboard_gathers_every_shard(self, shard_databases):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        for alias, name, amount in (('default', 'Penny', 10), ('shard1', 'Sheldon', 30), ('shard2', 'Howard', 20)):
+            client, user = user_on(alias, name)
+            post_usage(client, user, heating, amount)
+
+        admin = User.objects.create(name='admin', password='js.sj', is_superuser=1, is_staff=1)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(admin).access_token}')
+        response = client.get(reverse_querystring('leaderboard', query_kwargs={'period': '2022-03', 'limit': 2}))
+        assert [(entry['name'], entry['emissions']) for entry in response.data['leaderboard']] == \
+            [('Sheldon', 60.0), ('Howard', 40.0)]
+
+    def test_user_deletion_reaches_its_shard(self, shard_databases):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        client, user = user_on('shard1', 'Penny')
+        post_usage(client, user, heating, 10)
+        user.name = 'Penelope'
+        user.save()
+        assert User.objects.using('shard1').get(pk=user.pk).name == 'Penelope'
+
+        client.delete(reverse('user', args=[user.id.hex]))
+        assert not User.objects.using('shard1').filter(pk=user.pk).exists()
+        assert Usage.objects.using('shard1').count() == 0
+        assert UserPeriodEmissions.objects.using('shard1').count() == 0
+        assert get_emissions_leaderboard(date(2022, 3, 1))['leaderboard'] == []
+
+    def test_loaded_fixtures_reach_every_shard(self, shard_databases):
+        for _ in range(2):
+            call_command('loaddata', 'usagetypes.json', verbosity=0)
+        expected = list(UsageTypes.objects.order_by('pk').values_list('pk', 'name', 'factor'))
+        assert expected
+        for alias in SHARDS[1:]:
+            assert list(UsageTypes.objects.using(alias).order_by('pk').values_list('pk', 'name', 'factor')) == expected
+
+    def test_rebalance_moves_users_to_their_shard(self, shard_databases, settings):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        client_1, user_1 = user_on('shard1', 'Penny')
+        client_2, user_2 = user_on('default', 'Sheldon')
+        settings.USAGE_SHARDS = ['default']
+        post_usage(client_1, user_1, heating, 10)
+        post_usage(client_2, user_2, heating, 20)
+        usage_ids = set(Usage.objects.values_list('id', flat=True))
+
+        settings.USAGE_SHARDS = SHARDS
+        call_command('rebalance_shards', verbosity=0)
+
+        assert set(Usage.objects.using('shard1').values_list('id', flat=True)) | \
+            set(Usage.objects.using('default').values_list('id', flat=True)) == usage_ids
+        assert list(Usage.objects.using('default').values_list('user_id', flat=True)) == [user_2.id]
+        assert UsagePeriodTotal.objects.using('shard1').get().user_id_id == user_1.id
+        response = client_1.get(reverse('usages', args=[user_1.id.hex]))
+        assert response.data['count'] == 1
+
+        post_usage(client_1, user_1, heating, 5)
+        assert Usage.objects.using('shard1').count() == 2
+        assert not usage_ids & set(Usage.objects.using('shard1').filter(amount=5).values_list('id', flat=True))
+
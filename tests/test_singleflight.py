@@ -0,0 +1,92 @@
+import threading
+import time
+
+from app.replicas import RoutingState, _state
+from app.singleflight import Group, coalesce, group
+
+
+def run_concurrently(group, key, func, callers):
+    results = []
+    errors = []
+
+    def call():
+        try:
+            results.append(group.do(key, func))
+        except ValueError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=call) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_concurrent_calls_share_one_execution():
+    group = Group()
+    release = threading.Event()
+    executions = []
+
+    def expensive():
+        executions.append(1)
+        release.wait(5)
+        return {'emissions': 42.0}
+
+    threads, results, errors = run_concurrently(group, 'totals', expensive, 8)
+    while group.shared < 7:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(executions) == 1
+    assert results == [{'emissions': 42.0}] * 8
+    assert not group.in_flight('totals')
+
+
+def test_errors_reach_every_waiter_and_are_not_kept():
+    group = Group()
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise ValueError('database unavailable')
+
+    threads, results, errors = run_concurrently(group, 'totals', failing, 4)
+    while group.shared < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 4
+    assert group.do('totals', lambda: 'fresh') == 'fresh'
+
+
+
+def test_requests_reading_their_own_writes_run_on_their_own():
+    release = threading.Event()
+    executions = []
+
+    @coalesce
+    def totals(user_id):
+        executions.append(user_id)
+        if len(executions) == 1:
+            release.wait(5)
+        return len(executions)
+
+    shared = group.shared
+    leader = threading.Thread(target=totals, args=('penny',))
+    leader.start()
+    while not executions:
+        time.sleep(0.001)
+
+    for state in (RoutingState(use_replica=False), RoutingState(use_replica=True)):
+        state.wrote = state.use_replica
+        token = _state.set(state)
+        try:
+            assert totals('penny') == len(executions)
+        finally:
+            _state.reset(token)
+    release.set()
+    leader.join()
+    assert executions == ['penny'] * 3 and group.shared == shared
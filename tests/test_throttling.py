@@ -0,0 +1,107 @@
+import json
+import threading
+
+import pytest
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.urls import reverse
+from rest_framework import status
+
+from app import throttling
+from app.throttling import AdmissionControlMiddleware, MemoryBucketStore, SQLiteBucketStore
+from app.models import Usage
+from tests.helpers import create_usage_types, create_user, reverse_querystring
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = MemoryBucketStore()
+    monkeypatch.setattr(throttling, '_store', store)
+    return store
+
+
+@pytest.fixture
+def ingest_rate(settings, store):
+    settings.REST_FRAMEWORK = dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={
+        'user': '100/min', 'ingest': '2/min', 'reporting': '100/min'})
+
+
+def test_token_bucket_refills_at_its_rate():
+    store = MemoryBucketStore()
+    assert [store.take('key', 2, 1.0, now=100.0) for _ in range(3)] == [0, 0, 1.0]
+    assert store.take('key', 2, 1.0, now=100.5) == 0.5
+    assert store.take('key', 2, 1.0, now=101.0) == 0
+    assert store.take('key', 2, 1.0, now=200.0) == 0
+    assert store.take('key', 2, 1.0, now=200.0) == 0
+    assert store.take('key', 2, 1.0, now=200.0) == 1.0
+
+
+def test_sqlite_store_is_shared_between_processes(tmp_path):
+    first, second = SQLiteBucketStore(tmp_path / 'throttle.sqlite3'), SQLiteBucketStore(tmp_path / 'throttle.sqlite3')
+    assert first.take('key', 2, 1.0, now=100.0) == 0
+    assert second.take('key', 2, 1.0, now=100.0) == 0
+    assert first.take('key', 2, 1.0, now=100.0) == 1.0
+    assert second.take('other', 2, 1.0, now=100.0) == 0
+
+
+@pytest.mark.django_db
+def test_ingest_is_throttled_per_user_and_endpoint(ingest_rate):
+    heating = create_usage_types('Heating', 'kwh', 2.0)
+    api_client, user = create_user('Penny')
+    other_client, other = create_user('Sheldon')
+    url = reverse('usages', args=[user.id.hex])
+    data = json.dumps({"usage_type_id": heating.id, "usage_at": "2022-03-15T10:00:00Z", "amount": 1})
+
+    statuses = [api_client.post(url, data=data, content_type="application/json").status_code for _ in range(3)]
+    assert statuses == [status.HTTP_201_CREATED, status.HTTP_201_CREATED, status.HTTP_429_TOO_MANY_REQUESTS]
+    response = api_client.post(url, data=data, content_type="application/json")
+    assert response['Retry-After'] == '30'
+
+    assert api_client.get(url).status_code == status.HTTP_200_OK
+    other_url = reverse('usages', args=[other.id.hex])
+    assert other_client.post(other_url, data=data, content_type="application/json").status_code == \
+        status.HTTP_201_CREATED
+
+
+@pytest.mark.django_db
+def test_batches_take_a_token_per_sub_request(ingest_rate):
+    heating = create_usage_types('Heating', 'kwh', 2.0)
+    api_client, user = create_user('Penny')
+    url = reverse('usages', args=[user.id.hex])
+    operation = {'method': 'POST', 'path': url,
+                 'body': {"usage_type_id": heating.id, "usage_at": "2022-03-15T10:00:00Z", "amount": 1}}
+
+    response = api_client.post(reverse('batch'), data={'requests': [operation] * 2}, format='json')
+    assert [sub['status'] for sub in response.data['responses']] == [status.HTTP_201_CREATED] * 2
+    response = api_client.post(reverse('batch'), data={'requests': [operation]}, format='json')
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert Usage.objects.count() == 2
+
+    usage_url = reverse_querystring('usages', args=[user.id.hex], postfix=Usage.objects.first().pk)
+    assert api_client.delete(usage_url).status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert api_client.get(usage_url).status_code == status.HTTP_200_OK
+
+
+def test_requests_above_the_in_flight_limit_are_shed(settings):
+    settings.MAX_IN_FLIGHT_REQUESTS = 1
+    settings.IN_FLIGHT_RETRY_AFTER = 2
+    entered, release = threading.Event(), threading.Event()
+
+    def view(request):
+        entered.set()
+        release.wait(5)
+        return HttpResponse('ok')
+
+    middleware = AdmissionControlMiddleware(view)
+    worker = threading.Thread(target=middleware, args=(RequestFactory().get('/'),))
+    worker.start()
+    entered.wait(5)
+    response = middleware(RequestFactory().get('/'))
+    release.set()
+    worker.join()
+
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response['Retry-After'] == '2'
+    assert middleware.in_flight == 0
+    assert middleware(RequestFactory().get('/')).status_code == status.HTTP_200_OK
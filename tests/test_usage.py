@@ -1,9 +1,14 @@
 import json
 import pytest
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 
+from app.models import Usage, UsagePeriodTotal, UsageTypeFactor, UserPeriodEmissions
+from app.rollups import queryset_deltas, rebuild_usage_rollups
+
 from tests.helpers import (
     create_usage,
     create_usage_types,
@@ -256,3 +261,259 @@ class TestUsageTypes:
         url = reverse_querystring('usages', args=[user_id_1.id.hex], query_kwargs={'limit': 100, 'offset': 0})
         response = api_client_1.get(url)
         assert len(response.data['results']) == 3
+
+    def test_create_usage_stores_emissions(self):
+        api_client, user_id = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+
+        url = reverse('usages', args=[user_id.id.hex])
+        data = json.dumps({"usage_type_id": usage_type.id, "usage_at": get_time_now(), "amount": 25})
+        response = api_client.post(url, data=data, content_type="application/json")
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.data['usage']['emissions'] == 50.0
+
+        usage = Usage.objects.get(user_id=user_id)
+        assert usage.factor == 2.0
+        assert usage.emissions == 50.0
+
+    def test_create_usages_batch(self):
+        api_client, user_id = create_user('Penny')
+        usage_type_1 = create_usage_types('Heating', 'kwh', 2.0)
+        usage_type_2 = create_usage_types('Water', 'kg', 0.5)
+
+        url = reverse('usages', args=[user_id.id.hex])
+        data = json.dumps([{"usage_type_id": usage_type_1.id, "usage_at": get_time_now(), "amount": 10},
+                           {"usage_type_id": usage_type_2.id, "usage_at": get_time_now(), "amount": 4}])
+        response = api_client.post(url, data=data, content_type="application/json")
+        assert response.status_code == status.HTTP_201_CREATED
+        assert [row['usage']['emissions'] for row in response.data] == [20.0, 2.0]
+        assert Usage.objects.filter(user_id=user_id).count() == 2
+
+    def test_create_usages_batch_rejects_rows_that_are_not_objects(self):
+        api_client, user_id = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+
+        url = reverse('usages', args=[user_id.id.hex])
+        for body in ([1, "x"], [{"usage_type_id": usage_type.id, "usage_at": get_time_now(), "amount": 10}, None], 5):
+            response = api_client.post(url, data=json.dumps(body), content_type="application/json")
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not Usage.objects.exists()
+
+    def test_factor_edit_keeps_historical_emissions(self, api_client_admin):
+        api_client, user_id = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        usage_at = get_time_now()
+        usage = create_usage(usage_type_id=usage_type, user_id=user_id, usage_at=usage_at, amount=10)
+
+        url = reverse('usage_type', args=[usage_type.id])
+        data = json.dumps({"name": "Heating", "unit": "kwh", "factor": 3.0})
+        api_client_admin.put(url, data=data, content_type='application/json')
+
+        url = reverse_querystring('usages', args=[user_id.id.hex], postfix=usage.id)
+        data = json.dumps({"amount": 20, "usage_at": usage_at})
+        response = api_client.put(url, data=data, content_type='application/json')
+        assert response.data['usage']['emissions'] == 40.0
+
+    def test_get_usage_totals(self):
+        api_client, user_id = create_user('Penny')
+        usage_type_1 = create_usage_types('Heating', 'kwh', 2.0)
+        usage_type_2 = create_usage_types('Water', 'kg', 0.5)
+
+        create_usage(usage_type_id=usage_type_1, user_id=user_id, usage_at=get_time_now(), amount=10)
+        create_usage(usage_type_id=usage_type_1, user_id=user_id, usage_at=get_time_now(), amount=5)
+        create_usage(usage_type_id=usage_type_2, user_id=user_id, usage_at=get_time_now(), amount=4)
+
+        response = api_client.get(reverse('usage_totals', args=[user_id.id.hex]))
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['emissions'] == 32.0
+        assert response.data['totals'][0] == {'usage_type_id': usage_type_1.id, 'amount': 15.0,
+                                              'emissions': 30.0, 'count': 2}
+
+    def test_create_usage_idempotency_key(self):
+        api_client, user_id = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+
+        url = reverse('usages', args=[user_id.id.hex])
+        data = json.dumps({"usage_type_id": usage_type.id, "usage_at": get_time_now(), "amount": 25})
+        first = api_client.post(url, data=data, content_type="application/json", HTTP_IDEMPOTENCY_KEY='reading-1')
+        retry = api_client.post(url, data=data, content_type="application/json", HTTP_IDEMPOTENCY_KEY='reading-1')
+        assert first.status_code == retry.status_code == status.HTTP_201_CREATED
+        assert retry.data == first.data
+        assert Usage.objects.filter(user_id=user_id).count() == 1
+
+    def test_create_usages_batch_idempotency_keys(self):
+        api_client, user_id = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+
+        url = reverse('usages', args=[user_id.id.hex])
+        rows = [{"usage_type_id": usage_type.id, "usage_at": get_time_now(), "amount": amount,
+                 "idempotency_key": 'reading-{}'.format(amount)} for amount in (1, 2)]
+        api_client.post(url, data=json.dumps(rows), content_type="application/json")
+
+        rows.append({"usage_type_id": usage_type.id, "usage_at": get_time_now(), "amount": 3,
+                     "idempotency_key": 'reading-3'})
+        rows.append(dict(rows[-1]))
+        response = api_client.post(url, data=json.dumps(rows), content_type="application/json")
+        assert response.status_code == status.HTTP_201_CREATED
+        assert [row['usage']['amount'] for row in response.data] == [1, 2, 3, 3]
+        assert Usage.objects.filter(user_id=user_id).count() == 3
+
+        response = api_client.get(reverse('usage_totals', args=[user_id.id.hex]))
+        assert response.data['totals'][0]['count'] == 3
+
+    def test_create_usages_batch_query_count_is_constant(self, django_assert_max_num_queries):
+        api_client, user_id = create_user('Penny')
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        url = reverse('usages', args=[user_id.id.hex])
+
+        def post(count, offset):
+            rows = [{"usage_type_id": usage_type.id, "usage_at": get_time_now(), "amount": 1,
+                     "idempotency_key": 'reading-{}'.format(offset + index)} for index in range(count)]
+            return api_client.post(url, data=json.dumps(rows), content_type="application/json")
+
+        with CaptureQueriesContext(connection) as small_batch:
+            post(2, 0)
+        with django_assert_max_num_queries(len(small_batch)):
+            post(50, 100)
+
+    def test_usage_detail_is_scoped_to_owner(self, api_client_admin, django_assert_num_queries):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user_id = create_user('Penny')
+        other_client, other_user = create_user('Howard')
+        usage = create_usage(usage_type_id=usage_type, user_id=user_id, usage_at=get_time_now(), amount=5)
+
+        url = reverse_querystring('usages', args=[user_id.id.hex], postfix=usage.id)
+        with django_assert_num_queries(2):
+            response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['usage']['emissions'] == 10.0
+
+        url = reverse_querystring('usages', args=[other_user.id.hex], postfix=usage.id)
+        assert api_client_admin.get(url).status_code == status.HTTP_404_NOT_FOUND
+        assert api_client_admin.delete(url).status_code == status.HTTP_404_NOT_FOUND
+        data = json.dumps({"amount": 1, "usage_at": get_time_now()})
+        assert api_client_admin.put(url, data=data, content_type='application/json').status_code \
+            == status.HTTP_404_NOT_FOUND
+        assert Usage.objects.get(pk=usage.pk).amount == 5
+
+    def test_usage_put_and_delete_query_counts(self, django_assert_num_queries):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user_id = create_user('Penny')
+        api_client.post(reverse('usages', args=[user_id.id.hex]), content_type='application/json',
+                        data=json.dumps({"usage_type_id": usage_type.id, "usage_at": "2022-03-15T10:00:00Z",
+                                         "amount": 1}))
+        url = reverse_querystring('usages', args=[user_id.id.hex], postfix=Usage.objects.get().pk)
+
+        # Authentication, the locked read of the Usage, the change counter, the UPDATE of the Usage,
+        # the period total (2), sketch stripe (2) and leaderboard entry, the budgets and the outbox
+        # event. Only the view's transaction opens a savepoint.
+        with django_assert_num_queries(13):
+            response = api_client.put(url, data=json.dumps({"amount": 12, "usage_at": "2022-03-15T10:00:00Z"}),
+                                      content_type='application/json')
+        assert response.data['usage']['emissions'] == 24.0
+
+        # Authentication, the locked read, the DELETE, the period total (2), sketch stripe (2) and
+        # the emptied leaderboard entry, the change counter, the tombstone and the outbox event.
+        with django_assert_num_queries(13):
+            assert api_client.delete(url).status_code == status.HTTP_200_OK
+        assert not UserPeriodEmissions.objects.exists()
+
+    def test_sparse_fieldsets_project_the_select(self):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user_id = create_user('Penny')
+        usage = create_usage(usage_type_id=usage_type, user_id=user_id, usage_at='2022-03-15T10:00:00Z', amount=5)
+
+        url = reverse_querystring('usages', args=[user_id.id.hex], query_kwargs={'fields': 'id,amount,usage_type_id'})
+        with CaptureQueriesContext(connection) as queries:
+            response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()['results'] == [{'id': usage.id, 'usage': {'id': usage_type.id, 'amount': 5.0}}]
+        select = queries.captured_queries[-1]['sql']
+        assert 'JOIN' not in select and '"emissions"' not in select
+
+        url = reverse_querystring('usages', args=[user_id.id.hex], postfix=usage.id,
+                                  query_kwargs={'fields': 'user,usage_type,emissions'})
+        with CaptureQueriesContext(connection) as queries:
+            response = api_client.get(url)
+        assert response.json() == {'user': {'name': 'Penny', 'id': str(user_id.id)},
+                                   'usage': {'id': usage_type.id, 'name': 'Heating', 'unit': 'kwh', 'factor': 2.0,
+                                             'emissions': 10.0}}
+        select = queries.captured_queries[-1]['sql']
+        assert select.count('JOIN') == 2 and '"amount"' not in select
+
+        response = api_client.get(reverse_querystring('usages', args=[user_id.id.hex],
+                                                      query_kwargs={'fields': 'amount,password'}))
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_columnar_layout(self, django_assert_max_num_queries):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        water = create_usage_types('Water', 'kg', 0.5)
+        api_client, user_id = create_user('Penny')
+        for day, usage_type in ((1, heating), (2, water), (3, heating)):
+            create_usage(usage_type_id=usage_type, user_id=user_id, usage_at='2022-03-{:02d}T00:00:00Z'.format(day),
+                         amount=day)
+
+        url = reverse_querystring('usages', args=[user_id.id.hex], query_kwargs={'layout': 'columns', 'limit': 2})
+        with django_assert_max_num_queries(5):
+            response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {
+            'users': {str(user_id.id): {'name': 'Penny'}},
+            'usage_types': {str(heating.id): {'name': 'Heating', 'unit': 'kwh', 'factor': 2.0},
+                            str(water.id): {'name': 'Water', 'unit': 'kg', 'factor': 0.5}},
+            'usage_at': [1646092800.0, 1646179200.0],
+            'usage_type_id': [heating.id, water.id],
+            'amount': [1.0, 2.0],
+            'emissions': [2.0, 1.0],
+            'next_offset': 2,
+        }
+
+        response = api_client.get(reverse_querystring('usages', args=[user_id.id.hex], query_kwargs={
+            'layout': 'columns', 'offset': 2, 'usage_type_id': heating.id}))
+        assert response.data['usage_at'] == [] and response.data['usage_types'] == {}
+        assert response.data['next_offset'] is None
+
+    def assert_rollups_match_usages(self):
+        totals = {(total.user_id_id, total.usage_type_id_id, total.period): [total.amount, total.emissions, total.count]
+                  for total in UsagePeriodTotal.objects.all()}
+        assert totals == pytest.approx(queryset_deltas(Usage.objects.all()))
+
+    def test_bulk_delete_filtered_usages(self):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        water = create_usage_types('Water', 'kg', 0.5)
+        api_client, user_id = create_user('Penny')
+        for day in (1, 15, 28):
+            for usage_type in (heating, water):
+                create_usage(usage_type_id=usage_type, user_id=user_id, usage_at='2022-03-{:02d}T10:00:00Z'.format(day),
+                             amount=day)
+        rebuild_usage_rollups()
+
+        url = reverse_querystring('usages', args=[user_id.id.hex], query_kwargs={
+            'start_date': '2022-03-10T00:00:00Z', 'end_date': '2022-03-31T00:00:00Z', 'usage_type_id': heating.id})
+        response = api_client.delete(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == {'deleted': 2}
+        assert Usage.objects.filter(usage_type_id=heating).count() == 1
+        assert Usage.objects.filter(usage_type_id=water).count() == 3
+        self.assert_rollups_match_usages()
+
+    def test_bulk_patch_usage_type(self):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        gas = create_usage_types('Gas', 'kwh', 3.0)
+        UsageTypeFactor.objects.create(usage_type_id=gas, factor=5.0, valid_from='2022-03-15T00:00:00Z')
+        api_client, user_id = create_user('Penny')
+        for day in (1, 15, 28):
+            create_usage(usage_type_id=heating, user_id=user_id, usage_at='2022-03-{:02d}T10:00:00Z'.format(day),
+                         amount=2)
+        rebuild_usage_rollups()
+
+        url = reverse_querystring('usages', args=[user_id.id.hex], query_kwargs={'usage_type_id': heating.id})
+        response = api_client.patch(url, data=json.dumps({'usage_type_id': gas.id}), content_type='application/json')
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == {'updated': 3}
+        assert list(Usage.objects.order_by('usage_at').values_list('usage_type_id', 'factor', 'emissions')) \
+            == [(gas.id, 3.0, 6.0), (gas.id, 5.0, 10.0), (gas.id, 5.0, 10.0)]
+        self.assert_rollups_match_usages()
+
+        response = api_client.patch(url, data=json.dumps({}), content_type='application/json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
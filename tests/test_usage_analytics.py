@@ -0,0 +1,76 @@
+import pytest
+
+from datetime import datetime
+from io import StringIO
+
+import pytz
+
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework import status
+
+from tests.helpers import create_usage, create_usage_types, create_user, reverse_querystring
+
+
+def usage_at(year, month, day=15):
+    return datetime(year, month, day, 10, 0, tzinfo=pytz.utc)
+
+
+@pytest.mark.django_db
+class TestUsageAnalytics:
+
+    def create_history(self):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        water = create_usage_types('Water', 'kg', 0.5)
+        api_client, user = create_user('Penny')
+        for year, amount in ((2021, 10), (2022, 15)):
+            create_usage(user_id=user, usage_type_id=heating, usage_at=usage_at(year, 3), amount=amount)
+        for day in (1, 2, 3):
+            create_usage(user_id=user, usage_type_id=water, usage_at=usage_at(2022, 4, day), amount=day * 2)
+        return api_client, user, heating, water
+
+    def test_user_analytics(self):
+        api_client, user, heating, water = self.create_history()
+
+        url = reverse_querystring('usage_analytics', args=[user.id.hex], query_kwargs={'window': 2})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['start'] == '2021-03-15'
+        heating_metrics, water_metrics = response.data['usage_types']
+        assert heating_metrics['usage_type_id'] == heating.id
+        assert (heating_metrics['amount'], heating_metrics['emissions']) == (25.0, 50.0)
+        monthly = heating_metrics['monthly']
+        assert monthly['period'][0] == '2021-03' and monthly['period'][12] == '2022-03'
+        assert monthly['emissions'][12] == 30.0
+        assert monthly['yoy'][12] == pytest.approx(0.5)
+        assert monthly['baseline'][:13] == [None] * 12 + [20.0]
+
+        rolling = water_metrics['daily']['rolling_amount']
+        assert rolling[-3:] == [1.0, 3.0, 5.0]
+        assert water_metrics['trend']['amount'] > 0
+
+        url = reverse_querystring('usage_analytics', args=[user.id.hex], query_kwargs={
+            'start_date': '2022-01-01T00:00:00Z', 'usage_type_id': heating.id})
+        response = api_client.get(url)
+        assert [(row['usage_type_id'], row['amount']) for row in response.data['usage_types']] == [(heating.id, 15.0)]
+        assert response.data['usage_types'][0]['trend'] == {'amount': 0.0, 'emissions': 0.0}
+
+    def test_analytics_include_archived_months(self, settings, tmp_path):
+        settings.USAGE_ARCHIVE_DIR = tmp_path
+        api_client, user, heating, water = self.create_history()
+        create_usage(user_id=user, usage_type_id=heating, usage_at=datetime.now(tz=pytz.utc), amount=1)
+        call_command('archive_usage', older_than_days=30, stdout=StringIO())
+
+        response = api_client.get(reverse('usage_analytics', args=[user.id.hex]))
+        assert [row['amount'] for row in response.data['usage_types']] == [26.0, 12.0]
+
+    def test_cohort_analytics_is_admin_only(self, api_client_admin):
+        api_client, user, heating, water = self.create_history()
+        other_client, other = create_user('Sheldon')
+        create_usage(user_id=other, usage_type_id=heating, usage_at=usage_at(2022, 3), amount=5)
+
+        url = reverse_querystring('cohort_analytics', query_kwargs={'user_id': '{},{}'.format(user.id, other.id)})
+        assert api_client.get(url).status_code == status.HTTP_403_FORBIDDEN
+        response = api_client_admin.get(url)
+        assert [row['amount'] for row in response.data['usage_types']] == [30.0, 12.0]
+        assert api_client_admin.get(reverse('cohort_analytics')).status_code == status.HTTP_400_BAD_REQUEST
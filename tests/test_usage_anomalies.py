@@ -0,0 +1,111 @@
+import json
+import uuid
+
+import pytest
+
+from django.db import OperationalError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+
+from app import anomalies
+from app.anomalies import StatisticsStore, get_store
+from app.controller import bulk_create_usages
+from app.models import UsageAnomaly, UsageStatistic
+from tests.helpers import create_usage_types, create_user
+
+
+@pytest.fixture
+def fresh_store(monkeypatch):
+    monkeypatch.setattr(anomalies, '_store', None)
+
+
+def post_usages(api_client, user, usage_type, amounts):
+    rows = [{"usage_type_id": usage_type.id, "usage_at": "2022-03-{:02d}T10:00:00Z".format(day + 1), "amount": amount}
+            for day, amount in enumerate(amounts)]
+    return api_client.post(reverse('usages', args=[user.id.hex]), data=json.dumps(rows),
+                           content_type="application/json")
+
+
+def test_store_is_bounded_and_keeps_evicted_series_for_the_checkpoint(settings):
+    store = StatisticsStore(capacity=2)
+    store.fold([(key, 1.0) for key in ('a', 'b', 'c')])
+    assert list(store._series) == ['b', 'c']
+    assert set(store._dirty) == {'a', 'b', 'c'}
+
+
+# The statistics are updated once the inserts commit.
+@pytest.mark.django_db(transaction=True)
+class TestUsageAnomalies:
+
+    def test_out_of_line_readings_are_recorded(self, fresh_store):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        post_usages(api_client, user, heating, [10, 11, 9, 10, 12, 10, 9, 11, 10, 10])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = post_usages(api_client, user, heating, [10000])
+        assert response.status_code == status.HTTP_201_CREATED
+        assert not any('usagestatistic' in query['sql'] for query in queries.captured_queries)
+        assert post_usages(api_client, user, heating, [11]).status_code == status.HTTP_201_CREATED
+
+        response = api_client.get(reverse('usage_anomalies', args=[user.id.hex]))
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['count'] == 1
+        anomaly = response.data['results'][0]
+        assert (anomaly['amount'], anomaly['usage_type_id']) == (10000.0, heating.id)
+        assert anomaly['expected'] == pytest.approx(10.2)
+        assert anomaly['score'] > 1000
+
+    def test_statistics_survive_a_restart_through_checkpoints(self, fresh_store):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        post_usages(api_client, user, heating, [10] * 12)
+
+        assert get_store().checkpoint() == 1
+        statistic = UsageStatistic.objects.get(user_id=user)
+        assert (statistic.count, statistic.mean) == (12, 10.0)
+        post_usages(api_client, user, heating, [10])
+        get_store().checkpoint()
+        assert UsageStatistic.objects.get(user_id=user).count == 13
+
+        anomalies._store = None
+        post_usages(api_client, user, heating, [500])
+        assert UsageAnomaly.objects.filter(user_id=user).count() == 1
+
+    def test_rolled_back_inserts_leave_the_statistics_untouched(self, fresh_store):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        post_usages(api_client, user, heating, [10] * 3)
+
+        with pytest.raises(RuntimeError), transaction.atomic():
+            bulk_create_usages([{'user_id': user, 'usage_type_id': heating, 'usage_at': '2022-04-01T10:00:00Z',
+                                 'amount': 500}])
+            raise RuntimeError
+        assert get_store().get((user.id, heating.id)) == (3, 10.0, 0.0)
+
+    def test_checkpoints_skip_deleted_series_and_keep_failed_ones(self, fresh_store, api_client_admin,
+                                                                 monkeypatch):
+        heating = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        _, other = create_user('Sheldon')
+        post_usages(api_client, user, heating, [10])
+        post_usages(api_client, other, heating, [20])
+        store = get_store()
+
+        assert api_client_admin.delete(reverse('user', args=[other.id.hex])).status_code == status.HTTP_200_OK
+        assert (other.id, heating.id) not in store._series
+        deleted = (uuid.uuid4(), heating.id)
+        store.fold([(deleted, 1.0)])
+
+        def locked(*args):
+            raise OperationalError('database is locked')
+        upsert_statistics = anomalies._upsert_statistics
+        monkeypatch.setattr(anomalies, '_upsert_statistics', locked)
+        assert store.checkpoint() == 0
+        assert set(store._dirty) == {(user.id, heating.id), deleted}
+
+        monkeypatch.setattr(anomalies, '_upsert_statistics', upsert_statistics)
+        assert store.checkpoint() == 1
+        assert list(UsageStatistic.objects.values_list('user_id', 'count')) == [(user.id, 1)]
+        assert not store._dirty
@@ -0,0 +1,143 @@
+import pytest
+
+from datetime import datetime
+from io import StringIO
+
+import pytz
+
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework import status
+
+from app import archive
+from app.models import Usage, UsageArchiveSegment, UsagePeriodTotal, UsageTypeSketch, UserPeriodEmissions
+from app.rollups import rebuild_usage_rollups
+from tests.helpers import create_usage, create_usage_types, create_user, reverse_querystring
+
+
+@pytest.fixture
+def archive_dir(settings, tmp_path):
+    settings.USAGE_ARCHIVE_DIR = tmp_path
+    return tmp_path
+
+
+def usage_at(year, month, day=15):
+    return datetime(year, month, day, 10, 0, tzinfo=pytz.utc)
+
+
+@pytest.mark.django_db
+class TestUsageArchive:
+
+    def create_history(self):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        old = [create_usage(user_id=user, usage_type_id=usage_type, usage_at=usage_at(2019, month), amount=month)
+               for month in (1, 1, 2)]
+        recent = create_usage(user_id=user, usage_type_id=usage_type, usage_at=datetime.now(tz=pytz.utc), amount=10)
+        return api_client, user, old, recent
+
+    def test_archive_moves_old_rows_to_segments(self, archive_dir):
+        api_client, user, old, recent = self.create_history()
+
+        call_command('archive_usage', older_than_days=365, chunk_size=1, stdout=StringIO())
+
+        assert list(Usage.objects.values_list('id', flat=True)) == [recent.id]
+        segments = UsageArchiveSegment.objects.order_by('period')
+        assert [(segment.period.month, segment.row_count) for segment in segments] == [(1, 2), (2, 1)]
+        assert all((archive_dir / segment.path).exists() for segment in segments)
+
+    def test_reads_merge_archived_rows(self, archive_dir):
+        api_client, user, old, recent = self.create_history()
+        call_command('archive_usage', older_than_days=365, stdout=StringIO())
+
+        url = reverse_querystring('usages', args=[user.id.hex], query_kwargs={'limit': 100, 'offset': 0})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert [row['usage']['amount'] for row in response.data['results']] == [1, 1, 2, 10]
+        assert response.data['results'][0]['user']['name'] == 'Penny'
+
+        url = reverse_querystring('usages', args=[user.id.hex],
+                                  query_kwargs={'start_date': '2019-02-01T00:00:00Z', 'limit': 100})
+        response = api_client.get(url)
+        assert [row['usage']['amount'] for row in response.data['results']] == [2, 10]
+
+        response = api_client.get(reverse('usage_totals', args=[user.id.hex]))
+        assert response.data['totals'][0]['count'] == 4
+        assert response.data['emissions'] == 28.0
+
+        response = api_client.get(reverse('usage_export', args=[user.id.hex]))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        assert lines[0] == 'id,usage_type_id,usage_at,amount,factor,emissions'
+        assert len(lines) == 5
+
+    def test_rebuilt_rollups_include_archived_rows(self, archive_dir):
+        self.create_history()
+        rebuild_usage_rollups()
+
+        def rollups():
+            return (sorted(UsagePeriodTotal.objects.values_list('period', 'amount', 'emissions', 'count')),
+                    sorted(UserPeriodEmissions.objects.values_list('period', 'emissions', 'count')),
+                    sorted((sketch.period, bytes(sketch.data)) for sketch in UsageTypeSketch.objects.all()))
+        before = rollups()
+        assert len(before[0]) == 3
+
+        call_command('archive_usage', older_than_days=365, stdout=StringIO())
+        assert rollups() == before
+        rebuild_usage_rollups()
+        assert rollups() == before
+
+    def test_delete_all_usages_removes_segments(self, archive_dir):
+        api_client, user, old, recent = self.create_history()
+        call_command('archive_usage', older_than_days=365, stdout=StringIO())
+
+        response = api_client.delete(reverse('usages', args=[user.id.hex]))
+        assert response.data == 'Total of 4 Usage has been deleted'
+        assert not UsageArchiveSegment.objects.exists()
+
+    def test_bulk_changes_reject_ranges_reaching_archived_rows(self, archive_dir):
+        api_client, user, old, recent = self.create_history()
+        call_command('archive_usage', older_than_days=365, stdout=StringIO())
+
+        for query_kwargs in ({'usage_type_id': old[0].usage_type_id_id}, {'start_date': '2019-02-01T00:00:00Z'}):
+            url = reverse_querystring('usages', args=[user.id.hex], query_kwargs=query_kwargs)
+            response = api_client.patch(url, content_type='application/json', data='{"amount": 5}')
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+            assert 'archived' in str(response.data['start_date'])
+            assert api_client.delete(url).status_code == status.HTTP_400_BAD_REQUEST
+        assert Usage.objects.get().amount == 10
+        assert UsageArchiveSegment.objects.count() == 2
+
+        url = reverse_querystring('usages', args=[user.id.hex], query_kwargs={'start_date': '2019-03-01T00:00:00Z'})
+        response = api_client.patch(url, content_type='application/json', data='{"amount": 5}')
+        assert response.data == {'updated': 1}
+        assert api_client.delete(url).data == {'deleted': 1}
+
+    def test_reads_open_segments_only_when_the_page_reaches_them(self, archive_dir, monkeypatch):
+        api_client, user, old, recent = self.create_history()
+        call_command('archive_usage', older_than_days=365, stdout=StringIO())
+        opened = []
+
+        def open_segment(path):
+            opened.append(path)
+            return segment_class(path)
+        segment_class = archive.Segment
+        monkeypatch.setattr(archive, 'Segment', open_segment)
+
+        def amounts(limit, offset=0, **query_kwargs):
+            url = reverse_querystring('usages', args=[user.id.hex],
+                                      query_kwargs=dict(query_kwargs, limit=limit, offset=offset))
+            response = api_client.get(url)
+            assert response.data['count'] == 4
+            return [row['usage']['amount'] for row in response.data['results']]
+
+        assert amounts(1, orderby='usage_at', order='desc') == [10]
+        assert amounts(1, order='desc') == [10]
+        assert opened == []
+        assert amounts(2, orderby='usage_at', order='desc') == [10, 2]
+        assert len(opened) == 1
+        assert amounts(2, offset=2, orderby='usage_at', order='desc') == [1, 1]
+        assert amounts(2, offset=1, orderby='amount') == [1, 2]
+
+        response = api_client.get(reverse('usage_export', args=[user.id.hex]))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        assert [int(line.split(',')[0]) for line in lines[1:]] == sorted(usage.id for usage in old + [recent])
@@ -0,0 +1,77 @@
+import json
+import pytest
+
+from django.urls import reverse
+from rest_framework import status
+
+from tests.helpers import create_usage_types, create_user, reverse_querystring
+
+
+@pytest.mark.django_db
+class TestUsageChanges:
+
+    def post_usages(self, api_client, user, usage_type, amounts):
+        url = reverse('usages', args=[user.id.hex])
+        data = json.dumps([{"usage_type_id": usage_type.id, "usage_at": "2022-03-15T10:00:00Z", "amount": amount}
+                           for amount in amounts])
+        return api_client.post(url, data=data, content_type="application/json")
+
+    def get_changes(self, api_client, user, since, limit=100):
+        url = reverse_querystring('usage_changes', args=[user.id.hex], query_kwargs={'since': since, 'limit': limit})
+        return api_client.get(url)
+
+    def test_changes_since_cursor(self):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        self.post_usages(api_client, user, usage_type, [1, 2, 3])
+
+        response = self.get_changes(api_client, user, 0)
+        assert response.status_code == status.HTTP_200_OK
+        assert [change['amount'] for change in response.data['changes']] == [1, 2, 3]
+        cursor = response.data['cursor']
+
+        response = self.get_changes(api_client, user, cursor)
+        assert response.data['changes'] == []
+        assert response.data['cursor'] == cursor
+
+        first, second, third = self.get_changes(api_client, user, 0).data['changes']
+        url = reverse_querystring('usages', args=[user.id.hex], postfix=first['id'])
+        api_client.put(url, data=json.dumps({"amount": 10, "usage_at": "2022-03-15T10:00:00Z"}),
+                       content_type='application/json')
+        api_client.delete(reverse_querystring('usages', args=[user.id.hex], postfix=second['id']))
+
+        response = self.get_changes(api_client, user, cursor)
+        assert [(change['op'], change.get('amount')) for change in response.data['changes']] == \
+            [('upsert', 10), ('delete', None)]
+
+    def test_changes_reset_and_paging(self):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        self.post_usages(api_client, user, usage_type, [1, 2, 3])
+
+        response = self.get_changes(api_client, user, 0, limit=2)
+        assert len(response.data['changes']) == 2
+        assert response.data['has_more']
+        response = self.get_changes(api_client, user, response.data['cursor'], limit=2)
+        assert [change['amount'] for change in response.data['changes']] == [3]
+        assert not response.data['has_more']
+        cursor = response.data['cursor']
+
+        api_client.delete(reverse('usages', args=[user.id.hex]))
+        self.post_usages(api_client, user, usage_type, [4])
+
+        response = self.get_changes(api_client, user, cursor)
+        assert [change['op'] for change in response.data['changes']] == ['reset', 'upsert']
+
+    def test_changes_wrong_user_fails(self):
+        api_client_1, user_1 = create_user('Penny')
+        api_client_2, user_2 = create_user('Howard')
+        response = self.get_changes(api_client_2, user_1, 0)
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    def test_changes_reject_bad_cursor_and_limit(self):
+        api_client, user = create_user('Penny')
+        for since, limit, field in (('abc', 10, 'since'), (-1, 10, 'since'), ('1.5', 10, 'since'), (0, 'ten', 'limit')):
+            response = self.get_changes(api_client, user, since, limit=limit)
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+            assert field in response.data
@@ -0,0 +1,55 @@
+import pytest
+
+from datetime import datetime, timedelta
+from io import StringIO
+
+import pytz
+
+from django.core.management import call_command
+from rest_framework import status
+
+from app.compaction import compact_usages
+from app.models import Usage, UsageTombstone
+from app.rollups import queryset_deltas
+from tests.helpers import create_usage, create_usage_types, create_user, reverse_querystring
+
+
+@pytest.mark.django_db
+class TestUsageCompaction:
+
+    def create_readings(self):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        start = datetime(2020, 1, 31, 22, 0, tzinfo=pytz.utc)
+        for minute in range(0, 240, 20):
+            create_usage(user_id=user, usage_type_id=usage_type, usage_at=start + timedelta(minutes=minute), amount=1)
+        create_usage(user_id=user, usage_type_id=usage_type, usage_at=datetime.now(tz=pytz.utc), amount=5)
+        return api_client, user
+
+    def test_compaction_preserves_sums_and_counts(self):
+        api_client, user = self.create_readings()
+        before = queryset_deltas(Usage.objects.all())
+
+        replaced = compact_usages(Usage.Resolution.HOUR, datetime(2021, 1, 1, tzinfo=pytz.utc), chunk_size=5)
+        assert replaced == 12
+        assert queryset_deltas(Usage.objects.all()) == before
+        hourly = Usage.objects.filter(resolution=Usage.Resolution.HOUR).order_by('usage_at')
+        assert [(usage.usage_at.hour, usage.amount, usage.emissions, usage.sample_count) for usage in hourly] \
+            == [(hour, 3.0, 6.0, 3) for hour in (22, 23, 0, 1)]
+        assert UsageTombstone.objects.count() == 12
+
+        assert compact_usages(Usage.Resolution.HOUR, datetime(2021, 1, 1, tzinfo=pytz.utc)) == 0
+        assert compact_usages(Usage.Resolution.DAY, datetime(2021, 1, 1, tzinfo=pytz.utc)) == 4
+        daily = Usage.objects.filter(resolution=Usage.Resolution.DAY).order_by('usage_at')
+        assert [(usage.usage_at.day, usage.amount, usage.sample_count) for usage in daily] == [(31, 6.0, 6), (1, 6.0, 6)]
+        assert queryset_deltas(Usage.objects.all()) == before
+
+    def test_get_usages_reports_resolution(self):
+        api_client, user = self.create_readings()
+        call_command('compact_usage', resolution='day', older_than_days=30, stdout=StringIO())
+
+        url = reverse_querystring('usages', args=[user.id.hex], query_kwargs={'limit': 100, 'offset': 0})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert [(row['usage']['resolution'], row['usage']['sample_count']) for row in response.data['results']] \
+            == [('raw', 1), ('day', 6), ('day', 6)]
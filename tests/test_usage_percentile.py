@@ -0,0 +1,80 @@
+import json
+import pytest
+
+from django.urls import reverse
+from rest_framework import status
+
+from app.models import Usage, UsagePeriodTotal, UsageTypeSketch
+from app.rollups import load_sketch, rebuild_usage_rollups, sketch_stripe
+from tests.helpers import create_usage_types, create_user, reverse_querystring
+
+
+def post_usages(api_client, user, usage_type, amounts, usage_at='2022-03-15T10:00:00Z'):
+    url = reverse('usages', args=[user.id.hex])
+    data = json.dumps([{"usage_type_id": usage_type.id, "usage_at": usage_at, "amount": amount}
+                       for amount in amounts])
+    return api_client.post(url, data=data, content_type="application/json")
+
+
+@pytest.mark.django_db
+class TestUsagePercentile:
+
+    def test_percentile(self):
+        electricity = create_usage_types('Electricity', 'kwh', 1.5)
+        clients = [create_user(name) for name in ('Penny', 'Sheldon', 'Howard', 'Leonard')]
+        for amount, (api_client, user) in zip((10, 20, 30, 40), clients):
+            post_usages(api_client, user, electricity, [amount / 2, amount / 2])
+
+        api_client, user = clients[2]
+        url = reverse_querystring('usage_percentile', args=[user.id.hex, electricity.id],
+                                  query_kwargs={'period': '2022-03'})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['amount'] == 30.0
+        assert response.data['percentile'] == 62.5
+        assert response.data['users'] == 4
+
+    def test_percentile_tracks_updates_and_deletes(self):
+        electricity = create_usage_types('Electricity', 'kwh', 1.5)
+        api_client_1, user_1 = create_user('Penny')
+        api_client_2, user_2 = create_user('Sheldon')
+        post_usages(api_client_1, user_1, electricity, [10])
+        post_usages(api_client_2, user_2, electricity, [20])
+        usage = Usage.objects.get(user_id=user_2)
+
+        url = reverse_querystring('usages', args=[user_2.id.hex], postfix=usage.id)
+        api_client_2.put(url, data=json.dumps({"amount": 5, "usage_at": "2022-03-15T10:00:00Z"}),
+                         content_type='application/json')
+        total = UsagePeriodTotal.objects.get(user_id=user_2)
+        assert total.amount == 5.0
+        sketch = load_sketch(electricity.id, total.period)
+        assert sketch.count == 2
+        assert sketch.quantile(0) == pytest.approx(5, rel=0.01)
+
+        api_client_2.delete(reverse('usages', args=[user_2.id.hex]))
+        assert not UsagePeriodTotal.objects.filter(user_id=user_2).exists()
+        assert load_sketch(electricity.id, total.period).count == 1
+
+    def test_sketch_stripes_are_merged_on_read(self):
+        electricity = create_usage_types('Electricity', 'kwh', 1.5)
+        clients = [create_user(name) for name in ('Penny', 'Sheldon', 'Howard', 'Leonard')]
+        for amount, (api_client, user) in zip((10, 20, 30, 40), clients):
+            post_usages(api_client, user, electricity, [amount])
+
+        stripes = {sketch_stripe(user.id) for _, user in clients}
+        assert set(UsageTypeSketch.objects.values_list('stripe', flat=True)) == stripes
+        sketch = load_sketch(electricity.id, UsagePeriodTotal.objects.first().period)
+        assert sketch.count == 4
+        assert sketch.quantile(1) == pytest.approx(40, rel=0.01)
+
+        data = sorted(UsageTypeSketch.objects.values_list('stripe', 'data'))
+        rebuild_usage_rollups()
+        assert sorted(UsageTypeSketch.objects.values_list('stripe', 'data')) == data
+
+    def test_percentile_invalid_period(self):
+        electricity = create_usage_types('Electricity', 'kwh', 1.5)
+        api_client, user = create_user('Penny')
+        url = reverse_querystring('usage_percentile', args=[user.id.hex, electricity.id],
+                                  query_kwargs={'period': 'March'})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
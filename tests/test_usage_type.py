@@ -1,10 +1,15 @@
 import json
 import pytest
+import pytz
 
+from datetime import datetime
+from io import StringIO
+
+from django.core.management import call_command
 from django.urls import reverse
 from rest_framework import status
 
-from tests.helpers import create_user, create_usage_types, get_user
+from tests.helpers import create_usage, create_user, create_usage_types, get_user
 
 
 @pytest.mark.django_db
@@ -46,6 +51,24 @@ class TestUsageTypes:
         assert response.data['unit'] == 'm3'
         assert float(response.data['factor']) == 5.16
 
+    def test_update_usage_type_factor_adds_a_factor_version(self, api_client_admin):
+        usage_type = create_usage_types('Heating', 'kwh', 3.89)
+        api_client, user = create_user('Penny')
+        usage = create_usage(usage_type_id=usage_type, user_id=user,
+                             usage_at=datetime(2022, 1, 1, tzinfo=pytz.utc), amount=10)
+
+        url = reverse('usage_type', args=[usage_type.id])
+        data = json.dumps({"name": "Heating", "unit": "kwh", "factor": 5.16})
+        response = api_client_admin.put(url, data=data, content_type='application/json')
+        assert response.status_code == status.HTTP_200_OK
+        call_command('recompute_factors', stdout=StringIO())
+
+        response = api_client_admin.get(reverse('usage_type_factors', args=[usage_type.id]))
+        assert [factor['factor'] for factor in response.data['factors']] == [5.16]
+        assert response.data['factors'][0]['valid_to'] is None
+        usage.refresh_from_db()
+        assert (usage.factor, usage.emissions) == (3.89, 38.9)
+
     def test_delete_usage_type_admin(self, api_client_admin):
         usage_type = create_usage_types('Heating', 'kwh', 3.89)
         url = reverse('usage_type', args=[usage_type.id])
@@ -62,4 +85,62 @@ class TestUsageTypes:
         assert response.status_code == status.HTTP_200_OK
         assert response.data['name'] == 'Heating'
         assert response.data['unit'] == 'kwh'
-        assert response.data['factor'] == 3.89
\ No newline at end of file
+        assert response.data['factor'] == 3.89
+
+    def test_factor_version_recomputes_covered_usages(self, api_client_admin):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        old = create_usage(user_id=user, usage_type_id=usage_type, usage_at=datetime(2021, 6, 1, tzinfo=pytz.utc),
+                           amount=10)
+        new = create_usage(user_id=user, usage_type_id=usage_type, usage_at=datetime(2022, 6, 1, tzinfo=pytz.utc),
+                           amount=10)
+
+        url = reverse('usage_type_factors', args=[usage_type.id])
+        data = json.dumps({"factor": 3.0, "valid_from": "2022-01-01T00:00:00Z"})
+        response = api_client_admin.post(url, data=data, content_type='application/json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+        call_command('recompute_factors', chunk_size=1, stdout=StringIO())
+
+        response = api_client_admin.get(reverse('factor_job', args=[response.data['job']]))
+        assert response.data['status'] == 'done'
+        assert response.data['processed'] == response.data['total'] == 1
+
+        old.refresh_from_db()
+        new.refresh_from_db()
+        assert old.emissions == 20.0
+        assert new.factor == 3.0
+        assert new.emissions == 30.0
+
+    def test_factor_versions_close_previous_range(self, api_client_admin):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        url = reverse('usage_type_factors', args=[usage_type.id])
+        api_client_admin.post(url, data=json.dumps({"factor": 3.0, "valid_from": "2022-01-01T00:00:00Z"}),
+                              content_type='application/json')
+        api_client_admin.post(url, data=json.dumps({"factor": 4.0, "valid_from": "2023-01-01T00:00:00Z"}),
+                              content_type='application/json')
+
+        response = api_client_admin.get(url)
+        factors = response.data['factors']
+        assert [factor['factor'] for factor in factors] == [3.0, 4.0]
+        assert factors[0]['valid_to'] == factors[1]['valid_from']
+        assert factors[1]['valid_to'] is None
+
+        response = api_client_admin.post(url, data=json.dumps({"factor": 5.0, "valid_from": "2021-01-01T00:00:00Z",
+                                                               "valid_to": "2022-06-01T00:00:00Z"}),
+                                         content_type='application/json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_create_usage_resolves_effective_factor(self, api_client_admin):
+        usage_type = create_usage_types('Heating', 'kwh', 2.0)
+        api_client, user = create_user('Penny')
+        url = reverse('usage_type_factors', args=[usage_type.id])
+        api_client_admin.post(url, data=json.dumps({"factor": 3.0, "valid_from": "2022-01-01T00:00:00Z",
+                                                    "valid_to": "2023-01-01T00:00:00Z"}),
+                              content_type='application/json')
+
+        url = reverse('usages', args=[user.id.hex])
+        data = json.dumps([{"usage_type_id": usage_type.id, "usage_at": "2022-03-01T00:00:00Z", "amount": 10},
+                           {"usage_type_id": usage_type.id, "usage_at": "2023-03-01T00:00:00Z", "amount": 10}])
+        response = api_client.post(url, data=data, content_type='application/json')
+        assert [row['usage']['emissions'] for row in response.data] == [30.0, 20.0]
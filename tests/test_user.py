@@ -1,11 +1,13 @@
 import json
 import pytest
 
+from django.db import connection
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from tests.helpers import create_user, get_user
+from app.controller import _has_user_name_fts, search_users
+from tests.helpers import create_user, get_user, reverse_querystring
 
 
 @pytest.mark.django_db
@@ -84,3 +86,72 @@ class TestUsers:
 
         response = api_client_2.delete(url)
         assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    def test_get_all_users_paginated(self, api_client_admin):
+        for name in ('Penny', 'Sheldon', 'Howard', 'Leonard'):
+            create_user(name)
+
+        url = reverse_querystring('users', query_kwargs={'limit': 2})
+        response = api_client_admin.get(url)
+        assert [user['name'] for user in response.data['users']] == ['Howard', 'Leonard']
+        assert set(response.data['users'][0]) == {'id', 'name'}
+
+        url = reverse_querystring('users', query_kwargs={'limit': 2, 'after': response.data['next']})
+        response = api_client_admin.get(url)
+        assert [user['name'] for user in response.data['users']] == ['Penny', 'Sheldon']
+
+        url = reverse_querystring('users', query_kwargs={'limit': 2, 'after': response.data['next']})
+        response = api_client_admin.get(url)
+        assert [user['name'] for user in response.data['users']] == ['admin']
+        assert response.data['next'] is None
+
+    def test_search_users(self, api_client_admin):
+        for name in ('Penny', 'Sheldon', 'Howard', 'Leonard', 'Bernadette'):
+            create_user(name)
+
+        url = reverse_querystring('users', query_kwargs={'search': 'ARD'})
+        response = api_client_admin.get(url)
+        assert [user['name'] for user in response.data['users']] == ['Howard', 'Leonard']
+
+        url = reverse_querystring('users', query_kwargs={'prefix': 'pe'})
+        response = api_client_admin.get(url)
+        assert [user['name'] for user in response.data['users']] == ['Penny']
+
+    def test_search_users_with_wildcards(self, api_client_admin):
+        for name in ('Penny_Hofstadter', 'Penny Hofstadter', '100% Penny'):
+            create_user(name)
+
+        url = reverse_querystring('users', query_kwargs={'search': 'y_H'})
+        response = api_client_admin.get(url)
+        assert [user['name'] for user in response.data['users']] == ['Penny_Hofstadter']
+
+        url = reverse_querystring('users', query_kwargs={'search': '0% P'})
+        response = api_client_admin.get(url)
+        assert [user['name'] for user in response.data['users']] == ['100% Penny']
+
+    def test_search_users_uses_trigram_index(self):
+        if not _has_user_name_fts():
+            pytest.skip('SQLite lacks the FTS5 trigram tokenizer')
+        sql, params = search_users(search='ard', prefix='pe').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        assert sum('app_user_name_fts VIRTUAL TABLE INDEX 0:L1' in step for step in plan) == 2
+
+    def test_get_all_users_bad_limit(self, api_client_admin):
+        response = api_client_admin.get(reverse_querystring('users', query_kwargs={'limit': 'ten'}))
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_stream_users(self, api_client_admin):
+        create_user('Penny')
+        create_user('Sheldon')
+
+        url = reverse_querystring('users', query_kwargs={'stream': 'true', 'search': 'e'})
+        response = api_client_admin.get(url)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        assert [row['name'] for row in rows] == ['Penny', 'Sheldon']
+
+    def test_get_all_users_forbidden(self):
+        api_client, user = create_user('Penny')
+        response = api_client.get(reverse('users'))
+        assert response.status_code == status.HTTP_403_FORBIDDEN